@@ -1,9 +1,11 @@
 from PyQt4 import QtGui, QtCore, Qt
 from PyQt4.QtCore import pyqtSignal
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.threads import deferToThread
 import twisted.internet.error
 
 import time
+import json
 
 import numpy as np
 from copy import deepcopy
@@ -16,6 +18,23 @@ sys.path.append("./lib/sdk2/")
 from gui_helpers import *
 from andor_helpers import *
 from andor_class import KRbiXon
+from krb_frames import KRbFrameSet
+from krb_analysis import KRbAnalysisPool
+import krb_analysis
+from krb_fringe import KRbFringeRemover
+from krb_calibration import KRbCalibration, calibrationKey
+from krb_cosmic import rejectCosmics
+from krb_photon import KRbPhotonCounter
+from krb_autoroi import KRbAutoROI, locateCloud
+from krb_timing import KRbTimingPlanner
+from krb_polling import KRbPollScheduler, expectedDuration
+from krb_archive import KRbArchiveWriter, archivePath, indexPath
+from krb_spool import KRbReplicator, spoolDir, remotePath
+from krb_catalog import KRbCatalog
+from krb_compress import writeShot
+from krb_journal import KRbRawJournal
+from krb_thumbs import KRbThumbnailer
+from krb_history import nextShotId
 
 import qtreactor.pyqt4reactor
 qtreactor.pyqt4reactor.install()
@@ -45,6 +64,25 @@ class MainWindow(QtGui.QWidget):
 	# Acquire mode
 	gAcqMode = KRBCAM_ACQ_MODE
 
+	# Live preview running?
+	gFlagPreview = False
+
+	# Photon counting running?
+	gFlagCounting = False
+
+	# Copying a batch of spooled files?
+	gFlagReplicating = False
+	gReplicationError = None
+
+	# Writing queued shots to the catalog?
+	gFlagCataloging = False
+
+	# Last CCD temperature read
+	gCurrentTemp = None
+
+	# Shots saved since the last full frame when saving ROIs only, None to save a full frame next
+	gShotsSinceKeyframe = None
+
 	gSetTemp = KRBCAM_DEFAULT_TEMP
 
 	# gFileNameBase = gConfig['filebase']
@@ -55,8 +93,38 @@ class MainWindow(QtGui.QWidget):
 		self.reactor = reactor
 		self.setFixedSize(layout_params['main'][0],layout_params['main'][1])
 		self.populate()
+		self.analysisPool = KRbAnalysisPool(self.reactor)
+		self.fringeRemovers = [KRbFringeRemover() for i in range(KRBCAM_N_PLOT_SETTINGS)]
+		self.calibration = KRbCalibration()
+		self.photonCounter = KRbPhotonCounter()
+		self.autoROI = KRbAutoROI()
+		self.timingPlanner = KRbTimingPlanner()
+		self.pollScheduler = KRbPollScheduler()
+		self.archiveWriter = None
+		self.replicator = None
+		if KRBCAM_SPOOL_ENABLE:
+			self.replicator = KRbReplicator()
+			if self.replicator.backlog():
+				self.appendToStatus("{} files from the last session are still to be copied to the data share.\n".format(self.replicator.backlog()))
+			self.replicationCallback = self.reactor.callLater(KRBCAM_REPLICATE_TIMER, self.replicationLoop)
+		self.catalog = None
+		if KRBCAM_CATALOG_ENABLE:
+			self.catalog = KRbCatalog()
+			self.catalogCallback = self.reactor.callLater(KRBCAM_CATALOG_TIMER, self.catalogLoop)
+		self.journal = None
+		if KRBCAM_JOURNAL_ENABLE:
+			try:
+				self.journal = KRbRawJournal()
+			except (IOError, OSError) as e:
+				self.appendToStatus("Raw frame journal error, series won't be journaled: {}\n".format(e))
+		self.thumbnailer = None
+		if KRBCAM_THUMB_ENABLE:
+			self.thumbnailer = KRbThumbnailer(lambda shotId, paths, error: self.reactor.callFromThread(self.thumbnailsDone, shotId, paths, error))
 		self.initializeSDK()
 
+		# Save whatever a crash left in the journal, once everything is running
+		self.reactor.callLater(0, self.replayJournal)
+
 	# Initialize the Andor SDK using our KRbFastKinetics() class built on the atmcd.py python wrapper
 	def initializeSDK(self):
 		# Get form data and set the acquire button to disabled
@@ -91,6 +159,12 @@ class MainWindow(QtGui.QWidget):
 		self.acquireAbortStatus.acquireControl.clicked.connect(lambda: self.setupAcquisition(self.gFlagVerbose))
 		# Abort
 		self.acquireAbortStatus.abortControl.clicked.connect(self.abortAcquisition)
+		# Live preview
+		self.acquireAbortStatus.previewControl.clicked.connect(self.togglePreview)
+		# Photon counting
+		self.acquireAbortStatus.countingControl.clicked.connect(self.toggleCounting)
+		# Master dark
+		self.acquireAbortStatus.darkControl.clicked.connect(self.recordDarks)
 		# CoolerOn
 		self.coolerControl.coolerOnControl.clicked.connect(self.coolerOn)
 		# CoolerOff
@@ -99,9 +173,23 @@ class MainWindow(QtGui.QWidget):
 		self.coolerControl.ccdSetTempEdit.returnPressed.connect(self.updateSetTempFromEdit)
 		# Acquisition mode
 		self.configForm.kineticsFramesEdit.valueChanged.connect(self.controlAcquisitionMode)
+		self.configForm.acqModeControl.currentIndexChanged.connect(self.controlAcquisitionMode)
 		# Freeze acquisitionmode
 		self.acquireAbortStatus.acquireControl.clicked.connect(lambda: self.configForm.freezeForm(True))
 		self.acquireAbortStatus.abortControl.clicked.connect(lambda: self.configForm.freezeForm(False))
+		# Readout timing
+		self.configForm.planControl.clicked.connect(self.planReadout)
+		for edit in [self.configForm.exposureEdit, self.configForm.emGainEdit, self.configForm.dxEdit,
+			self.configForm.dyEdit, self.configForm.maxNoiseEdit]:
+			edit.textChanged.connect(self.updatePrediction)
+		for control in [self.configForm.acqModeControl, self.configForm.adChannelControl,
+			self.configForm.hssControl, self.configForm.vssControl]:
+			control.currentIndexChanged.connect(self.updatePrediction)
+		for control in [self.configForm.kineticsFramesEdit, self.configForm.accumulationsEdit]:
+			control.valueChanged.connect(self.updatePrediction)
+		for control in [self.configForm.binningControl, self.configForm.emEnableControl]:
+			control.stateChanged.connect(self.updatePrediction)
+		self.updatePrediction()
 
 	# Control the acquisition mode
 	def controlAcquisitionMode(self):
@@ -111,10 +199,7 @@ class MainWindow(QtGui.QWidget):
 		self.gFKSeriesLength = ind # No fast kinetics series, just 1 image
 		self.gFileNameBase = KRBCAM_FILENAME_BASE
 		
-		if ind == 0: # "Image"
-			self.gAcqMode = KRBCAM_ACQ_MODE_SINGLE # Single scan
-		else: # "Fast kinetics"
-			self.gAcqMode = KRBCAM_ACQ_MODE_FK # Fast Kinetics
+		self.gAcqMode = self.configForm.getAcquisitionMode()
 
 		# Update the gCamInfo struct
 		# VSS may change going from FK to Image modes
@@ -127,6 +212,38 @@ class MainWindow(QtGui.QWidget):
 			self.configForm.vssControl.addItem("{:.2} usec".format(val))
 		self.configForm.vssControl.setCurrentIndex(default_config['vss'])
 
+	# Show the predicted cycle time of the settings in the form
+	def updatePrediction(self):
+		form = self.configForm.getTimingForm()
+		if form is None:
+			self.configForm.predictionLabel.setText("")
+			return
+		try:
+			t = self.timingPlanner.predict(form, self.gCamInfo, acquisitionMode(form))
+		except (IndexError, KeyError):
+			# Combo boxes are being repopulated
+			return
+		self.configForm.predictionLabel.setText("Predicted cycle {:.1f} ms (readout {:.1f} ms), read noise {:.1f} e-".format(
+			t['cycle'] * 1e3, t['readout'] * 1e3, t['noise']))
+
+	# Set the fastest readout that meets the read noise limit in the form
+	def planReadout(self):
+		form = self.configForm.getTimingForm()
+		if form is None:
+			self.throwErrorMessage("Invalid form data!", "Can't plan the readout.")
+			return
+		mode = acquisitionMode(form)
+		(config, t) = self.timingPlanner.plan(form, self.gCamInfo, mode, form['maxNoise'],
+			self.configForm.allowBinningControl.isChecked())
+		if config is None:
+			self.throwErrorMessage("No readout settings meet the read noise limit!",
+				"Increase the limit or the EM gain.")
+			return
+
+		self.configForm.setReadout(config)
+		self.appendToStatus("Planned readout: AD channel {}, HSS {:.1f} MHz, VSS {:.2} usec, binning {}. Predicted cycle {:.1f} ms.\n".format(
+			config['adChannel'], self.gCamInfo['hss'][config['adChannel']][0 if config['emEnable'] else 1][config['hss']],
+			self.gCamInfo['vss'][config['vss']], config['binning'], t['cycle'] * 1e3))
 
 	# Turn on cooler
 	def coolerOn(self):
@@ -232,6 +349,7 @@ class MainWindow(QtGui.QWidget):
 		# Otherwise, current the current temp field
 		else:
 			self.coolerControl.ccdCurrentTempEdit.setText(str(temp))
+			self.gCurrentTemp = temp
 
 			# Update the cooler status field
 			if ret == self.AndorCamera.DRV_TEMP_OFF:
@@ -295,13 +413,24 @@ class MainWindow(QtGui.QWidget):
 		# At this point we have all the information we need to validate the
 		# user's desired camera configuration
 		# Validate and update the form with the correct values
-		self.gConfig = self.validateFormInput(self.configForm.getFormData())
+		form = self.configForm.getFormData()
+		self.gAcqMode = acquisitionMode(form)
+		self.gConfig = self.validateFormInput(form, self.gAcqMode)
 		self.configForm.setFormData(self.gConfig)
 
-		if self.gConfig['kinFrames'] == 1:
-			self.gAcqMode = KRBCAM_ACQ_MODE_SINGLE
-		else:
-			self.gAcqMode = KRBCAM_ACQ_MODE_FK
+		# Crop the readout around the recent clouds
+		# The form keeps the full region
+		fullShape = self.getImageShape()
+		# A multi-region readout already reads only the chosen rows
+		crop = None
+		useAutoROI = self.acquireAbortStatus.autoROIEnabled() and not readoutRegions(self.gConfig)
+		if useAutoROI:
+			crop = self.autoROI.nextCrop(fullShape, self.gAcqMode == KRBCAM_ACQ_MODE_FK)
+			if crop is not None:
+				self.gConfig = self.autoROI.cropConfig(self.gConfig, crop)
+				if flagVerbose:
+					self.appendToStatus("Readout cropped to x, y, dx, dy = {} (binned pixels).\n".format(crop))
+
 		self.gFKSeriesLength = self.gConfig['kinFrames']
 		self.gAcqLoopLength = self.gConfig['acqLength']
 
@@ -333,6 +462,28 @@ class MainWindow(QtGui.QWidget):
 				return -2
 			elif flagVerbose:
 				self.appendToStatus(errm)
+		elif self.gAcqMode == KRBCAM_ACQ_MODE_ACCUMULATE:
+			(errf, errm) = self.AndorCamera.setupAccumulate(self.gConfig)
+
+			if errf:
+				self.throwErrorMessage("KRbiXon.setupAccumulate error!", errm)
+				return -2
+			elif flagVerbose:
+				self.appendToStatus(errm)
+		elif self.gAcqMode == KRBCAM_ACQ_MODE_KINETICS:
+			(errf, errm) = self.AndorCamera.setupKineticSeries(self.gConfig)
+
+			if errf:
+				self.throwErrorMessage("KRbiXon.setupKineticSeries error!", errm)
+				return -2
+			elif flagVerbose:
+				self.appendToStatus(errm)
+
+		# Correct the timing model with the real readout time
+		if 'readout' in self.AndorCamera.timings:
+			self.timingPlanner.calibrate(self.gConfig, self.gCamInfo, self.gAcqMode, self.AndorCamera.timings['readout'])
+			self.updatePrediction()
+		self.pollScheduler.setup(expectedDuration(self.AndorCamera.timings, self.gConfig, self.gAcqMode))
 
 		# Enable abort button, disable acquire button
 		self.acquireAbortStatus.acquire()
@@ -340,12 +491,78 @@ class MainWindow(QtGui.QWidget):
 		# Reset OD series counter
 		self.gAcqLoopCounter = 0
 
+		# Reset display statistics when the user starts acquiring
+		if flagVerbose:
+			self.imageWindow.resetDisplayStatus()
+
 		# Start acquiring data!
-		# dataArray is passed between startAcquisition and checkForData methods
-		# to hold data
-		# Hopefully this does not result in memory leaks...?
-		dataArray = []
-		self.startAcquisition(dataArray)
+		# frameSet is passed between startAcquisition and checkForData methods
+		# to hold data. Its buffer is allocated once for the whole series.
+		(dy, dx) = self.getImageShape()
+		frameSet = KRbFrameSet(self.gAcqLoopLength, self.gFKSeriesLength, dy, dx, self.gConfig['rotateImage'])
+		frameSet.metadata['config'] = deepcopy(self.gConfig)
+		frameSet.metadata['accumulations'] = accumulations(self.gConfig)
+		frameSet.metadata['timings'] = dict(self.AndorCamera.timings)
+		frameSet.metadata['temperature'] = self.gCurrentTemp
+		frameSet.fullShape = fullShape
+		if crop is not None:
+			frameSet.origin = (crop[0], crop[1])
+		frameSet.regionRows = regionRows(self.gConfig)
+		frameSet.metadata['autoROIFull'] = useAutoROI and crop is None
+		self.selectCalibration(frameSet, flagVerbose)
+		self.startAcquisition(frameSet)
+
+	# Find the dark and hot pixel calibration for the camera configuration
+	# and decide whether it is applied to this frame set
+	def selectCalibration(self, frameSet, flagVerbose):
+		shape = np.shape(frameSet.frames)[1:]
+		self.calibration.select(calibrationKey(self.gConfig, self.gSetTemp), (shape[0],) + tuple(frameSet.fullShape))
+		if flagVerbose:
+			self.appendToStatus(self.calibration.describe() + "\n")
+
+		# Darks being recorded have to stay raw
+		calibrated = self.acquireAbortStatus.calibrationEnabled() and self.calibration.ready() and not self.calibration.recording
+		frameSet.metadata['calibrated'] = calibrated
+		if calibrated:
+			# Already subtracted from every frame
+			frameSet.darkFrames = np.zeros(shape, dtype=frameSet.frames.dtype)
+		elif self.calibration.ready():
+			frameSet.darkFrames = self.calibration.dark(frameSet.origin, shape)
+
+	# Cosmic ray rejection on a completed frame set
+	# The number of repaired pixels in each frame goes in the status log
+	def repairCosmics(self, frameSet):
+		counts = rejectCosmics(frameSet.frames)
+		frameSet.metadata['cosmics'] = counts
+		self.appendToStatus("Cosmic rays: {} pixels repaired {}.\n".format(np.sum(counts), counts.tolist()))
+
+	def recordDarks(self):
+		self.calibration.startRecording()
+		self.appendToStatus("Recording the master dark from the next {} series.\n".format(KRBCAM_DARK_COUNT))
+
+	# Add the dark frames of a series to the master dark being recorded
+	# These are the frames selected as the dark for each setting
+	def addDarks(self, frameSet):
+		# Only full frames that weren't calibrated already
+		if frameSet.metadata.get('calibrated', False) or np.shape(frameSet.frames)[2:] != tuple(frameSet.fullShape) or \
+			frameSet.regionRows is not None:
+			return
+
+		darks = set()
+		for fss in self.imageWindow.getFrameSelectState():
+			i = fss[2][0]
+			if i is not None and i != KRBCAM_MASTER_DARK and i < frameSet.acqLength:
+				darks.add(i)
+
+		if not darks:
+			self.calibration.stopRecording()
+			self.appendToStatus("No dark frame is selected, stopped recording the master dark.\n")
+			return
+
+		for i in sorted(darks):
+			if self.calibration.addDark(frameSet.frames[i]):
+				self.appendToStatus("Master dark recorded. " + self.calibration.describe() + "\n")
+				break
 
 	# Start acquisition
 	# Tells the camera to start acquiring data
@@ -359,11 +576,12 @@ class MainWindow(QtGui.QWidget):
 			self.throwErrorMessage("Acquisition error!", msg)
 		else:
 			# Set a timer for looking for the data
+			# The first check is when the shot is expected to be done
 			self.appendToStatus("Acquiring...\n")
-			self.acquireCallback = self.reactor.callLater(KRBCAM_ACQ_TIMER, self.checkForData, data)
+			self.acquireCallback = self.reactor.callLater(self.pollScheduler.start(self.gAcqLoopCounter), self.checkForData, data)
 
-	# Method that fires after the KRBCAM_ACQ_TIMER time has elapsed
-	# data argument holds list of numpy arrays that contain the data collected so far in this acquisition
+	# Method that fires when the poll scheduler expects the data
+	# data argument is the KRbFrameSet that holds the data collected so far in this acquisition
 	def checkForData(self, data):
 		# Check if the camera is still acquiring:
 		(ret, status) = self.AndorCamera.GetStatus()
@@ -376,10 +594,12 @@ class MainWindow(QtGui.QWidget):
 			# If still acquiring, run the timer again
 			if status == self.AndorCamera.DRV_ACQUIRING:
 				# Check back for new data later
-				self.acquireCallback = self.reactor.callLater(KRBCAM_ACQ_TIMER, self.checkForData, data)
+				self.acquireCallback = self.reactor.callLater(self.pollScheduler.next(), self.checkForData, data)
 
 			# If idle, then data has been acquired
 			elif status == self.AndorCamera.DRV_IDLE:
+				self.pollScheduler.finished()
+
 				# Increment OD series counter since we've taken an image
 				self.gAcqLoopCounter += 1
 
@@ -389,23 +609,25 @@ class MainWindow(QtGui.QWidget):
 				# Get the data off of the camera
 				newData = self.getData()
 
-				# If we need to rotate image
-				if self.gConfig['rotateImage']:
-					# The axes are kinetics frame, height, width
-					# Need to 
-					newData = np.flip(np.swapaxes(np.array(newData), 1, 2), axis=-1)
-				else:
-					newData = np.array(newData)
+				# getData already aborted the acquisition after a readout error
+				if not isinstance(newData, np.ndarray):
+					return
 
-				print np.shape(np.array(newData))
+				# Keep the previews out of the way while this shot is handled
+				if self.thumbnailer is not None:
+					self.thumbnailer.hold()
 
-				# Append it to the data array
-				if self.gAcqLoopCounter > 1:
-					for i in range(len(data)):
-						data[i] = np.concatenate((data[i], newData[i]))
-				else:
-					for i in range(len(newData)):
-						data.append(newData[i])
+				# Journal the raw frames before anything else can go wrong
+				self.journalData(data, newData)
+
+				# Copy it into the frame set
+				# Image rotation is not applied here, the frame set keeps track of it
+				data.addShot(newData)
+
+				# Subtract the master dark and repair hot pixels in place
+				if data.metadata.get('calibrated', False):
+					self.calibration.apply(data.frames[data.nAcquired - 1], data.origin)
+					data.clearGaps(data.nAcquired - 1)
 
 				# If need to take more in the OD series, acquire again
 				if self.gAcqLoopCounter < self.gAcqLoopLength:
@@ -416,24 +638,27 @@ class MainWindow(QtGui.QWidget):
 					# This catches when the directory should roll over at midnight
 					self.configForm.checkDir()
 					self.gConfig = self.configForm.getFormData()
+					data.metadata['fileNumber'] = self.gConfig['fileNumber']
+					data.metadata['shotId'] = nextShotId()
+					data.metadata['savePath'] = self.gConfig['savePath']
+					data.metadata['saveFiles'] = self.gConfig['saveFiles']
+
+					if self.calibration.recording:
+						self.addDarks(data)
+
+					# Repair cosmic ray hits before anything else sees the frames
+					if self.acquireAbortStatus.cosmicRejectionEnabled():
+						self.repairCosmics(data)
 
 					# If we're saving the files
 					if self.gConfig['saveFiles']:
-	 					# Save data
-	 					if self.gAcqMode == KRBCAM_ACQ_MODE_FK:
-
-	 						# This is an ugly way of doing this but oh well
-	 						savearray = data[0]
-	 						# Save all the data as one file
-	 						# So the data file will have e.g.
-	 						# K shadow, light, dark, Rb shadow, light, dark
-							for j in range(1, self.gFKSeriesLength):
-								savearray = np.concatenate((savearray, data[j]))
-							self.saveData(savearray)
-							self.appendToStatus("Data saved.\n")
-						elif self.gAcqMode == KRBCAM_ACQ_MODE_SINGLE:
-							self.saveData(data[0])
-							self.appendToStatus("Data saved.\n")
+						# Save all the data as one file
+						# So the data file will have e.g.
+						# K shadow, light, dark, Rb shadow, light, dark
+						self.saveData(data)
+						self.appendToStatus("Data saved.\n")
+						if self.journal is not None and data.metadata.has_key('journalSeries'):
+							self.journal.finish(data.metadata['journalSeries'])
 					else:
 						self.appendToStatus("Data saving is turned off.\n")
 
@@ -441,11 +666,10 @@ class MainWindow(QtGui.QWidget):
 						self.gConfig['fileNumber'] += 1
 						self.configForm.setFormData(self.gConfig)
 
-					# Display the data
-					self.imageWindow.imageRotated(self.gConfig['rotateImage'])
-					self.imageWindow.setData(data, self.gFKSeriesLength, self.gAcqLoopLength)
-					self.imageWindow.displayData()
-	
+					# Fringe removal, display and analysis
+					# None of these hold up the next acquisition
+					self.processFrameSet(data)
+
 					# if not looping:
 					if not self.gFlagLoop:
 						# Disable abort button, enable acquire button
@@ -458,15 +682,247 @@ class MainWindow(QtGui.QWidget):
 			else:
 				self.throwErrorMessage("Error in acquisition loop.", "Camera state is {}".format(status))
 
-	# Get data from camera
-	def getData(self):
-		# First need to get the total size of the image in binned pixels
+	# Size of a single image in binned pixels (camera orientation)
+	def getImageShape(self):
 		dy = self.gConfig['dy']
 		dx = self.gConfig['dx']
 
 		if (self.gConfig['binning']):
 			dy /= KRBCAM_BIN_SIZE
 			dx /= KRBCAM_BIN_SIZE
+		return (dy, dx)
+
+	# Shape of a single image as read from the camera
+	# A multi-region readout only has the rows of the regions
+	def getReadoutShape(self):
+		(dy, dx) = self.getImageShape()
+		rows = regionRows(self.gConfig)
+		if rows is not None:
+			dy = len(rows)
+		return (dy, dx)
+
+	# Start or stop the live preview
+	def togglePreview(self):
+		if self.gFlagPreview:
+			self.stopPreview()
+		else:
+			self.startPreview()
+
+	# Live preview for aligning the imaging optics
+	# Runs the camera in run till abort mode and shows the most recent frame
+	# Nothing is saved, and gConfig is left alone so the next acquisition
+	# is set up exactly as configured in the form
+	def startPreview(self):
+		(errf, errm) = self.AndorCamera.armiXon()
+		if errf:
+			self.throwErrorMessage("KRbiXon.armiXon error!", errm)
+			return -1
+		self.gCamInfo = self.AndorCamera.camInfo
+
+		# Same region of the CCD as the configured acquisition,
+		# but without the fast kinetics restrictions
+		binning = self.acquireAbortStatus.getPreviewBinning()
+		config = deepcopy(self.configForm.getFormData())
+		config['binning'] = False
+		config = self.validateFormInput(config, KRBCAM_ACQ_MODE_RTA)
+		config['dy'] -= config['dy'] % binning
+		config['dx'] -= config['dx'] % binning
+
+		(errf, errm) = self.AndorCamera.setupAcquisition(config)
+		if errf:
+			self.throwErrorMessage("KRbiXon.setupAcquisition error!", errm)
+			return -2
+
+		(errf, errm) = self.AndorCamera.setupPreview(config, binning)
+		if errf:
+			self.throwErrorMessage("KRbiXon.setupPreview error!", errm)
+			return -2
+		self.appendToStatus(errm)
+
+		ret = self.AndorCamera.StartAcquisition()
+		msg = self.AndorCamera.handleErrors(ret, "StartAcquisition error: ", "")
+		if ret != self.AndorCamera.DRV_SUCCESS:
+			self.throwErrorMessage("Preview error!", msg)
+			return -3
+
+		self.gPreviewShape = (config['dy'] / binning, config['dx'] / binning)
+		self.gPreviewRotate = config['rotateImage']
+		self.gPreviewCount = 0
+		self.gFlagPreview = True
+
+		self.acquireAbortStatus.preview(True)
+		self.configForm.freezeForm(True)
+		self.imageWindow.previewMode(True)
+		self.appendToStatus("Live preview started.\n")
+
+		self.previewCallback = self.reactor.callLater(1.0/KRBCAM_PREVIEW_MAX_FPS, self.previewLoop)
+
+	# Pull the most recent frame off the camera and hand it to the display
+	def previewLoop(self):
+		(dy, dx) = self.gPreviewShape
+		(errf, errm, count, data) = self.AndorCamera.getMostRecentImage(dy * dx, self.gPreviewCount)
+		if errf:
+			self.stopPreview()
+			self.throwErrorMessage("Preview error!", errm)
+			return
+
+		# Only a new frame is drawn
+		if data is not None:
+			self.gPreviewCount = count
+			frameSet = KRbFrameSet(1, 1, dy, dx, self.gPreviewRotate)
+			frameSet.addShot(np.reshape(np.ctypeslib.as_array(data), (1, dy, dx)))
+			self.imageWindow.postData(frameSet)
+
+		self.previewCallback = self.reactor.callLater(1.0/KRBCAM_PREVIEW_MAX_FPS, self.previewLoop)
+
+	# Stop the live preview
+	# The camera is left idle, the next acquisition sets up everything again
+	def stopPreview(self):
+		try:
+			self.previewCallback.cancel()
+		except:
+			pass
+
+		ret = self.AndorCamera.AbortAcquisition()
+		if ret != self.AndorCamera.DRV_SUCCESS and ret != self.AndorCamera.DRV_IDLE:
+			self.throwErrorMessage("AbortAcquisition error!", "Error code: {}".format(ret))
+
+		self.gFlagPreview = False
+		self.acquireAbortStatus.preview(False)
+		self.configForm.freezeForm(False)
+		self.imageWindow.previewMode(False)
+		self.appendToStatus("Live preview stopped.\n")
+
+	def toggleCounting(self):
+		if self.gFlagCounting:
+			self.stopCounting()
+		else:
+			self.startCounting()
+
+	# EMCCD photon counting
+	# Streams frames in run till abort mode and counts the photons in each one.
+	# The frames themselves are never saved, only the counts image when counting stops.
+	def startCounting(self):
+		(errf, errm) = self.AndorCamera.armiXon()
+		if errf:
+			self.throwErrorMessage("KRbiXon.armiXon error!", errm)
+			return -1
+		self.gCamInfo = self.AndorCamera.camInfo
+
+		self.gConfig = self.validateFormInput(self.configForm.getFormData(), KRBCAM_ACQ_MODE_RTA)
+		self.configForm.setFormData(self.gConfig)
+		if not self.gConfig['emEnable']:
+			self.throwErrorMessage("Photon counting needs EM gain.", "Turn on the EM gain and try again.")
+			return -1
+
+		(errf, errm) = self.AndorCamera.setupAcquisition(self.gConfig)
+		if errf:
+			self.throwErrorMessage("KRbiXon.setupAcquisition error!", errm)
+			return -2
+
+		(errf, errm) = self.AndorCamera.setupStreaming(self.gConfig)
+		if errf:
+			self.throwErrorMessage("KRbiXon.setupStreaming error!", errm)
+			return -2
+		self.appendToStatus(errm)
+
+		# The threshold from the last run is kept if the readout is the same
+		(dy, dx) = self.getImageShape()
+		self.photonCounter.select((calibrationKey(self.gConfig, self.gSetTemp), dy, dx))
+		self.photonCounter.reset()
+		self.gCountingCalibrationFrames = []
+
+		ret = self.AndorCamera.StartAcquisition()
+		msg = self.AndorCamera.handleErrors(ret, "StartAcquisition error: ", "")
+		if ret != self.AndorCamera.DRV_SUCCESS:
+			self.throwErrorMessage("Photon counting error!", msg)
+			return -3
+
+		self.gCountingShape = (dy, dx)
+		self.gFlagCounting = True
+
+		self.acquireAbortStatus.counting(True)
+		self.configForm.freezeForm(True)
+		self.imageWindow.previewMode(True)
+		self.appendToStatus("Photon counting started.\n")
+
+		self.countingCallback = self.reactor.callLater(KRBCAM_PC_TIMER, self.countingLoop)
+
+	# Pull all new frames off the camera and count them
+	def countingLoop(self):
+		(dy, dx) = self.gCountingShape
+		(errf, errm, n, data) = self.AndorCamera.getNewImages(dy * dx)
+		if errf:
+			self.stopCounting()
+			self.throwErrorMessage("Photon counting error!", errm)
+			return
+
+		if data is not None:
+			frames = np.reshape(np.ctypeslib.as_array(data), (n, dy, dx))
+
+			# The first frames of a run set the threshold, if there isn't one yet
+			if not self.photonCounter.isCalibrated():
+				self.gCountingCalibrationFrames.append(frames.copy())
+				if sum([len(f) for f in self.gCountingCalibrationFrames]) >= KRBCAM_PC_CALIBRATION_FRAMES:
+					self.photonCounter.calibrate(np.concatenate(self.gCountingCalibrationFrames))
+					self.gCountingCalibrationFrames = []
+					self.appendToStatus(self.photonCounter.describe() + "\n")
+			else:
+				self.photonCounter.addFrames(frames)
+				self.imageWindow.postData(self.getCountsFrameSet())
+				self.acquireAbortStatus.countingProgress(self.photonCounter.nFrames)
+
+		self.countingCallback = self.reactor.callLater(KRBCAM_PC_TIMER, self.countingLoop)
+
+	# The counts image as a frame set, for display and saving
+	def getCountsFrameSet(self):
+		(dy, dx) = self.gCountingShape
+		frameSet = KRbFrameSet(1, 1, dy, dx, self.gConfig['rotateImage'])
+		frameSet.addShot(self.photonCounter.image()[np.newaxis])
+		frameSet.metadata['config'] = deepcopy(self.gConfig)
+		frameSet.metadata['photonFrames'] = self.photonCounter.nFrames
+		return frameSet
+
+	# Stop photon counting and save the counts
+	def stopCounting(self):
+		try:
+			self.countingCallback.cancel()
+		except:
+			pass
+
+		ret = self.AndorCamera.AbortAcquisition()
+		if ret != self.AndorCamera.DRV_SUCCESS and ret != self.AndorCamera.DRV_IDLE:
+			self.throwErrorMessage("AbortAcquisition error!", "Error code: {}".format(ret))
+
+		self.gFlagCounting = False
+		self.acquireAbortStatus.counting(False)
+		self.configForm.freezeForm(False)
+		self.imageWindow.previewMode(False)
+
+		n = self.photonCounter.nFrames
+		self.appendToStatus("Photon counting stopped after {} frames.\n".format(n))
+		if n == 0:
+			return
+
+		self.configForm.checkDir()
+		self.gConfig = self.configForm.getFormData()
+		frameSet = self.getCountsFrameSet()
+		frameSet.metadata['fileNumber'] = self.gConfig['fileNumber']
+		frameSet.metadata['shotId'] = nextShotId()
+		frameSet.metadata['savePath'] = self.gConfig['savePath']
+		frameSet.metadata['saveFiles'] = self.gConfig['saveFiles']
+		if self.gConfig['saveFiles']:
+			self.saveData(frameSet)
+			self.appendToStatus("Photon counts saved.\n")
+		self.imageWindow.postData(frameSet)
+
+	# Get data from camera
+	# Returns an array with indices (kinetics frame, row, column)
+	# The kinetics frames are the fast kinetics frames or the frames of a kinetic series,
+	# Single scan and Accumulate give one frame
+	def getData(self):
+		# First need to get the total size of the image in binned pixels
+		(dy, dx) = self.getReadoutShape()
 		dataLength = self.gFKSeriesLength * dy * dx
 
 		# Now ask the camera for data
@@ -482,40 +938,385 @@ class MainWindow(QtGui.QWidget):
 			# Need to convert to numpy array
 			data = np.ctypeslib.as_array(data)
 
-			out = []
-
 			# Data is returned as one long array
-			# Need to split it up to get the individual images
-			num_images = self.gFKSeriesLength
-			image_length = len(data)/num_images
-			
-			# For each Fast Kinetics frame:
-			for i in range(num_images):
-				# Get the image and resize to the correct dimensions
-				image = np.resize(data[i*image_length : (i+1)*image_length], (dy, dx))
-				out.append(image)
-
-			return out
-
-	# Save data array
-	def saveData(self, data_array):
-		# The save path
-		path = self.gConfig['savePath'] + self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber'])
-		# Define a temporary path to avoid conflicts when writing file
-		# Otherwise, fitting program autoloads the file before writing is complete
-		path_temp = path + "_temp"
-		path += ".csv"
-		path_temp += ".csv"
-
-		np.savetxt(path_temp, data_array, fmt='%d', delimiter=',')
-
-		# Once file is written, rename to the correct filename
-		os.rename(path_temp, path)
+			# Reshaping it gives the individual images without copying
+			return np.reshape(data, (self.gFKSeriesLength, dy, dx))
+
+	# Everything that happens to a completed frame set after saving
+	# If fringe removal is on, it runs in a thread first, since it needs the
+	# reference light frames for the OD
+	def processFrameSet(self, frameSet):
+		# The full frames taken to find the cloud again would reset the fringe library
+		if not self.imageWindow.fringeRemovalEnabled() or frameSet.metadata.get('autoROIFull', False):
+			self.displayAndAnalyze(frameSet)
+			return
+
+		jobs = []
+		rois = self.imageWindow.getROIState()
+		for (setting, key, frames) in self.imageWindow.getSettingFrames(frameSet):
+			jobs.append((setting, key, frames, frameSet.cameraROI(frameSet.localROI(rois[setting]))))
+
+		d = deferToThread(self.removeFringes, jobs)
+		d.addCallback(self.fringesRemoved, frameSet)
+		d.addErrback(self.fringeRemovalFailed, frameSet)
+
+	# Runs in a thread
+	# Returns a dict of reference light frames keyed by frame selection
+	def removeFringes(self, jobs):
+		references = {}
+		for (setting, key, (shadow, light, dark), roi) in jobs:
+			references[key] = self.fringeRemovers[setting].process(shadow, light, dark, roi)
+		return references
+
+	def fringesRemoved(self, references, frameSet):
+		frameSet.metadata['references'] = references
+		self.displayAndAnalyze(frameSet)
+
+	# Still show the shot with the measured light frames
+	def fringeRemovalFailed(self, failure, frameSet):
+		self.appendToStatus("Fringe removal error: {}\n".format(failure.getErrorMessage()))
+		self.displayAndAnalyze(frameSet)
+
+	def displayAndAnalyze(self, frameSet):
+		# Hand the data to the display
+		# It gets drawn later, so a slow redraw doesn't hold up the next acquisition
+		self.imageWindow.postData(frameSet)
+
+		# Analyze the ROIs in the worker processes
+		self.analyzeData(frameSet)
+
+		odFrames = {}
+		for (setting, key, (shadow, light, dark)) in self.imageWindow.getSettingFrames(frameSet):
+			odFrames[setting] = (shadow, self.imageWindow.getLightFrame(frameSet, key, light), dark)
+
+		# Add to the running statistics
+		# The full frames taken to find the cloud again have a different size, and would reset them
+		if KRBCAM_STATS_ENABLE and not frameSet.metadata.get('autoROIFull', False):
+			d = deferToThread(self.updateStats, frameSet, odFrames)
+			d.addCallback(lambda ret: self.imageWindow.statsUpdated())
+			d.addErrback(lambda failure: self.appendToStatus("Statistics error: {}\n".format(failure.getErrorMessage())))
+
+		# Find the clouds for the automatic readout region
+		if self.acquireAbortStatus.autoROIEnabled():
+			d = deferToThread(self.locateClouds, frameSet, odFrames)
+			d.addCallback(lambda boxes: self.autoROI.addShot(boxes, frameSet.origin, frameSet.fullShape))
+			d.addErrback(lambda failure: self.appendToStatus("Auto ROI error: {}\n".format(failure.getErrorMessage())))
+
+	# Runs in a thread
+	# Returns the cloud bounding box for each setting, in camera orientation
+	def locateClouds(self, frameSet, odFrames):
+		boxes = []
+		for frames in odFrames.values():
+			od = krb_analysis.calcOD(*frames, accumulations=frameSet.metadata.get('accumulations', 1))
+			boxes.append(locateCloud(od))
+		return boxes
+
+	# Runs in a thread
+	# odFrames is a dict {setting: (shadow, light, dark)}
+	def updateStats(self, frameSet, odFrames):
+		ods = {}
+		for (setting, frames) in odFrames.items():
+			ods[setting] = krb_analysis.calcOD(*frames, accumulations=frameSet.metadata.get('accumulations', 1))
+		self.imageWindow.stats.update(frameSet, ods)
+
+	# Send a frame set off for ROI analysis
+	# The results come back in analysisComplete
+	def analyzeData(self, frameSet):
+		if not self.imageWindow.analysisEnabled():
+			return
+
+		settings = self.imageWindow.getAnalysisSettings(frameSet)
+		if settings:
+			fileNumber = frameSet.metadata['fileNumber']
+			metadata = frameSet.metadata
+			self.analysisPool.submit(lambda fileNumber, results: self.analysisComplete(fileNumber, results, metadata),
+				fileNumber, frameSet.rotate, settings)
+
+	# Show the analysis results and log them
+	# The log is a csv in the save directory of the shot, with one line per shot and setting
+	# metadata is the shot's, the settings may have changed since it was taken
+	# A log for the remote share is written in the spool and appended to the share's copy
+	def analysisComplete(self, fileNumber, results, metadata):
+		self.imageWindow.setAnalysisResults(fileNumber, results)
+
+		if not metadata.get('saveFiles', False):
+			return
+		if self.catalog is not None and metadata.has_key('catalogPath'):
+			self.catalog.addAnalysis(metadata['catalogPath'], fileNumber, results)
+
+		savePath = metadata['savePath']
+		folder = savePath
+		if self.replicator is not None and spoolDir(savePath) is not None:
+			folder = spoolDir(savePath)
+		path = os.path.join(folder, KRBCAM_ANALYSIS_LOG)
+		keys = ['N', 'peakOD', 'sumOD', 'xc', 'yc', 'sx', 'sy', 'sxy']
+		fitKeys = ['N', 'x0', 'y0', 'w x', 'w y', 'A', 'offset', 'fitTime']
+		try:
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			newFile = not os.path.isfile(path)
+			with open(path, 'a') as f:
+				if newFile:
+					header = ["fileNumber", "setting"] + keys + ["fitModel"] + ["fit " + k for k in fitKeys]
+					f.write(",".join(header) + "\n")
+				for r in results:
+					if r.has_key('error'):
+						continue
+					values = [str(fileNumber), str(r['setting'])] + ["{:.6g}".format(r[k]) for k in keys]
+
+					# Fit results, if any
+					fit = r.get('fit', None)
+					if fit is None or fit['error'] is not None:
+						values += ["None"] + ["nan"]*len(fitKeys)
+					else:
+						p = fit['params']
+						fitValues = [fit['N'], p[1], p[2], p[3], p[4], p[0], p[5], fit['fitTime']]
+						values += [fit['model']] + ["{:.6g}".format(v) for v in fitValues]
+					f.write(",".join(values) + "\n")
+			if folder != savePath:
+				self.replicator.add(path, os.path.join(savePath, KRBCAM_ANALYSIS_LOG), True)
+		except (IOError, OSError) as e:
+			self.appendToStatus("Error writing analysis log: {}\n".format(e))
+
+	# Save the frame set
+	# As a csv file, a compressed file and/or in the daily frame archive
+	# Files for the remote share are written to the local spool,
+	# and copied there by the replicator
+	def saveData(self, frameSet):
+		savePath = self.gConfig['savePath']
+		folder = savePath
+		if self.replicator is not None and spoolDir(savePath) is not None:
+			folder = spoolDir(savePath)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+
+		# Only the region around the clouds, except for the full frame keyframes
+		# The origin of the region goes in the metadata of the binary formats
+		shot = frameSet
+		if self.acquireAbortStatus.saveROIOnly():
+			box = self.saveRegion(frameSet)
+			if box is not None:
+				shot = frameSet.crop(box)
+				if self.gFlagVerbose:
+					self.appendToStatus("Saving x, y, dx, dy = {} ({:.0f}% of the frame).\n".format(box,
+						100.0 * shot.frames.size / frameSet.frames.size))
+			shot.metadata['keyframe'] = box is None
+		else:
+			self.gShotsSinceKeyframe = None
+
+		if KRBCAM_SAVE_CSV:
+			# The save path
+			name = self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber'])
+			path = folder + name
+			# Define a temporary path to avoid conflicts when writing file
+			# Otherwise, fitting program autoloads the file before writing is complete
+			path_temp = path + "_temp"
+			path += ".csv"
+			path_temp += ".csv"
+
+			with open(path_temp, 'w') as f:
+				shot.writeCSV(f)
+
+			# Once file is written, rename to the correct filename
+			os.rename(path_temp, path)
+			if folder != savePath:
+				self.replicator.add(path, savePath + name + ".csv")
+
+			# The csv of a region doesn't say where it goes on the full frame
+			if shot is not frameSet:
+				regionPath = folder + name + KRBCAM_REGION_SUFFIX
+				with open(regionPath, 'w') as f:
+					json.dump(shot.regionInfo(), f)
+				if folder != savePath:
+					self.replicator.add(regionPath, savePath + name + KRBCAM_REGION_SUFFIX)
+
+		if KRBCAM_SAVE_COMPRESSED:
+			name = self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber']) + KRBCAM_COMPRESSED_EXT
+			try:
+				(nBytes, seconds) = writeShot(folder + name, shot.frames, self.saveMetadata(shot))
+				if self.gFlagVerbose:
+					self.appendToStatus("Compressed to {:.2f} MB in {:.0f} ms.\n".format(nBytes / 2.0**20, seconds * 1e3))
+				if folder != savePath:
+					self.replicator.add(folder + name, savePath + name)
+			except (IOError, OSError) as e:
+				self.appendToStatus("Compressed shot not saved: {}\n".format(e))
+
+		if KRBCAM_SAVE_ARCHIVE:
+			path = self.archiveData(shot, folder)
+			frameSet.metadata['archivePath'] = path
+			if folder != savePath:
+				# The index only points to complete shots, so the data goes first
+				dst = archivePath(savePath, self.gConfig['filebase'])
+				self.replicator.add(path, dst, True)
+				self.replicator.add(indexPath(path), indexPath(dst), True)
+
+		if self.catalog is not None:
+			# Where the shot ends up, the csv file if there is one
+			if KRBCAM_SAVE_CSV:
+				path = savePath + self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber']) + ".csv"
+			elif KRBCAM_SAVE_COMPRESSED:
+				path = savePath + self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber']) + KRBCAM_COMPRESSED_EXT
+			else:
+				path = archivePath(savePath, self.gConfig['filebase'])
+			# The region is None for a full frame
+			region = None
+			if shot is not frameSet:
+				region = shot.regionInfo()['region']
+			# Settings the frames were taken with, a series recovered from the journal
+			# may have been taken with other settings than the current ones
+			meta = frameSet.metadata
+			self.catalog.addShot(path, self.gConfig['fileNumber'], meta.get('config', self.gConfig),
+				meta.get('timings', self.AndorCamera.timings), meta.get('temperature', self.gCurrentTemp),
+				shot.frames, region=region)
+			frameSet.metadata['catalogPath'] = path
+
+		if self.thumbnailer is not None:
+			# Previews of the whole frame, even if only the ROIs were saved
+			name = folder + KRBCAM_THUMB_FOLDER + self.gConfig['filebase'] + '_' + str(self.gConfig['fileNumber'])
+			odFrames = [frames for (setting, key, frames) in self.imageWindow.getSettingFrames(frameSet)]
+			self.thumbnailer.add(frameSet.metadata['shotId'], (name + ".png", name + "_frames.png"), odFrames,
+				frameSet.frames, frameSet.rotate, self.imageWindow.colormapLUT(), frameSet.metadata.get('accumulations', 1))
+
+	# Previews of a shot were written, called from the thumbnailer's thread
+	# Spooled previews are copied to the data share like the shot
+	def thumbnailsDone(self, shotId, paths, error):
+		if error is not None:
+			self.appendToStatus("Preview error, {}\n".format(error))
+		if self.replicator is not None:
+			for path in paths:
+				dst = remotePath(path)
+				if dst is not None:
+					self.replicator.add(path, dst)
+		if paths:
+			self.imageWindow.thumbnailReady(shotId, paths[0])
+
+	# Region of a frame set to save when saving ROIs only, [x, y, dx, dy] in camera orientation
+	# The union of the recent clouds if the auto ROI is following them, otherwise of the
+	# analysis ROIs, plus some padding. None for a full frame, which is saved every
+	# KRBCAM_SAVE_KEYFRAME_EVERY shots and when there are no ROIs
+	def saveRegion(self, frameSet):
+		if self.gShotsSinceKeyframe is None or self.gShotsSinceKeyframe >= KRBCAM_SAVE_KEYFRAME_EVERY - 1:
+			self.gShotsSinceKeyframe = 0
+			return None
+		self.gShotsSinceKeyframe += 1
+
+		boxes = []
+		if self.acquireAbortStatus.autoROIEnabled() and not self.autoROI.lost and self.autoROI.fullShape == frameSet.fullShape:
+			(ox, oy) = frameSet.origin
+			boxes = [[x0 - ox, y0 - oy, x1 - x0, y1 - y0] for (x0, y0, x1, y1) in self.autoROI.boxes]
+		if not boxes:
+			rois = self.imageWindow.getROIState()
+			boxes = [frameSet.cameraROI(frameSet.localROI(rois[setting])) for (setting, key, frames) in self.imageWindow.getSettingFrames(frameSet)]
+		if not boxes:
+			return None
+
+		(height, width) = np.shape(frameSet.frames)[2:]
+		pad = KRBCAM_SAVE_ROI_PADDING
+		x0 = max(min([b[0] for b in boxes]) - pad, 0)
+		y0 = max(min([b[1] for b in boxes]) - pad, 0)
+		x1 = min(max([b[0] + b[2] for b in boxes]) + pad, width)
+		y1 = min(max([b[1] + b[3] for b in boxes]) + pad, height)
+		if x1 <= x0 or y1 <= y0 or (x1 - x0) * (y1 - y0) >= width * height:
+			return None
+		return [x0, y0, x1 - x0, y1 - y0]
+
+	# Append an acquisition to the raw frame journal, if the series will be saved
+	def journalData(self, frameSet, images):
+		if self.journal is None or not self.gConfig['saveFiles']:
+			return
+		try:
+			if not self.journal.append(frameSet, frameSet.nAcquired, images):
+				self.appendToStatus("Raw frame journal is full of unsaved series, not journaled.\n")
+		except (IOError, OSError) as e:
+			self.appendToStatus("Raw frame journal error: {}\n".format(e))
+
+	# Save the series left pending in the journal, e.g. by a crash before saveData
+	# They get the next file numbers in the current save folder
+	def replayJournal(self):
+		if self.journal is None:
+			return
+		pending = self.journal.pending()
+		if not pending:
+			return
+
+		self.appendToStatus("Recovering {} unsaved series from the raw frame journal.\n".format(len(pending)))
+		for series in pending:
+			try:
+				(frameSet, n) = self.journal.frameSet(series)
+				self.configForm.checkDir()
+				self.gConfig = self.configForm.getFormData()
+				frameSet.metadata['fileNumber'] = self.gConfig['fileNumber']
+				frameSet.metadata['shotId'] = nextShotId()
+				frameSet.metadata['savePath'] = self.gConfig['savePath']
+				frameSet.metadata['recovered'] = True
+				self.saveData(frameSet)
+				self.journal.finish(series)
+				self.appendToStatus("Saved {} of {} acquisitions as file {}.\n".format(n, frameSet.acqLength, frameSet.metadata['fileNumber']))
+			except (IOError, OSError, ValueError, KeyError) as e:
+				self.appendToStatus("Could not recover series {}: {}\n".format(series, e))
+
+	# Metadata saved with the frames in the binary formats
+	def saveMetadata(self, frameSet):
+		meta = dict(frameSet.metadata)
+		meta['origin'] = frameSet.origin
+		meta['fullShape'] = frameSet.fullShape
+		meta['rotate'] = frameSet.rotate
+		meta['regionRows'] = frameSet.regionRows
+		meta['setTemp'] = self.gSetTemp
+		return meta
+
+	# Append the frame set to the archive in the save folder
+	# A new archive is started when the folder changes, e.g. at midnight
+	# Returns the path of the archive
+	def archiveData(self, frameSet, folder):
+		path = archivePath(folder, self.gConfig['filebase'])
+		if self.archiveWriter is None or self.archiveWriter.path != path:
+			if self.archiveWriter is not None:
+				self.archiveWriter.close()
+			self.archiveWriter = KRbArchiveWriter(path)
+
+		self.archiveWriter.append(frameSet.frames, self.gConfig['fileNumber'], self.saveMetadata(frameSet))
+		return path
+
+	# Copy spooled files to the remote share
+	# The copying runs in a thread, one batch at a time
+	def replicationLoop(self):
+		if not self.gFlagReplicating and self.replicator.due():
+			self.gFlagReplicating = True
+			d = deferToThread(self.replicator.work)
+			d.addErrback(lambda failure: self.appendToStatus("Replication error: {}\n".format(failure.getErrorMessage())))
+			d.addBoth(self.replicationDone)
+		self.acquireAbortStatus.replicationStatus.setText(self.replicator.describe())
+		self.replicationCallback = self.reactor.callLater(KRBCAM_REPLICATE_TIMER, self.replicationLoop)
+
+	def replicationDone(self, ret):
+		self.gFlagReplicating = False
+		error = self.replicator.lastError
+		if error is not None and error != self.gReplicationError:
+			self.appendToStatus("Copy to the data share failed, will retry. {}\n".format(error))
+		self.gReplicationError = error
+
+	# Write the queued shots to the catalog
+	# One transaction per batch, in a thread
+	def catalogLoop(self):
+		if not self.gFlagCataloging and self.catalog.pending():
+			self.gFlagCataloging = True
+			d = deferToThread(self.catalog.flush)
+			d.addErrback(lambda failure: self.appendToStatus("Catalog error: {}\n".format(failure.getErrorMessage())))
+			d.addBoth(self.catalogDone)
+		self.catalogCallback = self.reactor.callLater(KRBCAM_CATALOG_TIMER, self.catalogLoop)
+
+	def catalogDone(self, ret):
+		self.gFlagCataloging = False
 
 	# Abort an acquisition
 	def abortAcquisition(self):
 		# First, stop camera acquisition
 		ret = self.AndorCamera.AbortAcquisition()
+
+		# The series won't be saved, so there is nothing to recover
+		if self.journal is not None:
+			self.journal.discard()
 		if ret == self.AndorCamera.DRV_SUCCESS:
 			self.appendToStatus("Camera acquisition aborted successfully.\n")
 		elif ret != self.AndorCamera.DRV_IDLE:
@@ -560,7 +1361,11 @@ class MainWindow(QtGui.QWidget):
 		self.setLayout(self.layout)
 
 	# Validate the configuration form input vs the camera data
-	def validateFormInput(self, form):
+	# acqMode defaults to the current acquisition mode
+	def validateFormInput(self, form, acqMode=None):
+		if acqMode is None:
+			acqMode = self.gAcqMode
+
 		fk = form['kinFrames']
 
 		# validate against camera info
@@ -570,12 +1375,42 @@ class MainWindow(QtGui.QWidget):
 		# If in Fast kinetics mode,
 		# the number of rows should be either the number of exposed rows
 		# or at most the size of the device / number of shots in FK series
-		if self.gAcqMode == KRBCAM_ACQ_MODE_FK:
+		if acqMode == KRBCAM_ACQ_MODE_FK:
 			if KRBCAM_EXPOSED_ROWS < self.gCamInfo['detDim'][1] / fk:
 				y_limit = KRBCAM_EXPOSED_ROWS
 			else:
 				y_limit = self.gCamInfo['detDim'][1] / fk
 
+		# Several row regions can be read in the modes that don't use Fast Kinetics or Run till abort
+		# They are kept on the CCD, aligned to the bin size, sorted and merged where they overlap
+		# The Y offset and dy are set to the band they span
+		regions = []
+		if acqMode in [KRBCAM_ACQ_MODE_SINGLE, KRBCAM_ACQ_MODE_ACCUMULATE, KRBCAM_ACQ_MODE_KINETICS]:
+			if form['binning']:
+				binning = KRBCAM_BIN_SIZE
+			else:
+				binning = 1
+			for (y, dy) in sorted(readoutRegions(form)):
+				y = min(max(y, 0), y_limit)
+				dy = min(dy, y_limit - y)
+				if regions:
+					# Binned rows have to line up with those of the first region
+					shift = (y - regions[0][0]) % binning
+					(y, dy) = (y - shift, dy + shift)
+				dy -= dy % binning
+				if dy <= 0:
+					continue
+				if regions and y <= regions[-1][0] + regions[-1][1]:
+					regions[-1][1] = max(regions[-1][1], y + dy - regions[-1][0])
+				else:
+					regions.append([y, dy])
+		if regions:
+			form['yOffset'] = regions[0][0]
+			form['dy'] = regions[-1][0] + regions[-1][1] - regions[0][0]
+		if len(regions) < 2:
+			regions = []
+		form['regions'] = regions
+
 		# Keep the x/y offsets within the bounds of the CCD array
 		if form['xOffset'] > x_limit:
 			form['xOffset'] = x_limit - 1
@@ -607,9 +1442,16 @@ class MainWindow(QtGui.QWidget):
 
 		# If in Fast Kinetics mode, the width of the image should be
 		# the entire width of the CCD arrray
-		if self.gAcqMode == 4:
+		if acqMode == KRBCAM_ACQ_MODE_FK:
 			form['dx'] = self.gCamInfo['detDim'][0]
 
+		# Single scan and Accumulate read out one image per acquisition
+		if acqMode in [KRBCAM_ACQ_MODE_SINGLE, KRBCAM_ACQ_MODE_ACCUMULATE]:
+			form['kinFrames'] = 1
+		if acqMode == KRBCAM_ACQ_MODE_KINETICS:
+			form['kinFrames'] = min(max(form['kinFrames'], 1), KRBCAM_MAX_KINETIC_FRAMES)
+		form['nAcc'] = min(max(int(form.get('nAcc', KRBCAM_N_ACC)), 1), KRBCAM_MAX_ACC)
+
 		return form
 
 	def throwErrorMessage(self, header, msg):
@@ -638,6 +1480,16 @@ class MainWindow(QtGui.QWidget):
 			self.acquireCallback.cancel()
 		except:
 			pass
+		# Try to stop the live preview
+		try:
+			self.previewCallback.cancel()
+		except:
+			pass
+		# Try to stop photon counting
+		try:
+			self.countingCallback.cancel()
+		except:
+			pass
 		# Next, kill the checkTemp callback
 		try:
 			self.tempCallback.cancel()
@@ -693,6 +1545,32 @@ class MainWindow(QtGui.QWidget):
 					flag = True
 
 		if flag:
+			# Stop copying spooled files, the rest are copied at the next start
+			try:
+				self.replicationCallback.cancel()
+			except:
+				pass
+			# Stop the catalog loop and write what is left
+			try:
+				self.catalogCallback.cancel()
+			except:
+				pass
+			if self.catalog is not None and not self.gFlagCataloging:
+				try:
+					self.catalog.flush()
+				except Exception as e:
+					print "Catalog error: {}".format(e)
+			# Close the raw frame journal, anything not saved yet is saved at the next start
+			if self.journal is not None:
+				self.journal.close()
+				self.journal = None
+			# Stop making previews
+			if self.thumbnailer is not None:
+				self.thumbnailer.stop()
+			# Close the frame archive
+			if self.archiveWriter is not None:
+				self.archiveWriter.close()
+				self.archiveWriter = None
 			self.coolerOff()
 			self.tryToCloseNicely()
 			event.accept()
@@ -706,6 +1584,11 @@ class MainWindow(QtGui.QWidget):
 			del(self.AndorCamera)
 		except: pass
 
+		# Stop the analysis worker processes
+		try:
+			self.analysisPool.close()
+		except: pass
+
 		# Try to end the acquisition loop
 		try:
 			self.acquireCallback.cancel()
@@ -0,0 +1,284 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+import datetime
+import multiprocessing
+
+import numpy as np
+
+sys.path.append("./lib/")
+
+from andor_helpers import *
+from krb_reader import parseCSV, csvLayout, csvFrames
+from krb_archive import KRbArchiveWriter, KRbArchive, archivePath, indexPath, archiveFrames
+from krb_catalog import KRbCatalog
+
+# Convert the shot csv files of the dated save folders to frame archives
+#
+# Each folder/file base pair (e.g. 2019\01\20190101\Andor\, "iXon") becomes one
+# archive, like the ones saveData writes, converted by one worker process.
+# Run from this folder, like andor_gui.py, e.g.
+#	python krb_convert.py \\server\krbdata\data\ --start 20190101 --end 20191231
+#
+# Converting can be stopped and started again: shots already in an archive are
+# skipped, and folders that were fully converted are listed in KRBCAM_CONVERT_LOG
+# in the destination. Each shot keeps the crc32 of its csv file and of its frames
+# in its metadata, and the frames are checked against it once the folder is done.
+#
+# An archive can only have one writer. Today's folders, and archives written to in
+# the last KRBCAM_CONVERT_IDLE, may still be in use by the GUI (or the copy to the
+# data share), so they are left for a later run.
+
+CSV_NAME = re.compile(r'^(.*)_(\d+)\.csv$')
+DATE_FOLDER = re.compile(r'^\d{8}$')
+
+def crc(data):
+	return zlib.crc32(data) & 0xffffffff
+
+# Path of a shot from its dated folder on, for matching shots in different places
+# e.g. \\server\krbdata\data\2019\01\20190101\Andor\iXon_5.csv -> 20190101/andor/ixon_5.csv
+def shotKey(path):
+	parts = re.split(r'[\\/]+', os.path.normcase(path))
+	dates = [i for (i, p) in enumerate(parts) if DATE_FOLDER.match(p)]
+	if dates:
+		parts = parts[dates[-1]:]
+	return '/'.join(parts).lower()
+
+# The dated folder a folder is in, None if it isn't in one
+def folderDate(folder):
+	dates = [p for p in re.split(r'[\\/]+', folder) if DATE_FOLDER.match(p)]
+	if dates:
+		return dates[-1]
+	return None
+
+# Groups of shot csv files to convert
+# Returns [(folder, filebase, [(fileNumber, csv path), ...]), ...]
+def findShots(src, start=None, end=None):
+	groups = []
+	for (folder, dirs, files) in os.walk(src):
+		dirs.sort()
+		date = folderDate(folder)
+		if date is None or (start is not None and date < start) or (end is not None and date > end):
+			continue
+
+		shots = {}
+		for name in files:
+			m = CSV_NAME.match(name)
+			if m is None:
+				continue
+			shots.setdefault(m.group(1), []).append((int(m.group(2)), os.path.join(folder, name)))
+		for filebase in sorted(shots.keys()):
+			groups.append((folder, filebase, sorted(shots[filebase])))
+	return groups
+
+# Could the GUI still be writing to this archive?
+def archiveLive(path, today):
+	if folderDate(os.path.dirname(path)) == today:
+		return True
+	index = indexPath(path)
+	return os.path.isfile(index) and time.time() - os.path.getmtime(index) < KRBCAM_CONVERT_IDLE
+
+# Layout and time of cataloged shots, by shotKey
+def catalogShots(path):
+	if path is None or not os.path.isfile(path):
+		return {}
+	rows = KRbCatalog(path).query("SELECT path, timestamp, config FROM shots WHERE path LIKE '%.csv'")
+	return dict([(shotKey(row['path']), (row['timestamp'], json.loads(row['config']))) for row in rows])
+
+# Where the images of a csv go on the full region, from the KRBCAM_REGION_SUFFIX file
+# saveData writes next to the csv of a saved region (see KRbFrameSet.regionInfo)
+# None for a full frame csv
+def readRegion(csvPath):
+	path = csvPath[:-len(".csv")] + KRBCAM_REGION_SUFFIX
+	if not os.path.isfile(path):
+		return None
+	with open(path, 'r') as f:
+		return json.load(f)
+
+# Put the rows of a multi-region readout back in their place in the full frames,
+# the csv only has the rows that were read. frames are in camera orientation.
+def expandRows(frames, rows, height):
+	if rows is None:
+		return frames
+	if len(rows) != np.shape(frames)[2]:
+		raise ValueError("{} rows don't match the {} rows of the readout regions".format(np.shape(frames)[2], len(rows)))
+	full = np.zeros(np.shape(frames)[:2] + (height, np.shape(frames)[3]), dtype=frames.dtype)
+	full[:, :, rows, :] = frames
+	return full
+
+# Convert one folder/file base to an archive
+# Runs in a worker process, returns a summary of what was done
+def convertGroup(args):
+	(folder, filebase, shots, destFolder, cataloged, layout) = args
+	summary = {'folder': folder, 'filebase': filebase, 'shots': len(shots),
+		'converted': 0, 'skipped': 0, 'guessed': 0, 'bytes': 0, 'errors': []}
+
+	if not os.path.isdir(destFolder):
+		os.makedirs(destFolder)
+	path = archivePath(destFolder, filebase)
+	writer = KRbArchiveWriter(path)
+	try:
+		# Already converted, from an earlier run
+		done = set()
+		if len(writer):
+			done = set(KRbArchive(path).fileNumbers().tolist())
+
+		# Oldest first, so the archive is in time order
+		todo = []
+		for (fileNumber, csvPath) in shots:
+			if fileNumber in done:
+				summary['skipped'] += 1
+				continue
+			(timestamp, config) = cataloged.get(shotKey(csvPath), (None, None))
+			if timestamp is None:
+				timestamp = os.path.getmtime(csvPath)
+			todo.append((timestamp, fileNumber, csvPath, config))
+		todo.sort()
+
+		checks = []
+		for (timestamp, fileNumber, csvPath, config) in todo:
+			try:
+				with open(csvPath, 'rb') as f:
+					data = f.read()
+				values = parseCSV(data)
+				(shape, guessed) = csvLayout(np.shape(values), config, *layout)
+				frames = csvFrames(values, shape)
+
+				# Back to camera orientation, the csv images are in display orientation
+				# (rotated 90 degrees clockwise from the camera)
+				rotate = config is not None and bool(config.get('rotateImage', False))
+				if rotate:
+					frames = frames.swapaxes(2, 3)[:, :, ::-1, :]
+
+				# A saved region, with its place on the full region, like the shots saveData archives
+				region = readRegion(csvPath)
+				extra = {}
+				if region is not None:
+					(x, y, width, height) = region['region']
+					fullShape = region['fullShape']
+					rows = region.get('regionRows')
+					if rotate:
+						extra['origin'] = [y, fullShape[1] - width - x]
+						extra['fullShape'] = fullShape[::-1]
+						height = width
+					else:
+						extra['origin'] = [x, y]
+						extra['fullShape'] = fullShape
+					extra['region'] = region['region']
+				elif config is not None:
+					rows = regionRows(config)
+					height = int(config['dy'])
+					if config['binning']:
+						height /= KRBCAM_BIN_SIZE
+				else:
+					(rows, height) = (None, None)
+				frames = expandRows(frames, rows, height)
+				if rows is not None:
+					extra['regionRows'] = rows
+
+				stored = archiveFrames(frames)
+				meta = {
+					'fileNumber': fileNumber,
+					'source': csvPath,
+					'rotate': rotate,
+					'csvCRC': crc(data),
+					'framesCRC': crc(stored.tostring()),
+					'layoutGuessed': guessed
+				}
+				meta.update(extra)
+				if config is not None:
+					meta['config'] = config
+				writer.append(stored, fileNumber, meta, timestamp)
+				checks.append((fileNumber, meta['framesCRC']))
+
+				summary['converted'] += 1
+				summary['guessed'] += int(guessed)
+				summary['bytes'] += len(data)
+			except (IOError, ValueError) as e:
+				summary['errors'].append("{}: {}".format(csvPath, e))
+	finally:
+		writer.close()
+
+	# Read back what was written
+	archive = KRbArchive(path)
+	for (fileNumber, framesCRC) in checks:
+		i = archive.find(fileNumber)
+		if i is None or crc(archive.frames(i).tostring()) != framesCRC:
+			summary['errors'].append("{}: shot {} doesn't match its checksum".format(path, fileNumber))
+	return summary
+
+# Folders already converted: (folder, filebase): number of csv files
+def readLog(path):
+	done = {}
+	if os.path.isfile(path):
+		with open(path, 'r') as f:
+			for line in f:
+				fields = line.rstrip('\n').split('\t')
+				if len(fields) == 3:
+					done[(fields[0], fields[1])] = int(fields[2])
+	return done
+
+def main():
+	parser = argparse.ArgumentParser(description="Convert shot csv files to frame archives")
+	parser.add_argument('src', nargs='?', default=KRBCAM_DEFAULT_SAVE_PATH, help="Top of the dated save folders")
+	parser.add_argument('--dest', default=None, help="Where to put the archives, in the same folders as in src (default: next to the csv files)")
+	parser.add_argument('--start', default=None, help="First day to convert, YYYYMMDD")
+	parser.add_argument('--end', default=None, help="Last day to convert, YYYYMMDD")
+	parser.add_argument('--processes', type=int, default=KRBCAM_ANALYSIS_PROCESSES, help="Worker processes")
+	parser.add_argument('--acqLength', type=int, default=None, help="Acquisitions per shot, for shots that aren't in the catalog")
+	parser.add_argument('--kinFrames', type=int, default=None, help="Kinetics frames per shot, for shots that aren't in the catalog")
+	parser.add_argument('--catalog', default=KRBCAM_CATALOG_PATH, help="Shot catalog with the configs of the shots")
+	args = parser.parse_args()
+
+	dest = args.dest if args.dest is not None else args.src
+	logPath = os.path.join(dest, KRBCAM_CONVERT_LOG)
+	done = readLog(logPath)
+	cataloged = catalogShots(args.catalog)
+
+	today = datetime.date.today().strftime('%Y%m%d')
+	jobs = []
+	for (folder, filebase, shots) in findShots(args.src, args.start, args.end):
+		if done.get((folder, filebase)) == len(shots):
+			continue
+		destFolder = os.path.join(dest, os.path.relpath(folder, args.src), '')
+		if archiveLive(archivePath(destFolder, filebase), today):
+			print "{}: may still be in use, skipped".format(os.path.join(folder, filebase))
+			continue
+		shotCatalog = dict([(shotKey(p), cataloged[shotKey(p)]) for (n, p) in shots if shotKey(p) in cataloged])
+		jobs.append((folder, filebase, shots, destFolder, shotCatalog, (args.acqLength, args.kinFrames)))
+
+	nShots = sum([len(job[2]) for job in jobs])
+	print "{} folders, {} shots to convert".format(len(jobs), nShots)
+
+	t0 = time.time()
+	nBytes = 0
+	nConverted = 0
+	pool = multiprocessing.Pool(args.processes)
+	try:
+		for summary in pool.imap_unordered(convertGroup, jobs):
+			nBytes += summary['bytes']
+			nConverted += summary['converted']
+			for error in summary['errors']:
+				print "    " + error
+			print "{}: {} converted, {} already done, {} guessed layouts, {} errors".format(
+				os.path.join(summary['folder'], summary['filebase']), summary['converted'], summary['skipped'],
+				summary['guessed'], len(summary['errors']))
+
+			# Only fully converted folders are skipped next time
+			if not summary['errors']:
+				with open(logPath, 'a') as f:
+					f.write("{}\t{}\t{}\n".format(summary['folder'], summary['filebase'], summary['shots']))
+	finally:
+		pool.close()
+		pool.join()
+
+	seconds = time.time() - t0
+	print "{} shots, {:.1f} MB of csv in {:.0f} s ({:.1f} MB/s)".format(nConverted, nBytes / 2.0**20, seconds,
+		nBytes / 2.0**20 / max(seconds, 1e-3))
+
+if __name__ == "__main__":
+	main()
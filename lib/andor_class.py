@@ -28,6 +28,9 @@ class KRbiXon(atmcd.atmcd):
 	}
 	errorFlag = 0
 
+	# Real timings (s) of the last acquisition set up
+	timings = {}
+
 	def __init__(self):
 		super(KRbiXon, self).__init__()
 
@@ -424,6 +427,7 @@ class KRbiXon(atmcd.atmcd):
 		(ret, readout) = self.GetReadOutTime()
 		successMsg = "Readout time is {:.3} ms.\n".format(readout * 1.0e3)
 		msg += self.handleErrors(ret, "GetReadoutTime error: ", successMsg)
+		self.timings = {'exposure': realExp, 'accumulate': realAcc, 'kinetic': realKin, 'keepClean': keepclean, 'readout': readout}
 
 		return (self.errorFlag, msg)
 
@@ -443,33 +447,257 @@ class KRbiXon(atmcd.atmcd):
 	
 		# Set the exposure time
 		exposure = config['expTime'] * 1e-3
+		ret = self.SetExposureTime(exposure)
+		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
+
+		# Set the image bounds
+		msg += self.setReadoutRegions(config)
+
+		# Get the acquisition, keep clean and readout times
+		msg += self.getTimings()
+
+		return (self.errorFlag, msg)
+
+	# Setup accumulate mode
+	# Each acquisition is nAcc exposures, which the SDK sums into a single image
+	# before we read it out, so only one image per acquisition is transferred
+	def setupAccumulate(self, config):
+		self.errorFlag = 0
+		msg = ""
+
+		ret = self.SetAcquisitionMode(KRBCAM_ACQ_MODE_ACCUMULATE)
+		successMsg = "Acquisition mode set to " + acq_modes[str(KRBCAM_ACQ_MODE_ACCUMULATE)] + ".\n"
+		msg += self.handleErrors(ret, "SetAcquisitionMode error: ", successMsg)
+
+		ret = self.SetVSSpeed(config['vss'])
+		successMsg = "Vertical shift speed set to {}.\n".format(config['vss'])
+		msg += self.handleErrors(ret, "SetVSSpeed error: ", successMsg)
+
+		ret = self.SetExposureTime(config['expTime'] * 1e-3)
+		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
+
+		msg += self.setAccumulations(config)
+		msg += self.setReadoutRegions(config)
+		msg += self.getTimings()
+
+		return (self.errorFlag, msg)
+
+	# Setup kinetic series mode
+	# kinFrames full images (each a sum of nAcc exposures) are taken before the series is read out
+	def setupKineticSeries(self, config):
+		self.errorFlag = 0
+		msg = ""
+
+		ret = self.SetAcquisitionMode(KRBCAM_ACQ_MODE_KINETICS)
+		successMsg = "Acquisition mode set to " + acq_modes[str(KRBCAM_ACQ_MODE_KINETICS)] + ".\n"
+		msg += self.handleErrors(ret, "SetAcquisitionMode error: ", successMsg)
+
+		ret = self.SetVSSpeed(config['vss'])
+		successMsg = "Vertical shift speed set to {}.\n".format(config['vss'])
+		msg += self.handleErrors(ret, "SetVSSpeed error: ", successMsg)
+
+		ret = self.SetExposureTime(config['expTime'] * 1e-3)
+		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
+
+		msg += self.setAccumulations(config)
+
+		# Frames are taken as fast as possible, or as triggered
+		ret = self.SetNumberKinetics(config['kinFrames'])
+		successMsg = "Kinetic series length set to {}.\n".format(config['kinFrames'])
+		msg += self.handleErrors(ret, "SetNumberKinetics error: ", successMsg)
+		ret = self.SetKineticCycleTime(0)
+		msg += self.handleErrors(ret, "SetKineticCycleTime error: ", "")
+
+		msg += self.setReadoutRegions(config)
+		msg += self.getTimings()
+
+		return (self.errorFlag, msg)
+
+	# Number of accumulations, taken as fast as possible, or as triggered
+	def setAccumulations(self, config):
+		msg = ""
+		ret = self.SetNumberAccumulations(config['nAcc'])
+		successMsg = "Number of accumulations set to {}.\n".format(config['nAcc'])
+		msg += self.handleErrors(ret, "SetNumberAccumulations error: ", successMsg)
+		ret = self.SetAccumulationCycleTime(0)
+		msg += self.handleErrors(ret, "SetAccumulationCycleTime error: ", "")
+		return msg
+
+	# Image read mode bounds and binning from the config
+	def setImageBounds(self, config):
 		if config['binning']:
 			binning = KRBCAM_BIN_SIZE
 		else:
 			binning = 1
-		ret = self.SetExposureTime(exposure)
-		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
-
 		hstart = config['xOffset'] + 1
 		hend = config['xOffset'] + config['dx']
 		vstart = config['yOffset'] + 1
 		vend = config['yOffset'] + config['dy']
 		ret = self.SetImage(binning, binning, hstart, hend, vstart, vend)
-		msg += self.handleErrors(ret, "SetImage error: ", "Image bounds set.\n")
+		return self.handleErrors(ret, "SetImage error: ", "Image bounds set.\n")
 
-		# Get the Acquisition timings
+	# Image bounds, or the row regions of a multi-region readout
+	# The regions are read in Random-Track mode with one track per (binned) row, so each
+	# track is a row of the image and the rows between the regions are never digitized
+	def setReadoutRegions(self, config):
+		regions = readoutRegions(config)
+		if not regions:
+			return self.setImageBounds(config)
+
+		msg = ""
+		if config['binning']:
+			binning = KRBCAM_BIN_SIZE
+		else:
+			binning = 1
+
+		ret = self.SetReadMode(KRBCAM_READ_MODE_RANDOM_TRACK)
+		successMsg = "Read mode set to " + read_modes[str(KRBCAM_READ_MODE_RANDOM_TRACK)] + ".\n"
+		msg += self.handleErrors(ret, "SetReadMode error: ", successMsg)
+
+		ret = self.SetCustomTrackHBin(binning)
+		msg += self.handleErrors(ret, "SetCustomTrackHBin error: ", "")
+
+		ret = self.SetMultiTrackHRange(config['xOffset'] + 1, config['xOffset'] + config['dx'])
+		msg += self.handleErrors(ret, "SetMultiTrackHRange error: ", "")
+
+		# Tracks are [start, end] pairs of CCD rows, counted from 1
+		areas = []
+		for (y, dy) in regions:
+			for start in range(y + 1, y + dy + 1, binning):
+				areas += [start, start + binning - 1]
+		ret = self.SetRandomTracks(len(areas) / 2, areas)
+		successMsg = "{} row regions set ({} tracks).\n".format(len(regions), len(areas) / 2)
+		msg += self.handleErrors(ret, "SetRandomTracks error: ", successMsg)
+		return msg
+
+	# Acquisition, keep clean and readout times as a status message
+	def getTimings(self):
+		msg = ""
 		(ret, realExp, realAcc, realKin) = self.GetAcquisitionTimings()
 		successMsg = "Real (exp., acc., kin.) times are ({:.3}, {:.3}, {:.3}) ms.\n".format(realExp * 1.0e3, realAcc * 1.0e3, realKin * 1.0e3)
 		msg += self.handleErrors(ret, "GetAcquisitionTimings error: ", successMsg)
 
-		# Get the keep clean time
 		(ret, keepclean) = self.GetKeepCleanTime()
-		successMsg = "Keep clean time is {} ms.\n".format(keepclean * 1.0e3)
+		successMsg = "Keep clean time is {:.3} ms.\n".format(keepclean * 1.0e3)
 		msg += self.handleErrors(ret, "GetKeepCleanTime error: ", successMsg)
 
-		# Get the readout time
 		(ret, readout) = self.GetReadOutTime()
 		successMsg = "Readout time is {:.3} ms.\n".format(readout * 1.0e3)
 		msg += self.handleErrors(ret, "GetReadoutTime error: ", successMsg)
+		self.timings = {'exposure': realExp, 'accumulate': realAcc, 'kinetic': realKin, 'keepClean': keepclean, 'readout': readout}
+		return msg
+
+	# Setup the live preview
+	# Run till abort with internal trigger, image read mode with the given ROI and binning
+	# Nothing here is kept: the acquisition settings are all set again by
+	# armiXon, setupAcquisition and setupFastKinetics/setupImage before the next acquisition
+	def setupPreview(self, config, binning):
+		self.errorFlag = 0
+		msg = ""
+
+		ret = self.SetAcquisitionMode(KRBCAM_ACQ_MODE_RTA)
+		successMsg = "Acquisition mode set to " + acq_modes[str(KRBCAM_ACQ_MODE_RTA)] + ".\n"
+		msg += self.handleErrors(ret, "SetAcquisitionMode error: ", successMsg)
+
+		ret = self.SetTriggerMode(0)
+		successMsg = "Trigger mode set to " + trigger_modes['0'] + ".\n"
+		msg += self.handleErrors(ret, "SetTriggerMode error: ", successMsg)
+
+		# Use the fastest vertical shift speed that doesn't need extra clock voltage
+		(ret, index, speed) = self.GetFastestRecommendedVSSpeed()
+		msg += self.handleErrors(ret, "GetFastestRecommendedVSSpeed error: ", "")
+		ret = self.SetVSSpeed(index)
+		successMsg = "Vertical shift speed set to {:.3} microseconds.\n".format(speed)
+		msg += self.handleErrors(ret, "SetVSSpeed error: ", successMsg)
+
+		# Set the exposure time, and take frames back to back
+		ret = self.SetExposureTime(config['expTime'] * 1e-3)
+		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
+		ret = self.SetKineticCycleTime(0)
+		msg += self.handleErrors(ret, "SetKineticCycleTime error: ", "")
+
+		hstart = config['xOffset'] + 1
+		hend = config['xOffset'] + config['dx']
+		vstart = config['yOffset'] + 1
+		vend = config['yOffset'] + config['dy']
+		ret = self.SetImage(binning, binning, hstart, hend, vstart, vend)
+		msg += self.handleErrors(ret, "SetImage error: ", "Preview bounds set.\n")
+
+		# Get the Acquisition timings
+		(ret, realExp, realAcc, realKin) = self.GetAcquisitionTimings()
+		successMsg = "Preview frame time is {:.3} ms ({:.1f} fps).\n".format(realKin * 1.0e3, 1.0/max(realKin, 1e-6))
+		msg += self.handleErrors(ret, "GetAcquisitionTimings error: ", successMsg)
 
 		return (self.errorFlag, msg)
+
+	# Get the most recent image during a run till abort acquisition
+	# Returns (errorFlag, msg, count, data)
+	# count is the total number of images acquired so far,
+	# data is None if there isn't a new image since lastCount
+	def getMostRecentImage(self, dataLength, lastCount):
+		(ret, count) = self.GetTotalNumberImagesAcquired()
+		if ret != self.DRV_SUCCESS:
+			return (1, self.handleErrors(ret, "GetTotalNumberImagesAcquired error: ", ""), lastCount, None)
+		if count <= lastCount:
+			return (0, "", count, None)
+
+		(ret, data) = self.GetMostRecentImage(dataLength)
+		if ret != self.DRV_SUCCESS:
+			return (1, self.handleErrors(ret, "GetMostRecentImage error: ", ""), count, None)
+
+		return (0, "", count, data)
+
+	# Setup streaming frames for photon counting
+	# Run till abort with the configured trigger, image read mode with the configured ROI and binning
+	# Like the preview, armiXon, setupAcquisition and setupFastKinetics/setupImage
+	# set everything again before the next acquisition
+	def setupStreaming(self, config):
+		self.errorFlag = 0
+		msg = ""
+
+		ret = self.SetAcquisitionMode(KRBCAM_ACQ_MODE_RTA)
+		successMsg = "Acquisition mode set to " + acq_modes[str(KRBCAM_ACQ_MODE_RTA)] + ".\n"
+		msg += self.handleErrors(ret, "SetAcquisitionMode error: ", successMsg)
+
+		ret = self.SetVSSpeed(config['vss'])
+		successMsg = "Vertical shift speed set to {}.\n".format(config['vss'])
+		msg += self.handleErrors(ret, "SetVSSpeed error: ", successMsg)
+
+		ret = self.SetExposureTime(config['expTime'] * 1e-3)
+		msg += self.handleErrors(ret, "SetExposureTime error: ", "Exposure time set.\n")
+		ret = self.SetKineticCycleTime(0)
+		msg += self.handleErrors(ret, "SetKineticCycleTime error: ", "")
+
+		if config['binning']:
+			binning = KRBCAM_BIN_SIZE
+		else:
+			binning = 1
+		hstart = config['xOffset'] + 1
+		hend = config['xOffset'] + config['dx']
+		vstart = config['yOffset'] + 1
+		vend = config['yOffset'] + config['dy']
+		ret = self.SetImage(binning, binning, hstart, hend, vstart, vend)
+		msg += self.handleErrors(ret, "SetImage error: ", "Image bounds set.\n")
+
+		(ret, realExp, realAcc, realKin) = self.GetAcquisitionTimings()
+		successMsg = "Frame time is {:.3} ms ({:.1f} fps).\n".format(realKin * 1.0e3, 1.0/max(realKin, 1e-6))
+		msg += self.handleErrors(ret, "GetAcquisitionTimings error: ", successMsg)
+
+		return (self.errorFlag, msg)
+
+	# Get all the images acquired since the last call during a run till abort acquisition
+	# Returns (errorFlag, msg, n, data)
+	# n is the number of images in data, data is None if there are no new images
+	def getNewImages(self, dataLength):
+		(ret, first, last) = self.GetNumberNewImages()
+		if ret == self.DRV_NO_NEW_DATA:
+			return (0, "", 0, None)
+		if ret != self.DRV_SUCCESS:
+			return (1, self.handleErrors(ret, "GetNumberNewImages error: ", ""), 0, None)
+
+		n = last - first + 1
+		(ret, data, validfirst, validlast) = self.GetImages(first, last, n * dataLength)
+		if ret != self.DRV_SUCCESS:
+			return (1, self.handleErrors(ret, "GetImages error: ", ""), 0, None)
+
+		return (0, "", n, data)
@@ -8,10 +8,17 @@
 
 KRBCAM_ACQ_MODE_FK = 4					# 4 is Fast kinetics
 KRBCAM_ACQ_MODE_SINGLE = 1				# 1 is Single
+KRBCAM_ACQ_MODE_ACCUMULATE = 2			# 2 is Accumulate
+KRBCAM_ACQ_MODE_KINETICS = 3			# 3 is Kinetic series
+KRBCAM_ACQ_MODE_RTA = 5					# 5 is Run till abort
+
+# Acquisition modes that can be chosen in the config form
+KRBCAM_ACQ_MODES = [KRBCAM_ACQ_MODE_SINGLE, KRBCAM_ACQ_MODE_FK, KRBCAM_ACQ_MODE_ACCUMULATE, KRBCAM_ACQ_MODE_KINETICS]
 
 KRBCAM_ACQ_MODE = KRBCAM_ACQ_MODE_FK	# 4 is Fast Kinetics
 
 KRBCAM_READ_MODE = 4 					# 4 is Image
+KRBCAM_READ_MODE_RANDOM_TRACK = 2		# 2 is Random-Track, used to read several row regions
 
 KRBCAM_TRIGGER_MODE = 1					# 0 is Internal, 1 is External
 KRBCAM_EM_MODE = 3						# 0 is Normal, 3 is RealGain
@@ -25,7 +32,10 @@ KRBCAM_USE_INTERNAL_SHUTTER = 1			# 1 for no, 0 for yes
 # KRBCAM_OD_SERIES_LENGTH_IMAGE = 2		# 2 for fluorescence
 
 KRBCAM_FK_BINNING_MODE = 4
-KRBCAM_N_ACC = 1
+KRBCAM_N_ACC = 1						# Default number of accumulations for Accumulate and Kinetic series
+KRBCAM_MAX_ACC = 1000
+KRBCAM_MAX_FK_FRAMES = 6
+KRBCAM_MAX_KINETIC_FRAMES = 100
 KRBCAM_BIN_SIZE = 2
 
 KRBCAM_DEFAULT_TEMP = -20				# Celsius
@@ -40,7 +50,16 @@ if KRBCAM_TRIGGER_MODE == 1:
 	KRBCAM_ACQ_TIMER = 0.1				# 0.1 s for external trigger acquisition loop
 else:
 	KRBCAM_ACQ_TIMER = 0.3				# 0.3 s for internal trigger acquisition loop
+KRBCAM_POLL_MIN = 0.005					# s, shortest interval between status checks while acquiring
+KRBCAM_POLL_MAX = KRBCAM_ACQ_TIMER		# s, longest interval between status checks while acquiring
+KRBCAM_POLL_BACKOFF = 1.5				# Factor the interval grows by after each check that finds the camera busy
+KRBCAM_POLL_HISTORY = 10				# Recent shots the trigger to idle delay is learned from
 KRBCAM_LOOP_ACQ = True					# Loop acquisition?
+KRBCAM_DISPLAY_MAX_FPS = 5				# Maximum image window refresh rate (Hz)
+KRBCAM_DISPLAY_FPS_WINDOW = 10			# Number of redraws to average the display rate over
+
+KRBCAM_PREVIEW_MAX_FPS = 30				# Live preview refresh rate (Hz)
+KRBCAM_PREVIEW_BIN_SIZES = [1, 2, 4, 8]	# Hardware binning options for the live preview
 
 # KRBCAM_FILENAME_BASE_IMAGE = 'ixon_img_'
 # KRBCAM_FILENAME_BASE_FK = 'ixon_'
@@ -62,8 +81,56 @@ KRBCAM_REMOTE_SAVE_PATH = '\\\\' + ip_str + '\\krbdata\\data\\' # PolarKRB's IP
 KRBCAM_SAVE_PATH_SUFFIX = '{0.year}\\{0:%m}\\{0.year}{0:%m}{0:%d}\\' # e.g. "2019\01\20190101\Andor\"
 KRBCAM_DEFAULT_SAVE_PATH = KRBCAM_REMOTE_SAVE_PATH
 
+KRBCAM_SPOOL_ENABLE = True				# Save to a local spool and copy to the remote share in the background?
+KRBCAM_SPOOL_PATH = KRBCAM_LOCAL_SAVE_PATH + 'spool\\'	# Local mirror of the remote save path
+KRBCAM_SPOOL_JOURNAL = 'replication.journal'	# Queued and copied files, in the spool
+KRBCAM_REPLICATE_TIMER = 1				# s between checks for files to copy
+KRBCAM_REPLICATE_BATCH = 20				# Files copied per batch
+KRBCAM_REPLICATE_RETRY_MIN = 2			# s to wait after a failed copy, doubled after each failure
+KRBCAM_REPLICATE_RETRY_MAX = 120		# s, longest wait between retries
+KRBCAM_REPLICATE_RATE_WINDOW = 20		# Batches the copy rate is averaged over
+KRBCAM_SPOOL_KEEP = 172800				# s a copied file stays in the spool after it last changed
+KRBCAM_SPOOL_PRUNE_TIMER = 600			# s between looks for copied files to remove from the spool
+
+KRBCAM_CATALOG_ENABLE = True			# Catalog every saved shot in a local database?
+KRBCAM_CATALOG_PATH = KRBCAM_LOCAL_SAVE_PATH + 'catalog.sqlite'
+KRBCAM_CATALOG_TIMER = 5				# s between writes of the queued shots to the catalog
+
 KRBCAM_DEFAULT_CONFIG = 'TwoSpeciesFK.json'
 
+KRBCAM_SAVE_CSV = True					# Save each shot as a csv file?
+KRBCAM_SAVE_ARCHIVE = True				# Append each shot to the daily frame archive in the save folder?
+KRBCAM_ARCHIVE_EXT = '.krba'			# Frame archive data file
+KRBCAM_ARCHIVE_INDEX_EXT = '.krbi'		# Frame archive index file
+KRBCAM_JOURNAL_ENABLE = True			# Journal the raw frames of saved series, so they can be recovered after a crash?
+KRBCAM_JOURNAL_PATH = KRBCAM_LOCAL_SAVE_PATH + 'raw.journal'
+KRBCAM_JOURNAL_BYTES = 2 * 2**30		# Size of the journal, preallocated
+KRBCAM_JOURNAL_ALIGN = 2**16			# Records start on multiples of this
+KRBCAM_JOURNAL_FSYNC = False			# Force each record to disk? Without it a crash of the program loses nothing, a power cut can
+
+KRBCAM_THUMB_ENABLE = True				# Write previews of saved shots and show them in the image window?
+KRBCAM_THUMB_FOLDER = 'thumbs\\'		# Previews go in this folder of the save folder
+KRBCAM_THUMB_SIZE = 128				# Longest side of each setting's OD preview (pixels)
+KRBCAM_THUMB_FRAME_SIZE = 64			# Longest side of each frame in the frame sheet
+KRBCAM_THUMB_HOLD = 1.0				# s after a readout during which no previews are made
+
+KRBCAM_SAVE_ROI_ONLY = False			# Save only the region around the clouds, with a full frame every KRBCAM_SAVE_KEYFRAME_EVERY shots?
+KRBCAM_SAVE_KEYFRAME_EVERY = 20			# Shots between full frames when saving ROIs only
+KRBCAM_SAVE_ROI_PADDING = 16			# Binned pixels saved around the ROIs
+KRBCAM_REGION_SUFFIX = '_region.json'	# Saved next to the csv of a region, with where it is on the full frame
+KRBCAM_SAVE_COMPRESSED = False			# Save each shot as a losslessly compressed file?
+KRBCAM_COMPRESSED_EXT = '.krbz'			# Compressed shot file
+KRBCAM_COMPRESS_CODEC = 'zlib'			# 'zlib', 'bz2', or 'lzma' (Python 3 or backports.lzma)
+KRBCAM_COMPRESS_LEVEL = 1				# Compression level of the codec, higher levels gain little on noisy frames
+KRBCAM_COMPRESS_FILTER = 'shuffle'		# 'shuffle', or 'delta' for smooth low noise frames
+KRBCAM_COMPRESS_THREADS = 4				# Threads compressing the images of a shot
+KRBCAM_CONVERT_LOG = 'krb_convert.log'	# Folders converted from csv to frame archives, in the destination
+KRBCAM_CONVERT_IDLE = 3600				# s an archive must be left alone before it is converted into
+
+KRBCAM_HISTORY_MAX_BYTES = 512 * 2**20	# Memory for recent shots in the image window history
+KRBCAM_HISTORY_MAX_SHOTS = 1000			# Shots that can be recalled in the image window history
+KRBCAM_HISTORY_SPILL = True				# Recall shots evicted from memory from the frame archive?
+
 #########################################################################################
 ############# Don't change stuff above this line unless you mean it! ####################
 #########################################################################################
@@ -103,10 +170,98 @@ if not default_config.has_key('saveFolder'):
 
 KRBCAM_AUTOSCALE_PERCENTILES = [0.2, 99.8]
 
+##################################
+####### Per-shot analysis ########
+##################################
+
+KRBCAM_ANALYSIS_ENABLE = True			# Analyze the ROIs of each shot?
+KRBCAM_ANALYSIS_PROCESSES = 2			# Number of worker processes for the analysis
+KRBCAM_ANALYSIS_LOG = 'analysis_log.txt'	# csv written to the save directory, one line per shot and setting
+KRBCAM_DEFAULT_ROI = [0, 0, 512, 512]	# x, y, dx, dy in displayed (binned) pixels
+KRBCAM_PIXEL_SIZE = 16.0e-6				# CCD pixel size (m)
+KRBCAM_MAGNIFICATION = 1.0				# Imaging magnification
+KRBCAM_CROSS_SECTIONS = [2.81e-13, 2.91e-13]	# Resonant cross sections 3 lambda^2 / 2 pi (m^2) for settings 0 (K), 1 (Rb)
+
+KRBCAM_FIT_MODELS = ['None', 'Gaussian', 'Thomas-Fermi']	# Fit choices in the image window
+KRBCAM_FIT_DOWNSAMPLE = 4				# Coarse fit on k x k binned ROI before the full resolution fit
+KRBCAM_FIT_WINDOW = 3					# Full resolution fit region, in fitted widths around the center
+KRBCAM_FIT_MAX_ITER = 50				# Levenberg-Marquardt iterations per stage
+KRBCAM_FIT_TOL = 1e-4					# Relative parameter change for convergence
+
+KRBCAM_FRINGE_ENABLE = False			# Replace the light frame with a fringe-matched reference?
+KRBCAM_FRINGE_BASIS_SIZE = 20			# Number of basis frames used for the reference
+KRBCAM_FRINGE_LIBRARY_LENGTH = 50		# Number of recent light frames kept per setting
+
+KRBCAM_STATS_ENABLE = True				# Keep running per-pixel mean and variance over shots?
+
+KRBCAM_CALIBRATION_ENABLE = False		# Subtract the master dark and repair hot/dead pixels as frames come in?
+KRBCAM_DARK_COUNT = 20					# Number of dark frames for a master dark
+KRBCAM_HOT_PIXEL_THRESHOLD = 8			# Hot pixel cut, in robust standard deviations above the master dark level
+KRBCAM_MASTER_DARK = -1					# Acquisition index that selects the master dark in place of a dark frame
+
+KRBCAM_COSMIC_ENABLE = False			# Find and repair cosmic ray hits before the OD is calculated?
+KRBCAM_COSMIC_THRESHOLD = 8				# Cut above the local median and the other frames, in robust standard deviations
+
+KRBCAM_PC_THRESHOLD = 5					# Photon counting threshold above bias, in read noise standard deviations
+KRBCAM_PC_CALIBRATION_FRAMES = 20		# Frames at the start of a photon counting run used to find the bias and read noise
+KRBCAM_PC_TIMER = 0.05					# s between reading out new frames while photon counting
+
+KRBCAM_AUTOROI_ENABLE = False			# Crop the readout to the recent clouds?
+KRBCAM_AUTOROI_THRESHOLD = 0.2			# Cloud pixels are above this fraction of the peak OD (above background)
+KRBCAM_AUTOROI_BLOCK = 4				# Block size for averaging the OD before finding the cloud
+KRBCAM_AUTOROI_MIN_SNR = 5				# Peak OD needed to count as a cloud, in units of the OD noise
+KRBCAM_AUTOROI_PADDING = 0.5			# Padding on each side of the cloud, as a fraction of its size
+KRBCAM_AUTOROI_MIN_PADDING = 16			# Minimum padding in binned pixels
+KRBCAM_AUTOROI_HISTORY = 5				# Number of recent clouds the crop has to contain
+KRBCAM_AUTOROI_FULL_FRAME_EVERY = 20	# Take a full frame every this many series
+
+KRBCAM_READ_NOISE_EM = [(17, 89), (10, 60), (5, 40), (1, 25)]		# (HS speed MHz, read noise e- before EM gain) for the readout planner
+KRBCAM_READ_NOISE_CONVENTIONAL = [(3, 10), (1, 6), (0.08, 3)]		# (HS speed MHz, read noise e-) of the conventional amplifier
+KRBCAM_PLAN_MAX_NOISE = 10.0			# Default read noise limit for the readout planner (e-)
+
 #####################################
 ######### Dicts for lookups #########
 #####################################
 
+# Acquisition mode of a config
+# Configs from before the mode could be chosen are Single scan with 1 kinetics frame,
+# otherwise Fast kinetics
+def acquisitionMode(config):
+	if config.has_key('acqMode'):
+		return config['acqMode']
+	elif int(config['kinFrames']) == 1:
+		return KRBCAM_ACQ_MODE_SINGLE
+	else:
+		return KRBCAM_ACQ_MODE_FK
+
+# Number of exposures summed into each image
+def accumulations(config):
+	if acquisitionMode(config) in [KRBCAM_ACQ_MODE_ACCUMULATE, KRBCAM_ACQ_MODE_KINETICS]:
+		return int(config.get('nAcc', KRBCAM_N_ACC))
+	return 1
+
+# Row regions [[y, dy], ...] of a multi-region readout, in unbinned CCD rows
+# Empty for a single region set by the offsets and dx, dy. With several regions
+# yOffset and dy span all of them, and the columns are the same for every region.
+def readoutRegions(config):
+	return [list(r) for r in config.get('regions', [])]
+
+# Rows of the full region (binned, counted from yOffset) that a multi-region readout reads
+# None for a single region
+def regionRows(config):
+	regions = readoutRegions(config)
+	if not regions:
+		return None
+	if config['binning']:
+		binning = KRBCAM_BIN_SIZE
+	else:
+		binning = 1
+	rows = []
+	for (y, dy) in regions:
+		start = (y - config['yOffset']) / binning
+		rows.extend(range(start, start + dy / binning))
+	return rows
+
 acq_modes = {
 	'1': 'Single Scan',
 	'2': 'Accumulate',
@@ -1,5 +1,8 @@
 import os
+import re
 import datetime
+import time
+from collections import deque
 
 import json
 
@@ -19,6 +22,12 @@ from copy import deepcopy
 from andor_helpers import *
 
 from krb_custom_colors import KRbCustomColors
+import krb_analysis
+import krb_archive
+import krb_spool
+from krb_stats import KRbPixelStats
+from krb_history import KRbShotHistory
+import krb_thumbs
 
 layout_params = {
 	'main': [1000, 975],
@@ -45,8 +54,10 @@ class ConfigForm(QtGui.QWidget):
 
 	# These default parameters are set in the default_config dict in andor_helpers.py
 	def setDefaultValues(self, config=default_config):
+		self.setAcquisitionMode(acquisitionMode(config))
 		self.kineticsFramesEdit.setValue(int(config['kinFrames']))
 		self.acqLengthEdit.setValue(int(config['acqLength']))
+		self.accumulationsEdit.setValue(int(config.get('nAcc', KRBCAM_N_ACC)))
 
 		self.exposureEdit.setText(str(config['expTime']))
 
@@ -55,6 +66,7 @@ class ConfigForm(QtGui.QWidget):
 
 		self.dxEdit.setText(str(config['dx']))
 		self.dyEdit.setText(str(config['dy']))
+		self.regionsEdit.setText(self.formatRegions(config.get('regions', [])))
 
 		self.binningControl.setChecked(config['binning'])
 
@@ -106,6 +118,8 @@ class ConfigForm(QtGui.QWidget):
 		self.imageWindow.controlComboBoxes(int(config['kinFrames']), int(config['acqLength']))
 		if config.has_key('fss'):
 			self.imageWindow.setFrameSelectState(config['fss'])
+		if config.has_key('rois'):
+			self.imageWindow.setROIState(config['rois'])
 
 	# Check save directory and file number
 	# using path defined in the save path field
@@ -127,23 +141,34 @@ class ConfigForm(QtGui.QWidget):
 				savedir = KRBCAM_DEFAULT_SAVE_PATH + suffix
 				self.savePathEdit.setText(savedir)
 
+		# Files for the remote share are saved in the local spool first,
+		# the share doesn't have to be there
+		savedirs = [savedir]
+		spool = None
+		if KRBCAM_SPOOL_ENABLE:
+			spool = krb_spool.spoolDir(savedir)
+		if spool is not None:
+			savedirs.append(spool)
+
 		# Check if the directory exists
-		if os.path.isdir(savedir):
-			filelist = os.listdir(savedir)
-			for file in filelist:
-				# Extract the file number
-				# Files are saved as KRBCAM_FILENAME_BASE + filenumber + .csv
-				ind1 = len(filebase)
-				ind2 = file.find('.csv')
-				
-				# Compare file number, if it's bigger than set fileNumber to 1 greater than that
-				try:
-					substr = file[ind1:ind2]
-					num = int(substr)
-					if num >= fileNumber:
-						fileNumber = num + 1
-				except:
-					pass
+		if os.path.isdir(savedir) or spool is not None:
+			for d in savedirs:
+				if not os.path.isdir(d):
+					continue
+				filelist = os.listdir(d)
+				# Files are saved as KRBCAM_FILENAME_BASE + filenumber + .csv or the compressed extension
+				shotName = re.compile(re.escape(filebase) + r'(\d+)(\.csv|' + re.escape(KRBCAM_COMPRESSED_EXT) + r')$')
+				for file in filelist:
+					# Extract the file number
+					# Compare file number, if it's bigger than set fileNumber to 1 greater than that
+					m = shotName.match(file)
+					if m is not None:
+						num = int(m.group(1))
+						if num >= fileNumber:
+							fileNumber = num + 1
+
+				# Shots may only be in the frame archive
+				fileNumber = max(fileNumber, krb_archive.nextFileNumber(krb_archive.archivePath(d, str(self.fileBaseEdit.text()))))
 		# If not, make the directory
 		else:
 			try:
@@ -220,48 +245,81 @@ class ConfigForm(QtGui.QWidget):
 			if self.hssPA[adc][typ][hss][i]:
 				self.preAmpGainControl.addItem(str(self.pa[i]))
 
+	# Set the readout settings recommended by the timing planner
+	# The AD channel has to be set first, it repopulates the HS speeds and pre amp gains
+	def setReadout(self, config):
+		self.adChannelControl.setCurrentIndex(config['adChannel'])
+		self.hssControl.setCurrentIndex(config['hss'])
+		self.preAmpGainControl.setCurrentIndex(config['preAmpGain'])
+		self.vssControl.setCurrentIndex(config['vss'])
+		self.binningControl.setChecked(bool(config['binning']))
+		self.dxEdit.setText(str(config['dx']))
+		self.dyEdit.setText(str(config['dy']))
+
 	# Returns the form data
 	# If any field has an invalid format, the default values are reset
 	def getFormData(self):
 		self.checkDir()
 		try:
-			form = {}
-			form['kinFrames'] = int(self.kineticsFramesEdit.value())
-			form['acqLength'] = int(self.acqLengthEdit.value())
-			form['expTime'] = float(self.exposureEdit.text())
-			form['xOffset'] = int(self.xOffsetEdit.text())
-			form['yOffset'] = int(self.yOffsetEdit.text())
-			form['dx'] = int(self.dxEdit.text())
-			form['dy'] = int(self.dyEdit.text())
-			form['binning'] = bool(self.binningControl.isChecked())
-			form['emEnable'] = bool(self.emEnableControl.isChecked())
-			form['emGain'] = int(self.emGainEdit.text())
-			form['fileNumber'] = int(self.fileNumberEdit.text())
-			form['savePath'] = str(self.savePathEdit.text())
-			form['saveFolder'] = str(self.saveFolderEdit.text())
-			form['filebase'] = str(self.fileBaseEdit.text())
-			form['vss'] = self.vssControl.currentIndex()
-			form['adChannel'] = self.adChannelControl.currentIndex()
-			form['hss'] = self.hssControl.currentIndex()
-			form['preAmpGain'] = self.preAmpGainControl.currentIndex()
-			form['saveFiles'] = bool(self.saveEnableControl.isChecked())
-			form['rotateImage'] = bool(self.rotateImageControl.isChecked())
-			return form
+			return self.readForm()
 		except:
 			self.throwErrorMessage("Invalid form data!", "Try again.")
 			self.setDefaultValues()
 			return self.getFormData()
 
+	# Form data for the timing prediction while the form is being edited
+	# Returns None instead of resetting the form if a field is invalid or being repopulated
+	def getTimingForm(self):
+		try:
+			form = self.readForm()
+			form['maxNoise'] = float(self.maxNoiseEdit.text())
+		except:
+			return None
+		if min(form['vss'], form['adChannel'], form['hss'], form['preAmpGain']) < 0:
+			return None
+		return form
+
+	# Raises an exception if any field has an invalid format
+	def readForm(self):
+		form = {}
+		form['acqMode'] = self.getAcquisitionMode()
+		form['kinFrames'] = int(self.kineticsFramesEdit.value())
+		form['acqLength'] = int(self.acqLengthEdit.value())
+		form['nAcc'] = int(self.accumulationsEdit.value())
+		form['expTime'] = float(self.exposureEdit.text())
+		form['xOffset'] = int(self.xOffsetEdit.text())
+		form['yOffset'] = int(self.yOffsetEdit.text())
+		form['dx'] = int(self.dxEdit.text())
+		form['dy'] = int(self.dyEdit.text())
+		form['regions'] = self.parseRegions(str(self.regionsEdit.text()))
+		form['binning'] = bool(self.binningControl.isChecked())
+		form['emEnable'] = bool(self.emEnableControl.isChecked())
+		form['emGain'] = int(self.emGainEdit.text())
+		form['fileNumber'] = int(self.fileNumberEdit.text())
+		form['savePath'] = str(self.savePathEdit.text())
+		form['saveFolder'] = str(self.saveFolderEdit.text())
+		form['filebase'] = str(self.fileBaseEdit.text())
+		form['vss'] = self.vssControl.currentIndex()
+		form['adChannel'] = self.adChannelControl.currentIndex()
+		form['hss'] = self.hssControl.currentIndex()
+		form['preAmpGain'] = self.preAmpGainControl.currentIndex()
+		form['saveFiles'] = bool(self.saveEnableControl.isChecked())
+		form['rotateImage'] = bool(self.rotateImageControl.isChecked())
+		return form
+
 	# Takes form as an input dict (should have same keys as gConfig in the main GUI)
 	# and populates the form fields with these
 	def setFormData(self, form):
+		self.setAcquisitionMode(acquisitionMode(form))
 		self.kineticsFramesEdit.setValue(int(form['kinFrames']))
 		self.acqLengthEdit.setValue(int(form['acqLength']))
+		self.accumulationsEdit.setValue(int(form.get('nAcc', KRBCAM_N_ACC)))
 		self.exposureEdit.setText(str(form['expTime']))
 		self.xOffsetEdit.setText(str(form['xOffset']))
 		self.yOffsetEdit.setText(str(form['yOffset']))
 		self.dxEdit.setText(str(form['dx']))
 		self.dyEdit.setText(str(form['dy']))
+		self.regionsEdit.setText(self.formatRegions(form.get('regions', [])))
 		self.binningControl.setChecked(bool(form['binning']))
 		self.emEnableControl.setChecked(bool(form['emEnable']))
 		self.emGainEdit.setText(str(form['emGain']))
@@ -286,17 +344,45 @@ class ConfigForm(QtGui.QWidget):
 			self.emGainEdit.setDisabled(True)
 			self.emGainEdit.setStyleSheet("color: rgb(0,0,0);")
 
-	# Control labels based on acquisition mode
+	def getAcquisitionMode(self):
+		return KRBCAM_ACQ_MODES[self.acqModeControl.currentIndex()]
+
+	# Row regions are written as y:dy, separated by commas
+	# Raises ValueError if the text has an invalid format
+	def parseRegions(self, text):
+		regions = []
+		for item in text.split(','):
+			if item.strip():
+				(y, dy) = item.split(':')
+				regions.append([int(y), int(dy)])
+		return regions
+
+	def formatRegions(self, regions):
+		return ", ".join(["{}:{}".format(y, dy) for (y, dy) in regions])
+
+	def setAcquisitionMode(self, mode):
+		self.acqModeControl.setCurrentIndex(KRBCAM_ACQ_MODES.index(mode))
+		self.controlAcquireMode()
+
+	# Control labels and ranges based on acquisition mode
 	def controlAcquireMode(self):
-		# if self.acquireEdit.currentIndex() == 0:
-		# 	self.vssStatic.setText("VSS Speed")
-		# else:
-		# 	self.vssStatic.setText("FKVS Speed")
+		mode = self.getAcquisitionMode()
 
-		if int(self.kineticsFramesEdit.value()) == 1:
+		if mode == KRBCAM_ACQ_MODE_FK:
+			self.vssStatic.setText("FKVS Speed")
+			self.kineticsFramesStatic.setText("Fast Kinetics frames")
+			self.kineticsFramesEdit.setRange(2, KRBCAM_MAX_FK_FRAMES)
+		elif mode == KRBCAM_ACQ_MODE_KINETICS:
 			self.vssStatic.setText("VSS Speed")
+			self.kineticsFramesStatic.setText("Kinetic series frames")
+			self.kineticsFramesEdit.setRange(1, KRBCAM_MAX_KINETIC_FRAMES)
 		else:
-			self.vssStatic.setText("FKVS Speed")
+			# One image per acquisition
+			self.vssStatic.setText("VSS Speed")
+			self.kineticsFramesStatic.setText("Kinetics frames")
+			self.kineticsFramesEdit.setRange(1, 1)
+
+		self.accumulationsEdit.setDisabled(mode not in [KRBCAM_ACQ_MODE_ACCUMULATE, KRBCAM_ACQ_MODE_KINETICS])
 
 	# Save files control toggle
 	def saveControlToggle(self):
@@ -311,8 +397,10 @@ class ConfigForm(QtGui.QWidget):
 	def freezeForm(self, acquiring):
 		# self.acquireEdit.setDisabled(acquiring)
 
+		self.acqModeControl.setDisabled(acquiring)
 		self.kineticsFramesEdit.setDisabled(acquiring)
 		self.acqLengthEdit.setDisabled(acquiring)
+		self.accumulationsEdit.setDisabled(acquiring or self.getAcquisitionMode() not in [KRBCAM_ACQ_MODE_ACCUMULATE, KRBCAM_ACQ_MODE_KINETICS])
 		self.exposureEdit.setDisabled(acquiring)
 		self.emEnableControl.setDisabled(acquiring)
 		self.emGainEdit.setDisabled(acquiring)
@@ -323,8 +411,12 @@ class ConfigForm(QtGui.QWidget):
 		self.yOffsetEdit.setDisabled(acquiring)
 		self.dxEdit.setDisabled(acquiring)
 		self.dyEdit.setDisabled(acquiring)
+		self.regionsEdit.setDisabled(acquiring)
 		self.binningControl.setDisabled(acquiring)
 		self.vssControl.setDisabled(acquiring)
+		self.maxNoiseEdit.setDisabled(acquiring)
+		self.allowBinningControl.setDisabled(acquiring)
+		self.planControl.setDisabled(acquiring)
 		self.savePathEdit.setDisabled(acquiring)
 		self.saveFolderEdit.setDisabled(acquiring)
 		self.fileBaseEdit.setDisabled(acquiring)
@@ -340,6 +432,7 @@ class ConfigForm(QtGui.QWidget):
 
 			fss = self.imageWindow.getFrameSelectState()
 			formData["fss"] = fss
+			formData["rois"] = self.imageWindow.getROIState()
 
 			formData.pop('savePath', None)
 			formData.pop('fileNumber', None)
@@ -358,6 +451,8 @@ class ConfigForm(QtGui.QWidget):
 			self.imageWindow.controlComboBoxes(int(configData['kinFrames']), int(configData['acqLength']))
 			if configData.has_key("fss"):
 				self.imageWindow.setFrameSelectState(configData["fss"])
+			if configData.has_key("rois"):
+				self.imageWindow.setROIState(configData["rois"])
 
 	# Populate the form with widgets
 	def populate(self):
@@ -366,11 +461,22 @@ class ConfigForm(QtGui.QWidget):
 		self.loadConfigControl = QtGui.QPushButton("Load config", self)
 		self.loadConfigControl.clicked.connect(self.loadConfig)
 
+		self.acqModeStatic = QtGui.QLabel("Acquisition mode", self)
+		self.acqModeControl = QtGui.QComboBox(self)
+		for mode in KRBCAM_ACQ_MODES:
+			self.acqModeControl.addItem(acq_modes[str(mode)])
+		self.acqModeControl.currentIndexChanged.connect(self.controlAcquireMode)
+
 		self.kineticsFramesStatic = QtGui.QLabel("Fast Kinetics frames", self)
 		self.kineticsFramesEdit = QtGui.QSpinBox(self)
-		self.kineticsFramesEdit.setRange(1,6)
+		self.kineticsFramesEdit.setRange(1,KRBCAM_MAX_FK_FRAMES)
 		self.kineticsFramesEdit.valueChanged.connect(self.controlAcquireMode)
 
+		self.accumulationsStatic = QtGui.QLabel("Accumulations", self)
+		self.accumulationsEdit = QtGui.QSpinBox(self)
+		self.accumulationsEdit.setRange(1,KRBCAM_MAX_ACC)
+		self.accumulationsEdit.setToolTip("Exposures summed by the camera into each image (Accumulate and Kinetic series)")
+
 		self.acqLengthStatic = QtGui.QLabel("Acquisition loop length", self)
 		self.acqLengthEdit = QtGui.QSpinBox(self)
 		self.acqLengthEdit.setRange(1,3)
@@ -419,6 +525,11 @@ class ConfigForm(QtGui.QWidget):
 		self.dyStatic = QtGui.QLabel("Height dy (px)", self)
 		self.dyEdit = QtGui.QLineEdit(self)
 
+		self.regionsStatic = QtGui.QLabel("Row regions (y:dy, ...)", self)
+		self.regionsEdit = QtGui.QLineEdit(self)
+		self.regionsEdit.setToolTip("Read only these row regions, e.g. 40:100, 300:120 (unbinned CCD rows).\n"
+			"Leave empty to read the single region set by the Y offset and dy. Not available in Fast Kinetics.")
+
 		self.binningStatic = QtGui.QLabel("Bin 2x2?", self)
 		self.binningControl = QtGui.QCheckBox(self)
 
@@ -428,6 +539,19 @@ class ConfigForm(QtGui.QWidget):
 			self.vssStatic = QtGui.QLabel("VSS Speed", self)
 		self.vssControl = QtGui.QComboBox(self)
 
+		self.maxNoiseStatic = QtGui.QLabel("Max read noise (e-)", self)
+		self.maxNoiseEdit = QtGui.QLineEdit(self)
+		self.maxNoiseEdit.setText(str(KRBCAM_PLAN_MAX_NOISE))
+
+		self.allowBinningStatic = QtGui.QLabel("Planner may bin?", self)
+		self.allowBinningControl = QtGui.QCheckBox(self)
+
+		self.planControl = QtGui.QPushButton("Plan fastest readout", self)
+		self.planControl.setToolTip("Choose the AD channel, shift speeds and binning with the shortest cycle time within the read noise limit")
+
+		self.predictionLabel = QtGui.QLabel("", self)
+		self.predictionLabel.setWordWrap(True)
+
 		self.savePathStatic = QtGui.QLabel("Save data directory:", self)
 		self.savePathEdit = QtGui.QLineEdit(self)
 
@@ -458,10 +582,18 @@ class ConfigForm(QtGui.QWidget):
 		self.layout.addWidget(QtGui.QLabel(""), row, 0)
 		row += 1
 
+		self.layout.addWidget(self.acqModeStatic, row, 0)
+		self.layout.addWidget(self.acqModeControl, row, 1)
+		row += 1
+
 		self.layout.addWidget(self.kineticsFramesStatic, row, 0)
 		self.layout.addWidget(self.kineticsFramesEdit, row, 1)
 		row += 1
 
+		self.layout.addWidget(self.accumulationsStatic, row, 0)
+		self.layout.addWidget(self.accumulationsEdit, row, 1)
+		row += 1
+
 		self.layout.addWidget(self.acqLengthStatic, row, 0)
 		self.layout.addWidget(self.acqLengthEdit, row, 1)
 		row += 1
@@ -516,6 +648,10 @@ class ConfigForm(QtGui.QWidget):
 		self.layout.addWidget(self.dyEdit, row, 1)
 		row += 1
 
+		self.layout.addWidget(self.regionsStatic, row, 0)
+		self.layout.addWidget(self.regionsEdit, row, 1)
+		row += 1
+
 		self.layout.addWidget(self.binningStatic, row, 0)
 		self.layout.addWidget(self.binningControl, row, 1)
 		row += 1
@@ -524,6 +660,20 @@ class ConfigForm(QtGui.QWidget):
 		self.layout.addWidget(self.vssControl, row, 1)
 		row += 1
 
+		self.layout.addWidget(self.maxNoiseStatic, row, 0)
+		self.layout.addWidget(self.maxNoiseEdit, row, 1)
+		row += 1
+
+		self.layout.addWidget(self.allowBinningStatic, row, 0)
+		self.layout.addWidget(self.allowBinningControl, row, 1)
+		row += 1
+
+		self.layout.addWidget(self.planControl, row, 0, 1, 2)
+		row += 1
+
+		self.layout.addWidget(self.predictionLabel, row, 0, 1, 2)
+		row += 1
+
 		self.layout.addWidget(QtGui.QLabel(""), row, 0)
 		row += 1
 
@@ -577,11 +727,56 @@ class AcquireAbortStatus(QtGui.QWidget):
 	def acquire(self):
 		self.acquireControl.setDisabled(True)
 		self.abortControl.setDisabled(False)
+		self.previewControl.setDisabled(True)
+		self.countingControl.setDisabled(True)
 
 	# Enable acquire, disable abort
 	def abort(self):
 		self.abortControl.setDisabled(True)
 		self.acquireControl.setDisabled(False)
+		self.previewControl.setDisabled(False)
+		self.countingControl.setDisabled(False)
+
+	# Only the preview button is enabled while previewing
+	def preview(self, on):
+		self.acquireControl.setDisabled(on)
+		self.abortControl.setDisabled(True)
+		self.previewBinningControl.setDisabled(on)
+		self.countingControl.setDisabled(on)
+		if on:
+			self.previewControl.setText("Stop live preview")
+		else:
+			self.previewControl.setText("Start live preview")
+
+	# Only the photon counting button is enabled while counting
+	def counting(self, on):
+		self.acquireControl.setDisabled(on)
+		self.abortControl.setDisabled(True)
+		self.previewControl.setDisabled(on)
+		if on:
+			self.countingControl.setText("Stop photon counting")
+			self.countingStatus.setText("Calibrating")
+		else:
+			self.countingControl.setText("Start photon counting")
+
+	def countingProgress(self, nFrames):
+		self.countingStatus.setText("{} frames".format(nFrames))
+
+	def calibrationEnabled(self):
+		return self.calibrationControl.isChecked()
+
+	def cosmicRejectionEnabled(self):
+		return self.cosmicControl.isChecked()
+
+	def autoROIEnabled(self):
+		return self.autoROIControl.isChecked()
+
+	def saveROIOnly(self):
+		return self.saveROIControl.isChecked()
+
+	# Hardware binning for the live preview
+	def getPreviewBinning(self):
+		return int(self.previewBinningControl.currentText())
 
 	# Populate the GUI
 	def populate(self):
@@ -590,6 +785,53 @@ class AcquireAbortStatus(QtGui.QWidget):
 		self.acquireControl = QtGui.QPushButton("Update parameters and acquire")
 		self.abortControl = QtGui.QPushButton("Stop acquiring")
 
+		self.previewControl = QtGui.QPushButton("Start live preview")
+		self.previewBinningStatic = QtGui.QLabel("Preview binning:")
+		self.previewBinningControl = QtGui.QComboBox()
+		for b in KRBCAM_PREVIEW_BIN_SIZES:
+			self.previewBinningControl.addItem(str(b))
+
+		self.previewLayout = QtGui.QHBoxLayout()
+		self.previewLayout.addWidget(self.previewControl)
+		self.previewLayout.addWidget(self.previewBinningStatic)
+		self.previewLayout.addWidget(self.previewBinningControl)
+
+		self.darkControl = QtGui.QPushButton("Record master dark")
+		self.darkControl.setToolTip("Build the master dark and hot pixel mask from the dark frames of the next {} series".format(KRBCAM_DARK_COUNT))
+		self.calibrationControl = QtGui.QCheckBox("Dark/hot pixel correction")
+		self.calibrationControl.setChecked(KRBCAM_CALIBRATION_ENABLE)
+		self.calibrationControl.setToolTip("Subtract the master dark and repair hot pixels as frames are read out (also in saved files)")
+
+		self.countingControl = QtGui.QPushButton("Start photon counting")
+		self.countingControl.setToolTip("Stream frames with EM gain and count photons above the read noise. The first {} frames set the threshold.".format(KRBCAM_PC_CALIBRATION_FRAMES))
+		self.countingStatus = QtGui.QLabel("")
+
+		self.countingLayout = QtGui.QHBoxLayout()
+		self.countingLayout.addWidget(self.countingControl)
+		self.countingLayout.addWidget(self.countingStatus)
+
+		self.autoROIControl = QtGui.QCheckBox("Auto readout ROI")
+		self.autoROIControl.setChecked(KRBCAM_AUTOROI_ENABLE)
+		self.autoROIControl.setToolTip("Crop the readout around recent clouds, with a full frame every {} series".format(KRBCAM_AUTOROI_FULL_FRAME_EVERY))
+		self.countingLayout.addWidget(self.autoROIControl)
+
+		self.calibrationLayout = QtGui.QHBoxLayout()
+		self.calibrationLayout.addWidget(self.darkControl)
+		self.calibrationLayout.addWidget(self.calibrationControl)
+
+		self.cosmicControl = QtGui.QCheckBox("Cosmic ray repair")
+		self.cosmicControl.setChecked(KRBCAM_COSMIC_ENABLE)
+		self.cosmicControl.setToolTip("Replace single frame spikes by their local median before saving and the OD")
+		self.calibrationLayout.addWidget(self.cosmicControl)
+
+		self.saveROIControl = QtGui.QCheckBox("Save ROIs only")
+		self.saveROIControl.setChecked(KRBCAM_SAVE_ROI_ONLY)
+		self.saveROIControl.setToolTip("Save only the region around the clouds (auto ROI or analysis ROIs), with a full frame every {} shots".format(KRBCAM_SAVE_KEYFRAME_EVERY))
+		self.calibrationLayout.addWidget(self.saveROIControl)
+
+		self.replicationStatus = QtGui.QLabel("")
+		self.replicationStatus.setToolTip("Files saved in the local spool and not yet copied to the data share")
+
 		self.statusStatic = QtGui.QLabel("Status log:")
 		self.statusEdit = QtGui.QTextEdit()
 		self.statusEdit.setReadOnly(True)
@@ -597,6 +839,10 @@ class AcquireAbortStatus(QtGui.QWidget):
 
 		self.layout.addWidget(self.acquireControl)
 		self.layout.addWidget(self.abortControl)
+		self.layout.addLayout(self.previewLayout)
+		self.layout.addLayout(self.countingLayout)
+		self.layout.addLayout(self.calibrationLayout)
+		self.layout.addWidget(self.replicationStatus)
 		self.layout.addWidget(self.statusStatic)
 		self.layout.addWidget(self.statusEdit)
 
@@ -689,7 +935,8 @@ class CoolerControl(QtGui.QWidget):
 
 # Window for displaying images after they are acquired
 class ImageWindow(QtGui.QWidget):
-	data = []
+	# KRbFrameSet of the most recent acquisition
+	data = None
 
 	def __init__(self, Parent=None):
 		super(ImageWindow, self).__init__(Parent)
@@ -709,6 +956,40 @@ class ImageWindow(QtGui.QWidget):
 		# Frame select state
 		self.frameSelectState = [[(None,None), (None,None), (None,None)]]*KRBCAM_N_PLOT_SETTINGS
 
+		# Running statistics over shots
+		# Colorbar limits for the statistics images, keyed by (setting, frame, statistic)
+		self.stats = KRbPixelStats()
+		self.statLimits = {}
+
+		# Analysis ROI for each setting, and the latest results
+		self.roiState = [list(KRBCAM_DEFAULT_ROI) for i in range(KRBCAM_N_PLOT_SETTINGS)]
+		self.analysisResults = [None]*KRBCAM_N_PLOT_SETTINGS
+
+		# Single slot mailbox for the display
+		# Holds the latest completed frame set that has not been drawn yet
+		self.pendingData = None
+		self.redrawScheduled = False
+		self.lastRedraw = 0
+		self.redrawTimes = deque(maxlen=KRBCAM_DISPLAY_FPS_WINDOW)
+		self.droppedFrames = 0
+		self.maxFPS = KRBCAM_DISPLAY_MAX_FPS
+
+		# Current image on the canvas, reused if only the pixel values change
+		self.plotImage = None
+		self.plotState = None
+		self.plotData = None
+		self.plotOrigin = (0, 0)
+		self.previewFrameIndex = None
+
+		# Recent shots that can be shown again with the history slider
+		self.history = KRbShotHistory()
+
+		# Filmstrip items and preview paths of the shots in the history, by shot id
+		self.filmItems = {}
+		self.filmOrder = [] # Shot ids of the filmstrip items, in order
+		self.thumbPaths = {}
+		self.luts = {}
+
 		# Colormaps
 		self.colors = KRbCustomColors()
 		self.cmaps = [self.colors.whiteJet, self.colors.whiteMagma, self.colors.whitePlasma, plt.cm.jet]
@@ -722,11 +1003,128 @@ class ImageWindow(QtGui.QWidget):
 		a = self.gAcqLoopLength
 		fk = self.gFKSeriesLength
 		for f,w in zip(fss[0], self.frameSelectArray):
-			w.setCurrentIndex(f[0]*fk + f[1])
+			w.setCurrentIndex(self.comboIndex(f, fk, a))
 
 	def getFrameSelectState(self):
 		return self.frameSelectState
 
+	def setROIState(self, rois):
+		self.roiState = [list(r) for r in rois]
+		self.updateROIEdit()
+
+	def getROIState(self):
+		return self.roiState
+
+	def updateROIEdit(self):
+		setting = self.settingSelect.currentIndex()
+		self.roiEdit.setText(",".join([str(v) for v in self.roiState[setting]]))
+
+	# Read the ROI for the current setting from the text box
+	# Format is x,y,dx,dy in displayed pixels
+	def validateROI(self):
+		setting = self.settingSelect.currentIndex()
+		try:
+			roi = [int(v) for v in str(self.roiEdit.text()).split(',')]
+			if len(roi) != 4 or roi[2] <= 0 or roi[3] <= 0:
+				raise ValueError
+			self.roiState[setting] = roi
+		except ValueError:
+			msgBox = QtGui.QMessageBox()
+			msgBox.setText("Invalid entry for the analysis ROI.")
+			msgBox.setInformativeText("Please enter x,y,dx,dy (integers).")
+			msgBox.setStandardButtons(QtGui.QMessageBox.Ok)
+			msgBox.exec_()
+		self.updateROIEdit()
+
+	def analysisEnabled(self):
+		return self.analysisControl.isChecked()
+
+	def fringeRemovalEnabled(self):
+		return self.fringeControl.isChecked()
+
+	# Shadow, light and dark frames of a frame set for each setting
+	# Returns a list of (setting, key, (shadow, light, dark)) for the settings
+	# with a valid frame selection, key is the frame selection as a tuple
+	def getSettingFrames(self, data):
+		out = []
+		for setting in range(KRBCAM_N_PLOT_SETTINGS):
+			# Skip settings whose frames were never selected
+			fss = self.frameSelectState[setting]
+			if fss[0][0] is None:
+				continue
+			try:
+				frames = tuple([data.rawImage(i0, i1) for (i0, i1) in fss])
+			except IndexError:
+				continue
+			out.append((setting, self.frameKey(fss), frames))
+		return out
+
+	# Frame selection as a hashable key
+	def frameKey(self, fss):
+		return tuple([tuple(f) for f in fss])
+
+	# The light frame to use for the OD
+	# This is the fringe removal reference, if there is one
+	def getLightFrame(self, data, key, light):
+		return data.metadata.get('references', {}).get(key, light)
+
+	# Settings for the analysis of a frame set
+	# One entry for each setting with a valid shadow/light/dark selection
+	# See krb_analysis.analyzeShot
+	def getAnalysisSettings(self, data):
+		settings = []
+		config = data.metadata.get('config', {})
+
+		# Pixel size in the object plane
+		pixel = KRBCAM_PIXEL_SIZE / KRBCAM_MAGNIFICATION
+		if config.get('binning', False):
+			pixel *= KRBCAM_BIN_SIZE
+
+		for (setting, key, (shadow, light, dark)) in self.getSettingFrames(data):
+			settings.append({
+				'setting': setting,
+				'frames': (shadow, self.getLightFrame(data, key, light), dark),
+				'roi': data.localROI(self.roiState[setting]),
+				'origin': data.displayOrigin(),
+				'crossSection': KRBCAM_CROSS_SECTIONS[setting],
+				'pixelArea': pixel**2,
+				'accumulations': data.metadata.get('accumulations', 1),
+				'fitModel': str(self.fitSelect.currentText())
+			})
+		return settings
+
+	# Results from krb_analysis.analyzeShot
+	def setAnalysisResults(self, fileNumber, results):
+		for r in results:
+			r['fileNumber'] = fileNumber
+			self.analysisResults[r['setting']] = r
+		self.updateAnalysisLabel()
+
+	def updateAnalysisLabel(self):
+		r = self.analysisResults[self.settingSelect.currentIndex()]
+		if r is None:
+			self.analysisLabel.setText("No analysis")
+		elif r.has_key('error'):
+			self.analysisLabel.setText("Shot {}\nError: {}".format(r['fileNumber'], r['error']))
+		else:
+			text = "Shot {}\n".format(r['fileNumber'])
+			text += "N = {:.3g}\n".format(r['N'])
+			text += "Peak OD = {:.2f}\n".format(r['peakOD'])
+			text += "Center = ({:.1f}, {:.1f})\n".format(r['xc'], r['yc'])
+			text += "Sigma = ({:.1f}, {:.1f})".format(r['sx'], r['sy'])
+
+			f = r.get('fit', None)
+			if f is not None and f['error'] is not None:
+				text += "\n\n{} fit error: {}".format(f['model'], f['error'])
+			elif f is not None:
+				p = f['params']
+				text += "\n\n{} fit:\n".format(f['model'])
+				text += "N = {:.3g}\n".format(f['N'])
+				text += "Center = ({:.1f}, {:.1f})\n".format(p[1], p[2])
+				text += "Widths = ({:.1f}, {:.1f})\n".format(p[3], p[4])
+				text += "Fit time = {:.0f} ms".format(f['fitTime'] * 1e3)
+			self.analysisLabel.setText(text)
+
 	def imageRotated(self, rotate):
 		if rotate:
 			self.colorbarOrientation = 'vertical'
@@ -745,6 +1143,17 @@ class ImageWindow(QtGui.QWidget):
 					widget.addItem("{},{}".format(i, j))
 			widget.setCurrentIndex(0)
 
+		# The master dark can stand in for the dark frame
+		for j in range(numKin):
+			self.darkFrameSelect.addItem("M,{}".format(j))
+
+	# Combo box index of a frame selection
+	# The master dark entries come after the acquired frames
+	def comboIndex(self, f, numKin, acqLength):
+		if f[0] == KRBCAM_MASTER_DARK:
+			return acqLength*numKin + f[1]
+		return f[0]*numKin + f[1]
+
 	def controlComboBoxes(self, numKin, acqLength):
 		if self.gAcqLoopLength != acqLength or self.gFKSeriesLength != numKin:
 			self.gAcqLoopLength = acqLength
@@ -756,8 +1165,11 @@ class ImageWindow(QtGui.QWidget):
 		arr = []
 
 		for widget in self.frameSelectArray:
-			text = widget.currentText()
-			arr.append( (int(text.split(',')[0]), int(text.split(',')[1])) )
+			(i, j) = str(widget.currentText()).split(',')
+			if i == 'M':
+				arr.append( (KRBCAM_MASTER_DARK, int(j)) )
+			else:
+				arr.append( (int(i), int(j)) )
 
 		return arr
 
@@ -773,9 +1185,11 @@ class ImageWindow(QtGui.QWidget):
 			(i0, i1) = config[i]
 			widget = self.frameSelectArray[i]
 
-			index = i0*self.gFKSeriesLength + i1
+			index = self.comboIndex((i0, i1), self.gFKSeriesLength, self.gAcqLoopLength)
 			widget.setCurrentIndex(index)
 
+		self.updateROIEdit()
+		self.updateAnalysisLabel()
 		self.displayData()
 
 
@@ -813,11 +1227,43 @@ class ImageWindow(QtGui.QWidget):
 
 		self.darkFrameLabel = QtGui.QLabel("Dark")
 		self.darkFrameSelect = QtGui.QComboBox(self)
-		self.darkFrameSelect.setToolTip("K: (2,0); Rb: (2,1)")
+		self.darkFrameSelect.setToolTip("K: (2,0); Rb: (2,1); M: master dark")
 		self.darkFrameSelect.currentIndexChanged.connect(self.displayData)
 
 		self.frameSelectArray = [self.shadowFrameSelect, self.lightFrameSelect, self.darkFrameSelect]
 
+		self.roiLabel = QtGui.QLabel("ROI")
+		self.roiEdit = QtGui.QLineEdit(self)
+		self.roiEdit.setToolTip("x,y,dx,dy")
+		self.roiEdit.returnPressed.connect(self.validateROI)
+
+		self.analysisControl = QtGui.QCheckBox("Analyze ROI", self)
+		self.analysisControl.setChecked(KRBCAM_ANALYSIS_ENABLE)
+
+		self.fringeControl = QtGui.QCheckBox("Remove fringes", self)
+		self.fringeControl.setChecked(KRBCAM_FRINGE_ENABLE)
+		self.fringeControl.setToolTip("Light frame is rebuilt from recent light frames, masking the ROI")
+
+		self.statLabel = QtGui.QLabel("Statistic")
+		self.statSelect = QtGui.QComboBox(self)
+		self.statSelect.addItem("Shot")
+		self.statSelect.addItem("Mean")
+		self.statSelect.addItem("Std. dev.")
+		self.statSelect.setToolTip("Running statistics over shots since the last reset")
+		self.statSelect.currentIndexChanged.connect(self.displayData)
+
+		self.statResetButton = QtGui.QPushButton("Reset stats", self)
+		self.statResetButton.clicked.connect(self.resetStats)
+		self.statCountLabel = QtGui.QLabel("0 shots", self)
+
+		self.fitLabel = QtGui.QLabel("Fit")
+		self.fitSelect = QtGui.QComboBox(self)
+		for model in KRBCAM_FIT_MODELS:
+			self.fitSelect.addItem(model)
+
+		self.analysisLabel = QtGui.QLabel("No analysis", self)
+		self.analysisLabel.setAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop)
+
 		self.colorLabel = QtGui.QLabel("Colormap", self)
 		self.colorSelect = QtGui.QComboBox(self)
 		self.colorSelect.addItem("White Jet")
@@ -837,14 +1283,38 @@ class ImageWindow(QtGui.QWidget):
 		self.autoscaleButton = QtGui.QPushButton("Autoscale", self)
 		self.autoscaleButton.clicked.connect(self.autoscale)
 
+		self.displayStatus = QtGui.QLabel("Display: 0.0 fps, 0 dropped", self)
+
+		self.historyLabel = QtGui.QLabel("No shots", self)
+		self.historySlider = QtGui.QSlider(QtCore.Qt.Horizontal, self)
+		self.historySlider.setRange(0, 0)
+		self.historySlider.setToolTip("Show an earlier shot. New shots are shown again at the right end.")
+		self.historySlider.valueChanged.connect(self.showHistory)
+
+		self.filmstrip = QtGui.QListWidget(self)
+		self.filmstrip.setViewMode(QtGui.QListView.IconMode)
+		self.filmstrip.setFlow(QtGui.QListView.LeftToRight)
+		self.filmstrip.setWrapping(False)
+		self.filmstrip.setMovement(QtGui.QListView.Static)
+		self.filmstrip.setIconSize(QtCore.QSize(KRBCAM_THUMB_SIZE, KRBCAM_THUMB_SIZE/2))
+		self.filmstrip.setFixedHeight(KRBCAM_THUMB_SIZE/2 + 40)
+		self.filmstrip.setToolTip("Previews of the shots in the history, click one to show it")
+		self.filmstrip.itemClicked.connect(self.filmstripClicked)
+		self.filmstrip.horizontalScrollBar().valueChanged.connect(self.loadVisibleThumbs)
+		self.filmstrip.setVisible(KRBCAM_THUMB_ENABLE)
+
 		self.spacer = QtGui.QSpacerItem(1,1)
 
 		self.layout = QtGui.QGridLayout()
 
 		self.layout.addWidget(self.toolbar,0,0,1,6)
 		self.layout.addWidget(self.canvas,1,0,6,6)
+
+		self.layout.addWidget(self.historyLabel,7,0,1,2)
+		self.layout.addWidget(self.historySlider,7,2,1,4)
+		self.layout.addWidget(self.filmstrip,8,0,1,6)
 		
-		row = 8
+		row = 9
 		self.layout.addWidget(self.settingLabel, row, 0)
 		self.layout.addWidget(self.settingSelect, row, 1)
 		row += 1
@@ -865,7 +1335,32 @@ class ImageWindow(QtGui.QWidget):
 		self.layout.addWidget(self.darkFrameSelect, row, 1)
 		row += 1
 
-		row = 8
+		self.layout.addWidget(self.roiLabel, row, 0)
+		self.layout.addWidget(self.roiEdit, row, 1)
+		row += 1
+
+		self.layout.addWidget(self.fitLabel, row, 0)
+		self.layout.addWidget(self.fitSelect, row, 1)
+		row += 1
+
+		self.layout.addWidget(self.statLabel, row, 0)
+		self.layout.addWidget(self.statSelect, row, 1)
+		row += 1
+
+		self.layout.addWidget(self.statResetButton, row, 0)
+		self.layout.addWidget(self.statCountLabel, row, 1)
+		row += 1
+
+		row = 9
+		self.layout.addWidget(self.analysisControl, row, 2, 1, 2)
+		row += 1
+
+		self.layout.addWidget(self.fringeControl, row, 2, 1, 2)
+		row += 1
+
+		self.layout.addWidget(self.analysisLabel, row, 2, 5, 2)
+
+		row = 9
 		self.layout.addWidget(self.colorLabel,row,4)
 		self.layout.addWidget(self.colorSelect,row,5)
 		row += 1
@@ -879,6 +1374,9 @@ class ImageWindow(QtGui.QWidget):
 		row += 1
 
 		self.layout.addWidget(self.autoscaleButton,row,4,1,2)
+		row += 1
+
+		self.layout.addWidget(self.displayStatus,row,4,1,2)
 
 		# Try to make the layout look nice
 		for i in range(4):
@@ -888,14 +1386,21 @@ class ImageWindow(QtGui.QWidget):
 
 	def autoscale(self):
 		(setting, frame) = self.getConfig()
+		stat = self.statSelect.currentIndex()
 
-		if frame == 0:
+		if stat != 0:
+			image = self.getStatImage(setting, frame, stat)
+			if image is None:
+				return
+			low = np.percentile(image, KRBCAM_AUTOSCALE_PERCENTILES[0])
+			high = np.percentile(image, KRBCAM_AUTOSCALE_PERCENTILES[1])
+		elif frame == 0:
 			low = np.percentile(self.odFrames[setting], KRBCAM_AUTOSCALE_PERCENTILES[0])
 			high = np.percentile(self.odFrames[setting], KRBCAM_AUTOSCALE_PERCENTILES[1])
 		else:
 			(i0, i1) = self.getComboBoxState()[frame-1]
-			low = np.percentile(self.data[i0][i1], KRBCAM_AUTOSCALE_PERCENTILES[0])
-			high = np.percentile(self.data[i0][i1], KRBCAM_AUTOSCALE_PERCENTILES[1])
+			low = np.percentile(self.data.rawImage(i0, i1), KRBCAM_AUTOSCALE_PERCENTILES[0])
+			high = np.percentile(self.data.rawImage(i0, i1), KRBCAM_AUTOSCALE_PERCENTILES[1])
 
 		self.minEdit.setText(str(low))
 		self.maxEdit.setText(str(high))
@@ -903,7 +1408,7 @@ class ImageWindow(QtGui.QWidget):
 
 	# Display the data!
 	def displayData(self):
-		if self.data:
+		if self.data is not None:
 			try:
 				# Take the button states and determine what image the user wants to see
 				(setting, frame) = self.getConfig()
@@ -915,9 +1420,20 @@ class ImageWindow(QtGui.QWidget):
 
 			# Then try to plot the image
 			try:
+				stat = self.statSelect.currentIndex()
 
 				# Get the correct colorbar limits
-				if frame == 0:
+				if stat != 0:
+					image = self.getStatImage(setting, frame, stat)
+					if image is None:
+						return
+
+					# Statistics images start out autoscaled
+					key = (setting, frame, stat)
+					if not self.statLimits.has_key(key):
+						self.statLimits[key] = [np.percentile(image, p) for p in KRBCAM_AUTOSCALE_PERCENTILES]
+					lims = self.statLimits[key]
+				elif frame == 0:
 					lims = self.odLimits[setting]
 				else:
 					lims = self.countLimits[setting]
@@ -926,21 +1442,239 @@ class ImageWindow(QtGui.QWidget):
 				self.minEdit.setText(str(lims[0]))
 				self.maxEdit.setText(str(lims[1]))
 
-				if frame == 0:
+				# Images are kept in camera orientation,
+				# only the view that gets plotted is rotated
+				if stat != 0:
+					self.plot(self.data.orient(image), lims[0], lims[1], self.data.displayOrigin())
+				elif frame == 0:
 					self.odFrames[setting] = self.calcOD(self.getComboBoxState())
-					self.plot(self.odFrames[setting], lims[0], lims[1])
+					self.plot(self.data.orient(self.odFrames[setting]), lims[0], lims[1], self.data.displayOrigin())
 				else:
 					(i0, i1) = self.getComboBoxState()[frame-1]
-					self.plot(self.data[i0][i1], lims[0], lims[1])
+					self.plot(self.data.image(i0, i1), lims[0], lims[1], self.data.displayOrigin())
 				
 			# AttributeError will occur if no data collected, since
 			# then self.data is undefined
 			except Exception as e:
 				print e
 
-	def setData(self, data, kinFrames, acqLength):
-		self.controlComboBoxes(kinFrames, acqLength)
-		self.data = self.processData(data)
+	# Hand a completed frame set to the display
+	#
+	# Returns immediately, the image is drawn later at no more than
+	# self.maxFPS. If a newer frame set arrives before the old one
+	# was drawn, the old one is dropped from the display (it is still saved).
+	def postData(self, data):
+		# Shots with a file number go in the history
+		# While an older shot is shown, new ones are only added there
+		if data.metadata.has_key('shotId'):
+			live = self.historyLive()
+			self.history.add(data)
+			self.updateHistorySlider(live)
+			if not live:
+				return
+
+		if self.pendingData is not None:
+			self.droppedFrames += 1
+		self.pendingData = data
+
+		if not self.redrawScheduled:
+			self.redrawScheduled = True
+			wait = self.lastRedraw + 1.0/self.maxFPS - time.time()
+			QtCore.QTimer.singleShot(max(0, int(wait*1e3)), self.redraw)
+
+	# Draw whatever is in the mailbox
+	def redraw(self):
+		self.redrawScheduled = False
+		data = self.pendingData
+		self.pendingData = None
+		if data is None:
+			return
+
+		self.setData(data)
+		self.displayData()
+
+		self.lastRedraw = time.time()
+		self.redrawTimes.append(self.lastRedraw)
+		self.updateDisplayStatus()
+
+	# Is the history slider at the newest shot?
+	def historyLive(self):
+		return self.historySlider.value() == self.historySlider.maximum()
+
+	# Range of the history slider after a shot was added
+	# It stays at the newest shot if it was there
+	def updateHistorySlider(self, live):
+		n = len(self.history)
+		self.historySlider.blockSignals(True)
+		self.historySlider.setRange(0, max(n - 1, 0))
+		if live:
+			self.historySlider.setValue(n - 1)
+		self.historySlider.blockSignals(False)
+		self.updateHistoryLabel()
+		self.updateFilmstrip(live)
+
+	# Match the filmstrip to the shots in the history
+	# Previews are only loaded for the items that are in view
+	# Items are labeled with the file number
+	def updateFilmstrip(self, live):
+		shotIds = [self.history.shotId(i) for i in range(len(self.history))]
+		kept = [s for s in self.filmOrder if s in shotIds]
+		if kept != shotIds[:len(kept)]:
+			# A shot moved to the end, start over
+			self.filmstrip.clear()
+			self.filmItems = {}
+			kept = []
+		for shotId in [s for s in self.filmItems.keys() if s not in kept]:
+			item = self.filmItems.pop(shotId)
+			self.filmstrip.takeItem(self.filmstrip.row(item))
+		for shotId in shotIds[len(kept):]:
+			item = QtGui.QListWidgetItem(str(self.history.label(shotId)))
+			self.filmstrip.addItem(item)
+			self.filmItems[shotId] = item
+		self.filmOrder = shotIds
+
+		# Shot ids only go up, so previews of shots older than the history are done with
+		if shotIds:
+			for shotId in [s for s in self.thumbPaths.keys() if s < shotIds[0]]:
+				del self.thumbPaths[shotId]
+
+		if live and shotIds:
+			self.filmstrip.scrollToItem(self.filmItems[shotIds[-1]])
+		self.loadVisibleThumbs()
+
+	def loadVisibleThumbs(self):
+		view = self.filmstrip.viewport().rect()
+		for (shotId, item) in self.filmItems.items():
+			if item.icon().isNull() and self.thumbPaths.has_key(shotId) and \
+				self.filmstrip.visualItemRect(item).intersects(view):
+				item.setIcon(QtGui.QIcon(QtGui.QPixmap(self.thumbPaths[shotId])))
+
+	# The preview of a shot was written
+	# It can come before the shot is in the history, the path is kept until it is
+	def thumbnailReady(self, shotId, path):
+		self.thumbPaths[shotId] = path
+		if self.filmItems.has_key(shotId):
+			self.filmItems[shotId].setIcon(QtGui.QIcon())
+			self.loadVisibleThumbs()
+
+	def filmstripClicked(self, item):
+		position = self.history.position(self.filmOrder[self.filmstrip.row(item)])
+		if position is None:
+			return
+		if position == self.historySlider.value():
+			self.showHistory(position)
+		else:
+			self.historySlider.setValue(position)
+
+	# Lookup table of the current colormap, for the previews
+	def colormapLUT(self):
+		i = self.colorSelect.currentIndex()
+		if not self.luts.has_key(i):
+			self.luts[i] = krb_thumbs.colormapLUT(self.cmaps[i])
+		return self.luts[i]
+
+	def updateHistoryLabel(self):
+		n = len(self.history)
+		if n == 0:
+			self.historyLabel.setText("No shots")
+			return
+		fileNumber = self.history.fileNumber(self.historySlider.value())
+		if self.historyLive():
+			self.historyLabel.setText("Shot {} (newest)".format(fileNumber))
+		else:
+			self.historyLabel.setText("Shot {} ({} of {})".format(fileNumber, self.historySlider.value() + 1, n))
+
+	# Show a shot from the history
+	# Cached ODs are reused, so nothing is recalculated for a shot that was already shown
+	def showHistory(self, position):
+		if len(self.history) == 0:
+			return
+		self.updateHistoryLabel()
+		data = self.history.get(self.history.shotId(position))
+		if data is None:
+			self.historyLabel.setText("Shot {} is no longer available".format(self.history.fileNumber(position)))
+			return
+		self.pendingData = None
+		self.setData(data)
+		self.displayData()
+
+	# Update the display rate and dropped frame indicator
+	def updateDisplayStatus(self):
+		n = len(self.redrawTimes)
+		if n > 1 and self.redrawTimes[-1] > self.redrawTimes[0]:
+			fps = (n - 1)/(self.redrawTimes[-1] - self.redrawTimes[0])
+		else:
+			fps = 0
+		self.displayStatus.setText("Display: {:.1f} fps, {} dropped".format(fps, self.droppedFrames))
+
+	# Live preview shows single raw frames at a higher refresh rate
+	# The frame selection is restored when the preview is stopped
+	def previewMode(self, on):
+		if on:
+			self.maxFPS = KRBCAM_PREVIEW_MAX_FPS
+			self.previewFrameIndex = self.frameSelect.currentIndex()
+			self.previewState = (self.gFKSeriesLength, self.gAcqLoopLength, deepcopy(self.frameSelectState))
+			self.frameSelect.setCurrentIndex(1)
+		else:
+			self.maxFPS = KRBCAM_DISPLAY_MAX_FPS
+			if self.previewFrameIndex is not None:
+				# Put back the frame selection from before the preview
+				(numKin, acqLength, fss) = self.previewState
+				self.controlComboBoxes(numKin, acqLength)
+				self.frameSelectState = fss
+				setting = self.settingSelect.currentIndex()
+				if fss[setting][0][0] != None:
+					for (f, w) in zip(fss[setting], self.frameSelectArray):
+						w.setCurrentIndex(self.comboIndex(f, numKin, acqLength))
+				self.frameSelect.setCurrentIndex(self.previewFrameIndex)
+			self.previewFrameIndex = None
+		self.frameSelect.setDisabled(on)
+		self.resetDisplayStatus()
+
+	# Mean or standard deviation image over shots, in camera orientation
+	# frame is 0 for OD, otherwise the shadow/light/dark selection
+	# stat is 1 for the mean, 2 for the standard deviation
+	# Returns None if there aren't enough shots yet
+	def getStatImage(self, setting, frame, stat):
+		if frame == 0:
+			if stat == 1:
+				return self.stats.odMean(setting)
+			else:
+				return self.stats.odStd(setting)
+		else:
+			(i0, i1) = self.getComboBoxState()[frame-1]
+			# The master dark doesn't change from shot to shot
+			if i0 == KRBCAM_MASTER_DARK:
+				return None
+			if stat == 1:
+				return self.stats.frameMean(i0, i1)
+			else:
+				return self.stats.frameStd(i0, i1)
+
+	# Called after a frame set was added to the statistics
+	def statsUpdated(self):
+		self.statCountLabel.setText("{} shots".format(self.stats.count()))
+
+		# The shot view is updated through postData
+		if self.statSelect.currentIndex() != 0 and not self.redrawScheduled:
+			self.displayData()
+
+	def resetStats(self):
+		self.stats.reset()
+		self.statLimits = {}
+		self.statsUpdated()
+
+	# Called when a new acquisition is started by the user
+	def resetDisplayStatus(self):
+		self.droppedFrames = 0
+		self.redrawTimes.clear()
+		self.updateDisplayStatus()
+
+	# data is a KRbFrameSet
+	def setData(self, data):
+		self.controlComboBoxes(data.kinFrames, data.acqLength)
+		self.imageRotated(data.rotate)
+		self.data = data
 
 	# Validate the entered values in the min and max boxes
 	def validateLimits(self):
@@ -950,18 +1684,24 @@ class ImageWindow(QtGui.QWidget):
 			min_entry = float(self.minEdit.text())
 
 			(setting, frame) = self.getConfig()
+			stat = self.statSelect.currentIndex()
 
 			if max_entry < min_entry:
 				temp = min_entry
 				min_entry = max_entry
 				max_entry = temp
 
-			if frame != 0:
+			if frame != 0 and stat == 0:
 				max_entry = int(max_entry)
 				min_entry = int(min_entry)
 
 			# Update our od limits or count limits
-			if frame == 0:
+			if stat != 0:
+				if min_entry == max_entry:
+					max_entry += 0.1
+				self.statLimits[(setting, frame, stat)] = [min_entry, max_entry]
+
+			elif frame == 0:
 				if min_entry == max_entry:
 					max_entry += 0.1 # Avoid an issue with values pointing to each other
 				self.odLimits[setting] = [min_entry, max_entry]
@@ -999,71 +1739,68 @@ class ImageWindow(QtGui.QWidget):
 		(l0, l1) = config[1]
 		(d0, d1) = config[2]
 
-		shadow = self.data[s0][s1]
-		light = self.data[l0][l1]
-		dark = self.data[d0][d1]
-
-		with np.errstate(divide='ignore', invalid='ignore'):
-			od = np.log((light-dark).astype(float)/(shadow-dark).astype(float))
-			od += (light - shadow)/float(KRBCAM_C_SAT)
-			od[np.isnan(od)] = 0
-			od[np.isinf(od)] = 0
-			od[od > KRBCAM_OD_MAX] = KRBCAM_OD_MAX
-
-		return od
+		# Already calculated for this frame set
+		key = self.frameKey(config)
+		if self.data.odCache.has_key(key):
+			return self.data.odCache[key]
 
-	# Separate images, get OD image
-	def processData(self, data):
-		out = []
+		# OD is calculated in camera orientation
+		shadow = self.data.rawImage(s0, s1)
+		light = self.data.rawImage(l0, l1)
+		dark = self.data.rawImage(d0, d1)
 
-		# Data comes in as an array sorted by FK index
-		# with acquisition loop frames concatenated
-		# 
-		# We want to change the indices for convenience
-		for i in range(self.gAcqLoopLength):
-			arr = []
+		light = self.getLightFrame(self.data, key, light)
 
-			# Loop through kinetics frames
-			# and pull out the i-th acquisition loop frame
-			for j in range(self.gFKSeriesLength):
-				x = data[j]
-				(length, width) = np.shape(x)
+		od = krb_analysis.calcOD(shadow, light, dark, self.data.metadata.get('accumulations', 1))
+		self.data.odCache[key] = od
+		return od
 
-				length /= self.gAcqLoopLength
+	# Plot the data
+	# origin is the position of the image in the full readout region,
+	# so a cropped readout is drawn where it is on the camera
+	def plot(self, data, vmin, vmax, origin=(0, 0)):
+		color_index = self.colorSelect.currentIndex()
+		state = (np.shape(data), color_index, self.colorbarOrientation, tuple(origin))
 
-				arr.append(x[i*length:(i+1)*length])
+		# Data shown in the toolbar
+		self.plotData = data
+		self.plotOrigin = origin
 
-			out.append(arr)
+		# If only the pixel values changed, update the existing image
+		# This is much faster than redrawing the figure, e.g. for the live preview
+		if self.plotImage is not None and state == self.plotState:
+			self.plotImage.set_data(data)
+			self.plotImage.set_clim(vmin, vmax)
+			self.canvas.draw_idle()
+			return
 
-		# Now out should be a 2d array of data
-		# First index is acquisition loop frame
-		# Second index is FK frame
-		return out
+		self.plotState = state
 
-	# Plot the data
-	def plot(self, data, vmin, vmax):
 		# Clear plot
 		self.figure.clear()
 
 		# Plot the data
 		ax = self.figure.add_subplot(111)
-		color_index = self.colorSelect.currentIndex()
-		im = ax.imshow(data, vmin=vmin, vmax=vmax, cmap=self.cmaps[color_index])
+		(ny, nx) = np.shape(data)
+		(ox, oy) = origin
+		extent = (ox - 0.5, ox + nx - 0.5, oy + ny - 0.5, oy - 0.5)
+		im = ax.imshow(data, vmin=vmin, vmax=vmax, cmap=self.cmaps[color_index], extent=extent)
+		self.plotImage = im
 
 		# Add a horizontal colorbar
 		self.figure.colorbar(im, orientation=self.colorbarOrientation)
 
 		# Need to do the following to get the z data to show up in the toolbar
-		numrows, numcols = np.shape(data)
 		def format_coord(x, y):
-		    col = int(x + 0.5)
-		    row = int(y + 0.5)
+		    numrows, numcols = np.shape(self.plotData)
+		    col = int(x - self.plotOrigin[0] + 0.5)
+		    row = int(y - self.plotOrigin[1] + 0.5)
 		    if col >= 0 and col < numcols and row >= 0 and row < numrows:
-		        z = data[row, col]
+		        z = self.plotData[row, col]
 		        return '({:},{:}), z={:.2f}'.format(int(x),int(y),z)
 		    else:
 		        return 'x=%1.4f, y=%1.4f' % (x, y)
 		ax.format_coord = format_coord
 
 		# Update the plot
-		self.canvas.draw()
\ No newline at end of file
+		self.canvas.draw()
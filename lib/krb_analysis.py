@@ -0,0 +1,185 @@
+import multiprocessing
+
+import numpy as np
+
+from andor_helpers import *
+
+# Absorption OD from shadow, light and dark frames
+# Includes the saturation correction, and clips to KRBCAM_OD_MAX
+# Frames that are sums of several exposures are saturation corrected per exposure
+def calcOD(shadow, light, dark, accumulations=1):
+	with np.errstate(divide='ignore', invalid='ignore'):
+		od = np.log((light-dark).astype(float)/(shadow-dark).astype(float))
+		od += (light - shadow)/float(KRBCAM_C_SAT * accumulations)
+		od[np.isnan(od)] = 0
+		od[np.isinf(od)] = 0
+		od[od > KRBCAM_OD_MAX] = KRBCAM_OD_MAX
+
+	return od
+
+# Cut a (x, y, dx, dy) region out of an image
+# The region is clipped to the image bounds
+# Returns (subimage, x, y) where (x, y) is the corner actually used
+def cropROI(image, roi):
+	(height, width) = np.shape(image)
+	(x, y, dx, dy) = roi
+
+	x0 = min(max(int(x), 0), width)
+	y0 = min(max(int(y), 0), height)
+	x1 = min(max(int(x + dx), x0), width)
+	y1 = min(max(int(y + dy), y0), height)
+
+	return (image[y0:y1, x0:x1], x0, y0)
+
+# Integrated OD, centroid and second moments of an OD image in a ROI
+# Positions are in pixels of the full image
+# Atom number is sum(OD) * pixelArea / crossSection
+def roiMoments(od, roi, crossSection, pixelArea):
+	(sub, x0, y0) = cropROI(od, roi)
+
+	result = {
+		'roi': [x0, y0, np.shape(sub)[1], np.shape(sub)[0]],
+		'sumOD': 0.0,
+		'peakOD': 0.0,
+		'N': 0.0,
+		'xc': np.nan,
+		'yc': np.nan,
+		'sx': np.nan,
+		'sy': np.nan,
+		'sxy': np.nan
+	}
+	if sub.size == 0:
+		return result
+
+	total = float(np.sum(sub))
+	result['sumOD'] = total
+	result['peakOD'] = float(np.max(sub))
+	result['N'] = total * pixelArea / crossSection
+	if total <= 0:
+		return result
+
+	# Moments from the projections are much cheaper than using the full 2D grids
+	px = np.sum(sub, axis=0)
+	py = np.sum(sub, axis=1)
+	x = np.arange(len(px)) + x0
+	y = np.arange(len(py)) + y0
+
+	xc = np.dot(px, x) / total
+	yc = np.dot(py, y) / total
+	result['xc'] = xc
+	result['yc'] = yc
+
+	# Negative variances can happen for noisy images with little signal
+	varx = np.dot(px, (x - xc)**2) / total
+	vary = np.dot(py, (y - yc)**2) / total
+	result['sx'] = np.sqrt(varx) if varx > 0 else np.nan
+	result['sy'] = np.sqrt(vary) if vary > 0 else np.nan
+	result['sxy'] = np.dot(y - yc, np.dot(sub, x - xc)) / total
+
+	return result
+
+# Move the positions in an analysis result from the frames of a cropped readout
+# to the full readout region
+def shiftResult(result, origin):
+	(ox, oy) = origin
+	if ox == 0 and oy == 0:
+		return
+	result['xc'] += ox
+	result['yc'] += oy
+	result['roi'][0] += ox
+	result['roi'][1] += oy
+
+	fit = result.get('fit', None)
+	if fit is not None and fit.has_key('params'):
+		fit['params'][1] += ox
+		fit['params'][2] += oy
+		fit['x0'] += ox
+		fit['y0'] += oy
+
+# Analyze one shot
+# Runs in a worker process, so it only gets plain arrays and dicts
+#
+# settings is a list of dicts, one per imaging setting (e.g. K, Rb), with keys
+#  'setting': setting index
+#  'frames': (shadow, light, dark) arrays in camera orientation
+#  'roi': [x, y, dx, dy] in display orientation
+#  'crossSection': absorption cross section (m^2)
+#  'pixelArea': area of one (binned) pixel in the object plane (m^2)
+#  'fitModel': 'None' or a model in krb_fitting.fit_models
+#  'accumulations': number of exposures summed into each frame (optional)
+#  'origin': (x, y) display offset of the frames in the full readout region (optional)
+# Returns (fileNumber, list of result dicts)
+# If a fit was done, its result is under the 'fit' key
+def analyzeShot(fileNumber, rotate, settings):
+	# krb_fitting uses the ROI helpers from this file
+	import krb_fitting
+
+	results = []
+
+	for s in settings:
+		# An exception here would never make it back to the GUI,
+		# so pass it back as part of the result
+		try:
+			(shadow, light, dark) = s['frames']
+			od = calcOD(shadow, light, dark, s.get('accumulations', 1))
+			if rotate:
+				od = np.rot90(od, -1)
+
+			result = roiMoments(od, s['roi'], s['crossSection'], s['pixelArea'])
+
+			if s.get('fitModel', 'None') != 'None':
+				result['fit'] = krb_fitting.fitImage(od, s['roi'], s['fitModel'], s['crossSection'], s['pixelArea'])
+
+			shiftResult(result, s.get('origin', (0, 0)))
+		except Exception as e:
+			result = {'error': str(e)}
+		result['setting'] = s['setting']
+		results.append(result)
+
+	return (fileNumber, results)
+
+# analyzeShot for the worker processes
+# The pool only calls back for a result, an exception (e.g. importing krb_fitting)
+# is passed back as an error result for every setting, so the shot is still finished
+def analyzeShotInWorker(fileNumber, rotate, settings):
+	try:
+		return analyzeShot(fileNumber, rotate, settings)
+	except Exception as e:
+		return (fileNumber, [{'error': str(e), 'setting': s.get('setting')} for s in settings])
+
+# Runs analyzeShot in a pool of worker processes
+# Results are passed back to the reactor thread with reactor.callFromThread
+class KRbAnalysisPool:
+	def __init__(self, reactor, processes=KRBCAM_ANALYSIS_PROCESSES):
+		self.reactor = reactor
+		self.processes = processes
+		self.pool = None
+
+		# Number of shots submitted but not finished
+		self.pending = 0
+
+	# The worker processes are only started when they are first needed
+	def start(self):
+		if self.pool is None:
+			self.pool = multiprocessing.Pool(self.processes)
+
+	# Queue a shot for analysis
+	# callback(fileNumber, results) is called in the reactor thread when done
+	def submit(self, callback, fileNumber, rotate, settings):
+		self.start()
+
+		def done(ret):
+			self.reactor.callFromThread(self.finished, callback, ret)
+
+		self.pool.apply_async(analyzeShotInWorker, (fileNumber, rotate, settings), callback=done)
+		self.pending += 1
+
+	def finished(self, callback, ret):
+		self.pending -= 1
+		(fileNumber, results) = ret
+		callback(fileNumber, results)
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.terminate()
+			self.pool = None
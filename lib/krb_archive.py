@@ -0,0 +1,272 @@
+import os
+import struct
+import json
+import time
+
+import numpy as np
+
+from andor_helpers import *
+from krb_frames import KRbFrameSet
+
+# Append-only daily archive of frame sets
+#
+# One archive per save folder, next to the csv files. The data file is a fixed
+# header followed by one record per shot:
+#	record header (RECORD_HEADER), metadata as json, frames as little endian uint16
+# or, for frames that don't fit in uint16 (RECORD_MAGIC_INT32), int32,
+# with the metadata and frames each padded to 8 bytes, so the frames of any shot
+# can be memory mapped as an (acquisition, kinetics frame, row, column) array.
+#
+# The index file is an array of INDEX_DTYPE entries, one per shot, for finding
+# shots by file number or time without reading the data file.
+#
+# A shot is only written to the index after its record is on disk (fsync), and
+# readers only trust the index. If the program dies while writing, the partial
+# record or index entry is dropped the next time the archive is opened for writing.
+
+ARCHIVE_MAGIC = 'KRBARCH1'
+ARCHIVE_VERSION = 1
+FILE_HEADER = struct.Struct('<8sIId')		# magic, version, header size, creation time
+FILE_HEADER_SIZE = 64
+RECORD_MAGIC = 'KRBS'						# Frames are uint16
+RECORD_MAGIC_INT32 = 'KRBI'					# Frames are int32
+RECORD_TYPES = {RECORD_MAGIC: np.dtype('<u2'), RECORD_MAGIC_INT32: np.dtype('<i4')}
+RECORD_HEADER = struct.Struct('<4siqIIIII')	# magic, file number, timestamp (us), acq. length, kinetics frames, height, width, metadata length
+INDEX_DTYPE = np.dtype([('fileNumber', '<i8'), ('timestamp', '<f8'), ('offset', '<i8'), ('length', '<i8')])
+
+# Archive paths for a save folder
+def archivePath(savePath, filebase):
+	return savePath + filebase + KRBCAM_ARCHIVE_EXT
+
+def indexPath(path):
+	return os.path.splitext(path)[0] + KRBCAM_ARCHIVE_INDEX_EXT
+
+def padding(n):
+	return (-n) % 8
+
+# Frames as stored in the archive
+# uint16 if they fit, otherwise int32, e.g. after the master dark was subtracted
+# and the noise goes below 0, so a shot is stored exactly as it was saved
+def archiveFrames(frames):
+	if np.size(frames) == 0 or (np.min(frames) >= 0 and np.max(frames) <= np.iinfo(np.uint16).max):
+		return np.ascontiguousarray(frames, dtype='<u2')
+	return np.ascontiguousarray(frames, dtype='<i4')
+
+# Metadata that can go in the archive
+# numpy arrays and scalars become lists and numbers, anything else that json can't write is dropped
+def archiveMetadata(metadata):
+	def convert(value):
+		if isinstance(value, dict):
+			return dict([(str(k), convert(v)) for (k, v) in value.items()])
+		if isinstance(value, (list, tuple)):
+			return [convert(v) for v in value]
+		if hasattr(value, 'tolist'):
+			return value.tolist()
+		return value
+
+	meta = {}
+	for (key, value) in metadata.items():
+		value = convert(value)
+		try:
+			json.dumps(value)
+		except (TypeError, ValueError):
+			continue
+		meta[key] = value
+	return meta
+
+# Read the index entries of an archive
+# A partly written last entry is left out
+# The index is memory mapped unless copy is True, which doesn't keep the file open
+def readIndex(path, copy=False):
+	if not os.path.isfile(path):
+		return np.zeros(0, dtype=INDEX_DTYPE)
+	n = os.path.getsize(path) // INDEX_DTYPE.itemsize
+	if n == 0:
+		return np.zeros(0, dtype=INDEX_DTYPE)
+	if copy:
+		return np.fromfile(path, dtype=INDEX_DTYPE, count=n)
+	return np.memmap(path, dtype=INDEX_DTYPE, mode='r', shape=(n,))
+
+class KRbArchiveWriter:
+	def __init__(self, path):
+		self.path = path
+		self.indexPath = indexPath(path)
+
+		if not os.path.isfile(self.path):
+			with open(self.path, 'wb') as f:
+				header = FILE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, FILE_HEADER_SIZE, time.time())
+				f.write(header + '\0' * (FILE_HEADER_SIZE - len(header)))
+				f.flush()
+				os.fsync(f.fileno())
+			with open(self.indexPath, 'wb') as f:
+				pass
+		else:
+			checkHeader(self.path)
+
+		self.recover()
+		self.data = open(self.path, 'r+b')
+		self.index = open(self.indexPath, 'r+b')
+
+	# Drop anything written after the last complete shot
+	def recover(self):
+		if not os.path.isfile(self.indexPath):
+			open(self.indexPath, 'wb').close()
+
+		entries = readIndex(self.indexPath, copy=True)
+		dataSize = os.path.getsize(self.path)
+		valid = entries['offset'] + entries['length'] <= dataSize
+		n = len(entries) if np.all(valid) else int(np.argmin(valid))
+		end = FILE_HEADER_SIZE
+		if n:
+			end = int(entries['offset'][n - 1] + entries['length'][n - 1])
+
+		with open(self.indexPath, 'r+b') as f:
+			f.truncate(n * INDEX_DTYPE.itemsize)
+		with open(self.path, 'r+b') as f:
+			f.truncate(end)
+
+	def __len__(self):
+		return os.path.getsize(self.indexPath) // INDEX_DTYPE.itemsize
+
+	# Append one shot
+	# frames is (acquisition, kinetics frame, row, column) in camera orientation
+	# Returns the index entry that was written
+	def append(self, frames, fileNumber, metadata, timestamp=None):
+		if timestamp is None:
+			timestamp = time.time()
+		frames = archiveFrames(frames)
+		(acqLength, kinFrames, height, width) = np.shape(frames)
+		meta = json.dumps(archiveMetadata(metadata))
+
+		magic = RECORD_MAGIC if frames.dtype == RECORD_TYPES[RECORD_MAGIC] else RECORD_MAGIC_INT32
+		header = RECORD_HEADER.pack(magic, fileNumber, int(timestamp * 1e6),
+			acqLength, kinFrames, height, width, len(meta))
+		record = header + '\0' * padding(len(header)) + meta + '\0' * padding(len(meta))
+
+		self.data.seek(0, os.SEEK_END)
+		offset = self.data.tell()
+		self.data.write(record)
+		self.data.write(frames.tostring())
+		self.data.flush()
+		os.fsync(self.data.fileno())
+
+		# Only now is the shot in the archive
+		entry = np.array([(fileNumber, timestamp, offset, len(record) + frames.nbytes)], dtype=INDEX_DTYPE)
+		self.index.seek(0, os.SEEK_END)
+		self.index.write(entry.tostring())
+		self.index.flush()
+		os.fsync(self.index.fileno())
+		return entry[0]
+
+	def close(self):
+		self.data.close()
+		self.index.close()
+
+def checkHeader(path):
+	with open(path, 'rb') as f:
+		(magic, version, headerSize, created) = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+	if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+		raise IOError("{} is not a version {} frame archive".format(path, ARCHIVE_VERSION))
+	return created
+
+# Read only access to an archive
+# Frames are numpy views of the memory mapped data file, nothing is copied
+# until the frames are used. Call refresh() to see shots appended since opening.
+class KRbArchive:
+	def __init__(self, path):
+		self.path = path
+		self.created = checkHeader(path)
+		self.refresh()
+
+	def refresh(self):
+		self.index = readIndex(indexPath(self.path))
+		self.data = np.memmap(self.path, dtype=np.uint8, mode='r')
+
+		# A writer in another process may have an index entry ahead of what we mapped
+		end = self.index['offset'] + self.index['length']
+		if len(end) and end[-1] > len(self.data):
+			self.index = self.index[:int(np.searchsorted(end, len(self.data), side='right'))]
+
+	def __len__(self):
+		return len(self.index)
+
+	def fileNumbers(self):
+		return self.index['fileNumber']
+
+	def timestamps(self):
+		return self.index['timestamp']
+
+	# Position of the last shot with this file number, None if there isn't one
+	def find(self, fileNumber):
+		positions = np.nonzero(self.index['fileNumber'] == fileNumber)[0]
+		if len(positions) == 0:
+			return None
+		return int(positions[-1])
+
+	# Positions of the shots taken between two times (s since the epoch)
+	# Shots are appended in time order, so this is a binary search
+	def between(self, t0, t1):
+		times = self.index['timestamp']
+		return range(int(np.searchsorted(times, t0, side='left')), int(np.searchsorted(times, t1, side='right')))
+
+	# Record header of the shot at a position
+	def header(self, i):
+		offset = int(self.index['offset'][i])
+		(magic, fileNumber, timestamp, acqLength, kinFrames, height, width, metaLength) = \
+			RECORD_HEADER.unpack(self.data[offset:offset + RECORD_HEADER.size].tostring())
+		if not RECORD_TYPES.has_key(magic):
+			raise IOError("Bad record at offset {} of {}".format(offset, self.path))
+		return {
+			'dtype': RECORD_TYPES[magic],
+			'fileNumber': fileNumber,
+			'timestamp': timestamp * 1e-6,
+			'shape': (acqLength, kinFrames, height, width),
+			'metaOffset': offset + RECORD_HEADER.size + padding(RECORD_HEADER.size),
+			'metaLength': metaLength
+		}
+
+	def metadata(self, i):
+		h = self.header(i)
+		return json.loads(self.data[h['metaOffset']:h['metaOffset'] + h['metaLength']].tostring())
+
+	# Frames of the shot at a position, as a read only view
+	def frames(self, i):
+		h = self.header(i)
+		start = h['metaOffset'] + h['metaLength'] + padding(h['metaLength'])
+		end = start + h['dtype'].itemsize * int(np.prod(h['shape']))
+		return self.data[start:end].view(h['dtype']).reshape(h['shape'])
+
+	# Frame set of the shot at a position
+	# The frames are copied, so they can be calibrated and analyzed like new ones
+	def frameSet(self, i):
+		frames = self.frames(i)
+		meta = self.metadata(i)
+		(acqLength, kinFrames, height, width) = np.shape(frames)
+		frameSet = KRbFrameSet(acqLength, kinFrames, height, width, meta.get('rotate', False))
+		frameSet.frames[:] = frames
+		frameSet.nAcquired = acqLength
+		frameSet.origin = tuple(meta.get('origin', (0, 0)))
+		frameSet.fullShape = tuple(meta.get('fullShape', (height, width)))
+		frameSet.regionRows = meta.get('regionRows')
+		frameSet.metadata = meta
+		frameSet.metadata['archivePath'] = self.path
+		return frameSet
+
+	# (frames, metadata) of a shot by file number
+	def shot(self, fileNumber):
+		i = self.find(fileNumber)
+		if i is None:
+			raise KeyError("No shot {} in {}".format(fileNumber, self.path))
+		return (self.frames(i), self.metadata(i))
+
+	# (frames, metadata) of the shots at some positions, e.g. a slice of range(len(archive))
+	def shots(self, positions):
+		for i in positions:
+			yield (self.frames(i), self.metadata(i))
+
+# Next file number after the shots in an archive, 0 if there is no archive
+def nextFileNumber(path):
+	entries = readIndex(indexPath(path), copy=True)
+	if len(entries) == 0:
+		return 0
+	return int(np.max(entries['fileNumber'])) + 1
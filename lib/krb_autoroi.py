@@ -0,0 +1,129 @@
+from collections import deque
+
+import numpy as np
+
+from andor_helpers import *
+
+# Bounding box of the cloud in an OD image
+# The OD is block averaged first, so single noisy pixels don't count.
+# Returns [x, y, dx, dy] in pixels of the image, or None if there is no clear cloud
+def locateCloud(od, threshold=KRBCAM_AUTOROI_THRESHOLD, block=KRBCAM_AUTOROI_BLOCK):
+	(ny, nx) = np.shape(od)
+	ny -= ny % block
+	nx -= nx % block
+	if ny == 0 or nx == 0:
+		return None
+	small = od[:ny, :nx].reshape(ny // block, block, nx // block, block).mean(axis=3).mean(axis=1)
+
+	background = np.median(small)
+	noise = 1.4826 * np.median(np.abs(small - background))
+	peak = np.max(small)
+	if peak - background < KRBCAM_AUTOROI_MIN_SNR * max(noise, 1e-6):
+		return None
+
+	mask = small > background + threshold * (peak - background)
+	rows = np.nonzero(np.any(mask, axis=1))[0]
+	cols = np.nonzero(np.any(mask, axis=0))[0]
+	return [cols[0] * block, rows[0] * block, (cols[-1] - cols[0] + 1) * block, (rows[-1] - rows[0] + 1) * block]
+
+# Automatic readout region around the atoms
+#
+# Clouds are located in the OD of each shot, and the readout is cropped to the
+# recent clouds plus some padding. Coordinates are binned camera pixels relative
+# to the full readout region set in the config form.
+#
+# Every KRBCAM_AUTOROI_FULL_FRAME_EVERY series, or when the cloud is lost or gets
+# close to the edge of the crop, a full frame is taken to find it again.
+class KRbAutoROI:
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.crop = None # [x, y, dx, dy], None for the full region
+		self.fullShape = None
+		self.boxes = deque(maxlen=KRBCAM_AUTOROI_HISTORY)
+		self.seriesSinceFull = 0
+		self.lost = True
+
+	# Add the cloud boxes found in the frames of one series
+	# boxes are in the frames' pixels, origin is the (x, y) offset of the frames in the full region
+	def addShot(self, boxes, origin, fullShape):
+		if fullShape != self.fullShape:
+			self.reset()
+			self.fullShape = fullShape
+
+		boxes = [b for b in boxes if b is not None]
+		if not boxes:
+			self.lost = True
+			return
+
+		x0 = min([b[0] for b in boxes]) + origin[0]
+		y0 = min([b[1] for b in boxes]) + origin[1]
+		x1 = max([b[0] + b[2] for b in boxes]) + origin[0]
+		y1 = max([b[1] + b[3] for b in boxes]) + origin[1]
+		self.boxes.append((x0, y0, x1, y1))
+
+		# Lost if the cloud touches the edge of the crop, it may have moved out of it
+		self.lost = False
+		if self.crop is not None:
+			(cx, cy, cw, ch) = self.crop
+			margin = KRBCAM_AUTOROI_BLOCK
+			if (x0 - cx < margin and cx > 0) or (y0 - cy < margin and cy > 0) or \
+				(cx + cw - x1 < margin and cx + cw < fullShape[1]) or (cy + ch - y1 < margin and cy + ch < fullShape[0]):
+				self.lost = True
+
+	# Crop for the next series, None for the full region
+	# fullWidth is True for fast kinetics, where only rows can be cropped
+	def nextCrop(self, fullShape, fullWidth=False):
+		if fullShape != self.fullShape or self.lost or not self.boxes or \
+			self.seriesSinceFull + 1 >= KRBCAM_AUTOROI_FULL_FRAME_EVERY:
+			self.seriesSinceFull = 0
+			self.crop = None
+			return None
+
+		self.seriesSinceFull += 1
+		(height, width) = fullShape
+
+		# Union of the recent clouds
+		x0 = min([b[0] for b in self.boxes])
+		y0 = min([b[1] for b in self.boxes])
+		x1 = max([b[2] for b in self.boxes])
+		y1 = max([b[3] for b in self.boxes])
+		padx = max(int(KRBCAM_AUTOROI_PADDING * (x1 - x0)), KRBCAM_AUTOROI_MIN_PADDING)
+		pady = max(int(KRBCAM_AUTOROI_PADDING * (y1 - y0)), KRBCAM_AUTOROI_MIN_PADDING)
+
+		# Keep the current crop while the clouds are well inside it and it isn't much too big,
+		# so the image size doesn't change every shot
+		if self.crop is not None:
+			(cx, cy, cw, ch) = self.crop
+			inside = cx <= max(x0 - padx/2, 0) and cy <= max(y0 - pady/2, 0) and \
+				cx + cw >= min(x1 + padx/2, width) and cy + ch >= min(y1 + pady/2, height)
+			if inside and cw * ch <= 2 * (x1 - x0 + 2*padx) * (y1 - y0 + 2*pady):
+				return self.crop
+
+		x0 = max(x0 - padx, 0)
+		y0 = max(y0 - pady, 0)
+		x1 = min(x1 + padx, width)
+		y1 = min(y1 + pady, height)
+		if fullWidth:
+			(x0, x1) = (0, width)
+
+		self.crop = [x0, y0, x1 - x0, y1 - y0]
+		return self.crop
+
+	# Config for a cropped readout
+	# crop is in binned pixels, the config is in unbinned pixels
+	# The region that was cropped is kept in config['uncropped']
+	def cropConfig(self, config, crop):
+		config = dict(config)
+		config['uncropped'] = dict([(k, config[k]) for k in ['xOffset', 'yOffset', 'dx', 'dy']])
+		if config['binning']:
+			binning = KRBCAM_BIN_SIZE
+		else:
+			binning = 1
+		(x, y, dx, dy) = crop
+		config['xOffset'] += x * binning
+		config['yOffset'] += y * binning
+		config['dx'] = dx * binning
+		config['dy'] = dy * binning
+		return config
@@ -0,0 +1,157 @@
+import os
+import time
+
+import numpy as np
+
+from andor_helpers import *
+
+PATH_TO_CALIBRATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration")
+
+# Name of the calibration for a camera configuration
+# The dark level and hot pixels depend on the readout settings, exposure time and
+# temperature, and the dark is only good for the part of the sensor it was taken on
+# A readout cropped by the auto ROI uses the master dark of the region it was cropped
+# from, the part it needs is found with the frame set's origin
+def calibrationKey(config, temperature):
+	if config['emEnable']:
+		amp = "em{}".format(config['emGain'])
+	else:
+		amp = "conv"
+	region = config.get('uncropped', config)
+	return "{}_ad{}_hss{}_vss{}_pa{}_bin{}_exp{:g}_x{}_y{}_T{}".format(amp, config['adChannel'], config['hss'],
+		config['vss'], config['preAmpGain'], int(bool(config['binning'])), float(config['expTime']),
+		region['xOffset'], region['yOffset'], temperature)
+
+# Master dark and bad pixel mask for one camera configuration
+#
+# Built from a series of dark frames: the master dark is their median, hot pixels
+# are far above the rest of the master dark, and dead (stuck) pixels don't change
+# between darks. Frames are (kinetics frame, row, column) like a single shot.
+class KRbCalibration:
+	def __init__(self):
+		self.key = None
+		self.shape = None
+		self.master = None # Master dark, rounded to integers
+		self.mask = None # True for hot/dead pixels
+		self.badPixels = None # Indices of the bad pixels
+		self.nDarks = 0
+
+		# Darks being recorded
+		self.recording = 0
+		self.darks = []
+
+	def ready(self):
+		return self.master is not None
+
+	def path(self, key):
+		return os.path.join(PATH_TO_CALIBRATION, key + ".npz")
+
+	# Use the calibration for this configuration and frame shape, if there is one
+	# Returns True if a calibration was loaded
+	def select(self, key, shape):
+		if key == self.key and shape == self.shape and self.ready():
+			return True
+
+		# Darks from a different configuration can't go into the same master dark
+		if key != self.key or shape != self.shape:
+			self.darks = []
+
+		self.key = key
+		self.shape = shape
+		self.master = None
+		self.mask = None
+		self.badPixels = None
+
+		path = self.path(key)
+		if not os.path.isfile(path):
+			return False
+
+		f = np.load(path)
+		if tuple(f['master'].shape) != tuple(shape):
+			return False
+		self.setCalibration(f['master'], f['mask'], int(f['nDarks']))
+		return True
+
+	def setCalibration(self, master, mask, nDarks):
+		self.master = np.asarray(master, dtype=np.int32)
+		self.mask = np.asarray(mask, dtype=bool)
+		self.badPixels = np.nonzero(self.mask)
+		self.nDarks = nDarks
+
+	# Start collecting n darks
+	def startRecording(self, n=KRBCAM_DARK_COUNT):
+		self.recording = n
+		self.darks = []
+
+	def stopRecording(self):
+		self.recording = 0
+		self.darks = []
+
+	# Add a dark frame while recording
+	# Returns True when enough darks were collected and the calibration was built and saved
+	def addDark(self, dark):
+		if not self.recording:
+			return False
+
+		self.darks.append(np.array(dark, dtype=np.int32))
+		if len(self.darks) < self.recording:
+			return False
+
+		self.build(np.array(self.darks))
+		self.save()
+		self.stopRecording()
+		return True
+
+	# Build the master dark and bad pixel mask from a (n, kinetics frame, row, column) stack
+	def build(self, darks):
+		master = np.median(darks, axis=0)
+
+		# Hot pixels: far above the typical dark level of their frame,
+		# using the median absolute deviation as a robust width
+		level = np.median(master, axis=(1, 2), keepdims=True)
+		mad = np.median(np.abs(master - level), axis=(1, 2), keepdims=True)
+		hot = master - level > KRBCAM_HOT_PIXEL_THRESHOLD * np.maximum(1.4826 * mad, 1)
+
+		# Dead or stuck pixels: no noise at all
+		dead = np.all(darks == darks[0], axis=0)
+
+		self.shape = tuple(master.shape)
+		self.setCalibration(np.round(master), hot | dead, len(darks))
+
+	def save(self):
+		if not os.path.isdir(PATH_TO_CALIBRATION):
+			os.makedirs(PATH_TO_CALIBRATION)
+		np.savez(self.path(self.key), master=self.master, mask=self.mask, nDarks=self.nDarks, time=time.time())
+
+	# Master dark for part of the frame, when the readout is cropped
+	# origin is the (x, y) offset of the images in the calibrated frame
+	def dark(self, origin, shape):
+		(x, y) = origin
+		return self.master[:, y:y + shape[1], x:x + shape[2]]
+
+	# Subtract the master dark and repair bad pixels, in place
+	# images is (kinetics frame, row, column) from one shot
+	def apply(self, images, origin=(0, 0)):
+		np.subtract(images, self.dark(origin, np.shape(images)), out=images, casting='unsafe')
+		self.repair(images, origin)
+
+	# Replace the bad pixels with the median of their 8 neighbours
+	def repair(self, images, origin=(0, 0)):
+		if self.badPixels is None or len(self.badPixels[0]) == 0:
+			return
+
+		# Bad pixels inside the images
+		(k, y, x) = self.badPixels
+		y = y - origin[1]
+		x = x - origin[0]
+		inside = (y >= 0) & (y < np.shape(images)[1]) & (x >= 0) & (x < np.shape(images)[2])
+		(k, y, x) = (k[inside], y[inside], x[inside])
+		padded = np.pad(images, ((0, 0), (1, 1), (1, 1)), mode='edge')
+		neighbours = [padded[k, y + 1 + dy, x + 1 + dx] for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+		images[k, y, x] = np.median(neighbours, axis=0)
+
+	# Summary for the status log
+	def describe(self):
+		if not self.ready():
+			return "No calibration for {}.".format(self.key)
+		return "Calibration {}: master dark of {} frames, {} bad pixels.".format(self.key, self.nDarks, int(np.sum(self.mask)))
@@ -0,0 +1,213 @@
+import os
+import sys
+import time
+import json
+import sqlite3
+import threading
+import datetime
+
+import numpy as np
+
+from andor_helpers import *
+
+# Columns of the shots table, after the id
+# The settings are copied out of the config so they can be searched, the full
+# validated config is kept as json
+COLUMNS = [
+	('path', 'TEXT'),				# Saved file (csv, or the frame archive)
+	('fileNumber', 'INTEGER'),
+	('timestamp', 'REAL'),			# s since the epoch
+	('acqMode', 'INTEGER'),
+	('kinFrames', 'INTEGER'),
+	('acqLength', 'INTEGER'),
+	('nAcc', 'INTEGER'),
+	('expTime', 'REAL'),			# ms, as set
+	('emEnable', 'INTEGER'),
+	('emGain', 'INTEGER'),
+	('adChannel', 'INTEGER'),
+	('hss', 'INTEGER'),
+	('vss', 'INTEGER'),
+	('preAmpGain', 'INTEGER'),
+	('binning', 'INTEGER'),
+	('xOffset', 'INTEGER'),
+	('yOffset', 'INTEGER'),
+	('dx', 'INTEGER'),
+	('dy', 'INTEGER'),
+	('exposure', 'REAL'),			# s, real timings from the camera
+	('kineticCycle', 'REAL'),
+	('readout', 'REAL'),
+	('temperature', 'REAL'),		# CCD temperature (C)
+	('countsMean', 'REAL'),			# Quick statistics of the raw frames
+	('countsMax', 'REAL'),
+	('peakOD', 'REAL'),				# Largest peak OD of the analysis ROIs, when analyzed
+	('atomNumber', 'TEXT'),			# Atom number in the ROI of each setting, as a json list
+	('region', 'TEXT'),				# Saved region as json [x, y, width, height] (see KRbFrameSet.regionInfo), NULL for full frames
+	('config', 'TEXT')
+]
+COLUMN_NAMES = [c[0] for c in COLUMNS]
+SETTING_COLUMNS = ['acqMode', 'kinFrames', 'acqLength', 'nAcc', 'expTime', 'emEnable', 'emGain', 'adChannel',
+	'hss', 'vss', 'preAmpGain', 'binning', 'xOffset', 'yOffset', 'dx', 'dy']
+
+# Seconds since the epoch for a datetime, or a number that already is
+def epochTime(t):
+	if isinstance(t, datetime.datetime):
+		return time.mktime(t.timetuple()) + t.microsecond * 1e-6
+	return float(t)
+
+# Catalog of saved shots in a local SQLite database
+#
+# Shots and analysis results are queued from the GUI thread, and written in one
+# transaction per flush(), which runs in a thread. The quick statistics of the
+# frames are also calculated there.
+class KRbCatalog:
+	def __init__(self, path=KRBCAM_CATALOG_PATH):
+		self.path = path
+		self.lock = threading.Lock()
+		self.queue = []
+
+		db = self.connect()
+		with db:
+			db.execute("CREATE TABLE IF NOT EXISTS shots (id INTEGER PRIMARY KEY, " +
+				", ".join(["{} {}".format(name, typ) for (name, typ) in COLUMNS]) + ")")
+			# Columns added since the catalog was made
+			existing = [row['name'] for row in db.execute("PRAGMA table_info(shots)")]
+			for (name, typ) in COLUMNS:
+				if name not in existing:
+					db.execute("ALTER TABLE shots ADD COLUMN {} {}".format(name, typ))
+			db.execute("CREATE INDEX IF NOT EXISTS shotsTime ON shots (timestamp)")
+			db.execute("CREATE INDEX IF NOT EXISTS shotsFile ON shots (path, fileNumber)")
+			db.execute("CREATE INDEX IF NOT EXISTS shotsGain ON shots (emGain, timestamp)")
+		db.close()
+
+	def connect(self):
+		d = os.path.dirname(self.path)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+		db = sqlite3.connect(self.path, timeout=10)
+		db.row_factory = sqlite3.Row
+		return db
+
+	def pending(self):
+		with self.lock:
+			return len(self.queue)
+
+	# Queue a saved shot
+	# frames (those that were saved) is only used for the quick statistics, timings are
+	# from KRbiXon.timings, region is where the saved frames are if they aren't the full frame
+	def addShot(self, path, fileNumber, config, timings, temperature, frames, timestamp=None, region=None):
+		if timestamp is None:
+			timestamp = time.time()
+		row = dict([(k, config.get(k)) for k in SETTING_COLUMNS])
+		row['nAcc'] = accumulations(config)
+		row['acqMode'] = acquisitionMode(config)
+		row.update({
+			'path': path,
+			'fileNumber': fileNumber,
+			'timestamp': timestamp,
+			'exposure': timings.get('exposure'),
+			'kineticCycle': timings.get('kinetic'),
+			'readout': timings.get('readout'),
+			'temperature': temperature,
+			'region': json.dumps(region) if region is not None else None,
+			'config': json.dumps(config, default=str)
+		})
+		with self.lock:
+			self.queue.append(('insert', row, frames))
+
+	# Queue the analysis results of a shot (see krb_analysis.analyzeShot)
+	# They go with the last shot cataloged with that path and file number, file
+	# numbers alone repeat from day to day
+	def addAnalysis(self, path, fileNumber, results):
+		results = [r for r in results if not r.has_key('error')]
+		if not results:
+			return
+		values = {
+			'peakOD': max([float(r['peakOD']) for r in results]),
+			'atomNumber': json.dumps([float(r['N']) for r in results])
+		}
+		with self.lock:
+			self.queue.append(('analysis', (path, fileNumber), values))
+
+	# Write everything queued, in one transaction
+	# If it fails (e.g. the database stays locked by a reader), nothing was written
+	# and the entries go back on the queue for the next flush
+	# Returns the number of queued entries written
+	def flush(self):
+		with self.lock:
+			(queue, self.queue) = (self.queue, [])
+		if not queue:
+			return 0
+
+		try:
+			self.write(queue)
+		except Exception:
+			with self.lock:
+				self.queue[:0] = queue
+			raise
+		return len(queue)
+
+	def write(self, queue):
+		db = self.connect()
+		try:
+			with db:
+				for (action, key, value) in queue:
+					if action == 'insert':
+						row = dict(key)
+						row['countsMean'] = float(np.mean(value))
+						row['countsMax'] = float(np.max(value))
+						names = [c for c in COLUMN_NAMES if row.has_key(c)]
+						db.execute("INSERT INTO shots ({}) VALUES ({})".format(", ".join(names), ", ".join(["?"]*len(names))),
+							[row[c] for c in names])
+					else:
+						db.execute("UPDATE shots SET peakOD = ?, atomNumber = ? WHERE id = " +
+							"(SELECT MAX(id) FROM shots WHERE path = ? AND fileNumber = ?)",
+							(value['peakOD'], value['atomNumber']) + key)
+		finally:
+			db.close()
+
+	# Rows of an SQL query, as dicts
+	def query(self, sql, params=()):
+		db = self.connect()
+		try:
+			return [dict(row) for row in db.execute(sql, params)]
+		finally:
+			db.close()
+
+	# Shots taken between start and end (datetimes or s since the epoch) with the given
+	# settings, and at least minPeakOD if given, oldest first
+	# e.g. find(yesterday, today, minPeakOD=2, emGain=100)
+	def find(self, start=None, end=None, minPeakOD=None, **settings):
+		where = []
+		params = []
+		if start is not None:
+			where.append("timestamp >= ?")
+			params.append(epochTime(start))
+		if end is not None:
+			where.append("timestamp < ?")
+			params.append(epochTime(end))
+		if minPeakOD is not None:
+			where.append("peakOD >= ?")
+			params.append(minPeakOD)
+		for (name, value) in settings.items():
+			if name not in COLUMN_NAMES:
+				raise KeyError("No column {} in the shot catalog".format(name))
+			where.append("{} = ?".format(name))
+			params.append(value)
+
+		sql = "SELECT * FROM shots"
+		if where:
+			sql += " WHERE " + " AND ".join(where)
+		return self.query(sql + " ORDER BY timestamp", params)
+
+# List the shots of the last day with some settings
+# e.g. python lib/krb_catalog.py emGain=100 minPeakOD=2
+if __name__ == "__main__":
+	args = dict([a.split('=', 1) for a in sys.argv[1:]])
+	args = dict([(k, float(v)) for (k, v) in args.items()])
+	now = datetime.datetime.now()
+	t0 = time.time()
+	rows = KRbCatalog().find(now - datetime.timedelta(days=1), now, **args)
+	t1 = time.time()
+	for row in rows:
+		print "{}\t{}\t{}\tpeak OD {}".format(datetime.datetime.fromtimestamp(row['timestamp']), row['fileNumber'], row['path'], row['peakOD'])
+	print "{} shots in {:.1f} ms".format(len(rows), (t1 - t0) * 1e3)
@@ -0,0 +1,191 @@
+import os
+import bz2
+import json
+import time
+import zlib
+import struct
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from andor_helpers import *
+from krb_archive import archiveMetadata
+
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+# Losslessly compressed shot files
+#
+# One file per shot: a header (FILE_HEADER), the metadata as json, a table of
+# (offset, length) for each chunk, then the chunks. Each chunk is one image
+# (acquisition, kinetics frame) in camera orientation, so a viewer can decode a
+# single image without the rest of the shot.
+#
+# Before compressing, each image goes through a filter:
+#	shuffle:	all the low bytes, then the high bytes, ... The high bytes of a
+#				background barely change, so they compress to almost nothing
+#	delta:		each pixel minus the one to its left (wrapping around, so nothing
+#				is lost), then shuffle. Better for smooth frames with little noise,
+#				worse for shot noise limited ones, since it doubles the noise
+# The images are compressed in parallel by a pool of threads, the codecs let go
+# of the GIL while they work.
+
+COMPRESS_MAGIC = 'KRBZ'
+COMPRESS_VERSION = 1
+FILE_HEADER = struct.Struct('<4sI8s8sIIIIIII')	# magic, version, codec, filter, acq. length, kinetics frames, height, width, item size, signed, metadata length
+FILTERS = ['shuffle', 'delta']
+CHUNK_ENTRY = struct.Struct('<qq')			# offset, length
+
+# name: (compress(data, level), decompress(data))
+codecs = {
+	'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+	'bz2': (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress),
+	'none': (lambda data, level: data, lambda data: data)
+}
+if lzma is not None:
+	codecs['lzma'] = (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+
+pool = None
+poolLock = threading.Lock()
+
+def getPool():
+	global pool
+	with poolLock:
+		if pool is None:
+			pool = ThreadPool(KRBCAM_COMPRESS_THREADS)
+		return pool
+
+# Smallest integer type that holds the frames exactly
+def storageType(frames):
+	if np.size(frames) == 0 or (np.min(frames) >= 0 and np.max(frames) <= np.iinfo(np.uint16).max):
+		return np.dtype('<u2')
+	return np.dtype('<i4')
+
+# Filter an image, and undo it
+# image is a 2D array of storage type, the differences are taken as unsigned so they wrap around
+def filterImage(image, filt):
+	u = np.ascontiguousarray(image).view(image.dtype.str.replace('i', 'u'))
+	if filt == 'delta':
+		u = u.copy()
+		u[:, 1:] -= image.view(u.dtype)[:, :-1]
+	return u.view(np.uint8).reshape((-1, u.dtype.itemsize)).T.tostring()
+
+def unfilterImage(data, filt, dtype, shape):
+	dtype = np.dtype(dtype)
+	u = np.fromstring(data, dtype=np.uint8).reshape((dtype.itemsize, -1)).T.copy()
+	u = u.view(dtype.str.replace('i', 'u')).reshape(shape)
+	if filt == 'delta':
+		u = np.cumsum(u, axis=1, dtype=u.dtype)
+	return u.view(dtype)
+
+def encodeImage(args):
+	(image, codec, level, filt) = args
+	return codecs[codec][0](filterImage(image, filt), level)
+
+# Compress frames (acquisition, kinetics frame, row, column) and metadata
+# Returns the contents of the file
+def encodeShot(frames, metadata, codec=KRBCAM_COMPRESS_CODEC, level=KRBCAM_COMPRESS_LEVEL, filt=KRBCAM_COMPRESS_FILTER):
+	if not codecs.has_key(codec):
+		raise ValueError("Codec {} isn't available".format(codec))
+	if filt not in FILTERS:
+		raise ValueError("No filter {}".format(filt))
+	dtype = storageType(frames)
+	stored = np.ascontiguousarray(frames, dtype=dtype)
+	(acqLength, kinFrames, height, width) = np.shape(stored)
+	images = [stored[i, j] for i in range(acqLength) for j in range(kinFrames)]
+	chunks = getPool().map(encodeImage, [(image, codec, level, filt) for image in images])
+
+	meta = json.dumps(archiveMetadata(metadata))
+	header = FILE_HEADER.pack(COMPRESS_MAGIC, COMPRESS_VERSION, codec, filt, acqLength, kinFrames, height, width,
+		dtype.itemsize, int(dtype.kind == 'i'), len(meta))
+	offset = len(header) + len(meta) + CHUNK_ENTRY.size * len(chunks)
+	table = []
+	for chunk in chunks:
+		table.append(CHUNK_ENTRY.pack(offset, len(chunk)))
+		offset += len(chunk)
+	return header + meta + ''.join(table) + ''.join(chunks)
+
+# Write a compressed shot, under a temporary name first so nobody reads a partial file
+# An existing shot is never overwritten, that raises an IOError
+# Returns (bytes written, seconds spent compressing)
+def writeShot(path, frames, metadata, codec=KRBCAM_COMPRESS_CODEC, level=KRBCAM_COMPRESS_LEVEL, filt=KRBCAM_COMPRESS_FILTER):
+	if os.path.exists(path):
+		raise IOError("{} already exists".format(path))
+	t0 = time.time()
+	data = encodeShot(frames, metadata, codec, level, filt)
+	t1 = time.time()
+	temp = path + "_temp"
+	with open(temp, 'wb') as f:
+		f.write(data)
+	os.rename(temp, path)
+	return (len(data), t1 - t0)
+
+# Read access to a compressed shot
+# Only the header and chunk table are read on opening, images are decoded when asked for
+class KRbCompressedShot:
+	def __init__(self, path):
+		self.path = path
+		with open(path, 'rb') as f:
+			fields = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+			(magic, version, codec, filt, acqLength, kinFrames, height, width, itemSize, signed, metaLength) = fields
+			if magic != COMPRESS_MAGIC or version != COMPRESS_VERSION:
+				raise IOError("{} is not a version {} compressed shot".format(path, COMPRESS_VERSION))
+			self.codec = codec.rstrip('\0')
+			self.filter = filt.rstrip('\0')
+			if not codecs.has_key(self.codec):
+				raise IOError("{} needs the {} codec, which isn't available".format(path, self.codec))
+			self.shape = (acqLength, kinFrames, height, width)
+			self.dtype = np.dtype('<{}{}'.format('i' if signed else 'u', itemSize))
+			self.metadata = json.loads(f.read(metaLength))
+			n = acqLength * kinFrames
+			table = f.read(CHUNK_ENTRY.size * n)
+			self.chunks = [CHUNK_ENTRY.unpack_from(table, k * CHUNK_ENTRY.size) for k in range(n)]
+
+	def readChunk(self, k):
+		(offset, length) = self.chunks[k]
+		with open(self.path, 'rb') as f:
+			f.seek(offset)
+			return f.read(length)
+
+	def decode(self, k):
+		data = codecs[self.codec][1](self.readChunk(k))
+		return unfilterImage(data, self.filter, self.dtype, self.shape[2:])
+
+	# Image of acquisition i, kinetics frame j, in camera orientation
+	def image(self, i, j):
+		return self.decode(i * self.shape[1] + j)
+
+	# All the frames, decoded in parallel
+	def frames(self):
+		images = getPool().map(self.decode, range(len(self.chunks)))
+		return np.array(images).reshape(self.shape)
+
+	# Bytes on disk against bytes of the raw frames
+	def ratio(self):
+		return float(np.prod(self.shape) * self.dtype.itemsize) / os.path.getsize(self.path)
+
+# Compare the codecs on a simulated full size FK shot
+if __name__ == "__main__":
+	np.random.seed(0)
+	(acqLength, kinFrames, height, width) = (3, 2, KRBCAM_EXPOSED_ROWS, 512)
+	y = np.arange(height)[:, np.newaxis]
+	x = np.arange(width)[np.newaxis, :]
+	background = 500 + 200 * np.exp(-((x - 256)**2 + (y - height/2)**2) / 2e4)
+	frames = np.random.poisson(background, (acqLength, kinFrames, height, width))
+	raw = frames.size * 2
+
+	for codec in sorted(codecs.keys()):
+		for level in [1, 6, 9]:
+			for filt in FILTERS:
+				t0 = time.time()
+				data = encodeShot(frames, {}, codec, level, filt)
+				t1 = time.time()
+				print "{} {} {}: {:.2f}x in {:.1f} ms".format(codec, level, filt, float(raw) / len(data), (t1 - t0) * 1e3)
+			if codec == 'none':
+				break
@@ -0,0 +1,251 @@
+import time
+import multiprocessing
+
+import numpy as np
+
+from andor_helpers import *
+from krb_analysis import cropROI, roiMoments
+
+#########################################################################################
+# 2D fit models
+#
+# Each model has a value function, a Jacobian and an initial guess from the image moments.
+# x is a row vector (1, nx) and y is a column vector (ny, 1) of pixel coordinates,
+# so everything is evaluated on the grid by broadcasting.
+#########################################################################################
+
+# Gaussian
+# p = [amplitude, x0, y0, sigma x, sigma y, offset]
+GAUSSIAN_PARAMS = ['A', 'x0', 'y0', 'sx', 'sy', 'offset']
+
+def gaussianValue(p, x, y):
+	(A, x0, y0, sx, sy, off) = np.asarray(p, dtype=float)
+	X = (x - x0) / sx
+	Y = (y - y0) / sy
+	return A * np.exp(-0.5*X**2) * np.exp(-0.5*Y**2) + off
+
+def gaussianJacobian(p, x, y):
+	(A, x0, y0, sx, sy, off) = np.asarray(p, dtype=float)
+	X = (x - x0) / sx
+	Y = (y - y0) / sy
+
+	# Separable, so only two 1D exponentials are needed
+	g = np.exp(-0.5*X**2) * np.exp(-0.5*Y**2)
+	Ag = A * g
+	return [g, Ag*X/sx, Ag*Y/sy, Ag*X**2/sx, Ag*Y**2/sy, np.ones_like(g)]
+
+def gaussianGuess(m, offset):
+	sx = max(m['sx'], 1.0)
+	sy = max(m['sy'], 1.0)
+	A = m['sumOD'] / (2*np.pi*sx*sy)
+	return np.array([A, m['xc'], m['yc'], sx, sy, offset])
+
+# Integral of the fit over the plane, in units of OD * pixels
+def gaussianIntegral(p):
+	return 2*np.pi * p[0] * abs(p[3] * p[4])
+
+# Thomas-Fermi (column integrated)
+# p = [amplitude, x0, y0, radius x, radius y, offset]
+THOMAS_FERMI_PARAMS = ['A', 'x0', 'y0', 'Rx', 'Ry', 'offset']
+
+def thomasFermiValue(p, x, y):
+	(A, x0, y0, rx, ry, off) = np.asarray(p, dtype=float)
+	u = 1 - ((x - x0) / rx)**2 - ((y - y0) / ry)**2
+	return A * np.maximum(u, 0)**1.5 + off
+
+def thomasFermiJacobian(p, x, y):
+	(A, x0, y0, rx, ry, off) = np.asarray(p, dtype=float)
+	X = (x - x0) / rx
+	Y = (y - y0) / ry
+	u = np.maximum(1 - X**2 - Y**2, 0)
+
+	s = np.sqrt(u)
+	dA = u * s
+	c = 3 * A * s
+	return [dA, c*X/rx, c*Y/ry, c*X**2/rx, c*Y**2/ry, np.ones_like(u)]
+
+def thomasFermiGuess(m, offset):
+	# For a column integrated TF profile <x^2> = Rx^2 / 7
+	rx = np.sqrt(7) * max(m['sx'], 1.0)
+	ry = np.sqrt(7) * max(m['sy'], 1.0)
+	A = m['sumOD'] * 5 / (2*np.pi*rx*ry)
+	return np.array([A, m['xc'], m['yc'], rx, ry, offset])
+
+def thomasFermiIntegral(p):
+	return 2*np.pi/5 * p[0] * abs(p[3] * p[4])
+
+# Lookup for the models by name
+fit_models = {
+	'Gaussian': (gaussianValue, gaussianJacobian, gaussianGuess, gaussianIntegral, GAUSSIAN_PARAMS),
+	'Thomas-Fermi': (thomasFermiValue, thomasFermiJacobian, thomasFermiGuess, thomasFermiIntegral, THOMAS_FERMI_PARAMS)
+}
+
+#########################################################################################
+# Fitting
+#########################################################################################
+
+# Levenberg-Marquardt least squares fit of z(x, y) with an analytic Jacobian
+# Returns (params, chi2, iterations)
+def fitLM(value, jacobian, p, x, y, z, maxIter=KRBCAM_FIT_MAX_ITER, tol=KRBCAM_FIT_TOL):
+	p = np.array(p, dtype=float)
+	lam = 1e-3
+
+	r = (z - value(p, x, y)).ravel()
+	chi2 = np.dot(r, r)
+
+	it = 0
+	newJacobian = True
+	while it < maxIter:
+		it += 1
+
+		if newJacobian:
+			# Jacobian as an (npixels, nparams) matrix
+			J = np.column_stack([np.broadcast_to(d, np.shape(z)).ravel() for d in jacobian(p, x, y)])
+			JtJ = np.dot(J.T, J)
+			g = np.dot(J.T, r)
+
+		try:
+			dp = np.linalg.solve(JtJ + lam*np.diag(np.diag(JtJ)), g)
+		except np.linalg.LinAlgError:
+			lam *= 10
+			newJacobian = False
+			continue
+
+		pNew = p + dp
+		rNew = (z - value(pNew, x, y)).ravel()
+		chi2New = np.dot(rNew, rNew)
+
+		if chi2New < chi2:
+			converged = np.all(np.abs(dp) <= tol * (np.abs(p) + tol))
+			(p, r, chi2) = (pNew, rNew, chi2New)
+			lam = max(lam / 10, 1e-9)
+			newJacobian = True
+			if converged:
+				break
+		else:
+			lam *= 10
+			newJacobian = False
+			if lam > 1e9:
+				break
+
+	return (p, chi2, it)
+
+# Average over k x k blocks
+# Returns (image, x, y) with the pixel coordinates of the block centers
+def downsample(image, x0, y0, k):
+	(ny, nx) = np.shape(image)
+	ny -= ny % k
+	nx -= nx % k
+	small = image[:ny, :nx].reshape(ny // k, k, nx // k, k).mean(axis=3).mean(axis=1)
+
+	x = x0 + k*np.arange(nx // k) + (k - 1) / 2.0
+	y = y0 + k*np.arange(ny // k) + (k - 1) / 2.0
+	return (small, x[np.newaxis, :], y[:, np.newaxis])
+
+# Fit one OD image in a ROI
+#
+# The initial guess comes from the moments of the ROI. The fit is first done on a
+# downsampled copy of the ROI, then refined at full resolution in a window of
+# KRBCAM_FIT_WINDOW widths around the cloud.
+#
+# roi is [x, y, dx, dy], model is a key of fit_models
+# Returns a dict with the parameters, atom number and the fit time
+def fitImage(od, roi, model, crossSection=1.0, pixelArea=1.0, downsampleFactor=KRBCAM_FIT_DOWNSAMPLE):
+	t0 = time.time()
+	(value, jacobian, guess, integral, names) = fit_models[model]
+
+	(sub, x0, y0) = cropROI(od, roi)
+	sub = np.asarray(sub, dtype=float)
+
+	result = {'model': model, 'error': None}
+	if sub.size == 0:
+		result['error'] = "Empty ROI"
+		return result
+
+	# Initial guess
+	# The offset is estimated from the border of the ROI, and removed for the moments
+	offset = np.median(np.concatenate((sub[0], sub[-1], sub[:, 0], sub[:, -1])))
+	m = roiMoments(np.maximum(sub - offset, 0), [0, 0, sub.shape[1], sub.shape[0]], 1.0, 1.0)
+	if not m['sumOD'] > 0:
+		result['error'] = "No signal in ROI"
+		return result
+	m['xc'] += x0
+	m['yc'] += y0
+	p = guess(m, offset)
+
+	# Coarse fit
+	nCoarse = 0
+	if downsampleFactor > 1 and min(np.shape(sub)) >= 4 * downsampleFactor:
+		(small, x, y) = downsample(sub, x0, y0, downsampleFactor)
+		(p, chi2, nCoarse) = fitLM(value, jacobian, p, x, y, small)
+
+	# Refine at full resolution around the cloud
+	(wx, wy) = (KRBCAM_FIT_WINDOW * abs(p[3]), KRBCAM_FIT_WINDOW * abs(p[4]))
+	window = [p[1] - wx, p[2] - wy, 2*wx + 1, 2*wy + 1]
+	(fine, fx0, fy0) = cropROI(sub, [window[0] - x0, window[1] - y0, window[2], window[3]])
+	if fine.size < len(p):
+		(fine, fx0, fy0) = (sub, 0, 0)
+	x = (np.arange(fine.shape[1]) + fx0 + x0)[np.newaxis, :]
+	y = (np.arange(fine.shape[0]) + fy0 + y0)[:, np.newaxis]
+	(p, chi2, nFine) = fitLM(value, jacobian, p, x, y, fine)
+
+	# Widths only enter squared
+	p[3] = abs(p[3])
+	p[4] = abs(p[4])
+
+	for (name, v) in zip(names, p):
+		result[name] = v
+	result['params'] = p
+	result['chi2'] = chi2 / max(fine.size - len(p), 1)
+	result['iterations'] = (nCoarse, nFine)
+	result['N'] = integral(p) * pixelArea / crossSection
+	result['fitTime'] = time.time() - t0
+	return result
+
+# Helper for fitBatch, Pool.map only passes one argument
+def fitImageArgs(args):
+	return fitImage(*args)
+
+# Fit a batch of OD images across several processes
+# ods, rois are lists of the same length
+# If no pool is given, one is started (and stopped) just for this batch
+# Returns a list of fitImage results in the same order
+def fitBatch(ods, rois, model, crossSection=1.0, pixelArea=1.0, pool=None):
+	args = [(od, roi, model, crossSection, pixelArea) for (od, roi) in zip(ods, rois)]
+	if pool is not None:
+		return pool.map(fitImageArgs, args)
+
+	pool = multiprocessing.Pool(KRBCAM_ANALYSIS_PROCESSES)
+	try:
+		return pool.map(fitImageArgs, args)
+	finally:
+		pool.close()
+		pool.join()
+
+# Time the fits on simulated full size FK frames
+if __name__ == "__main__":
+	np.random.seed(0)
+	height = KRBCAM_EXPOSED_ROWS
+	width = 512
+	y = np.arange(height)[:, np.newaxis]
+	x = np.arange(width)[np.newaxis, :]
+
+	for model in sorted(fit_models.keys()):
+		value = fit_models[model][0]
+		p = [1.5, 250, 240, 30, 20, 0.02]
+		ods = [value(p, x, y) + 0.05*np.random.randn(height, width) for i in range(8)]
+		rois = [[0, 0, width, height]]*len(ods)
+
+		pool = multiprocessing.Pool(KRBCAM_ANALYSIS_PROCESSES)
+
+		t0 = time.time()
+		results = [fitImage(od, roi, model) for (od, roi) in zip(ods, rois)]
+		t1 = time.time()
+		batch = fitBatch(ods, rois, model, pool=pool)
+		t2 = time.time()
+
+		pool.close()
+
+		print "{}: {:.1f} ms per shot (fit time {:.1f} ms), batch of {} in {:.1f} ms".format(
+			model, (t1 - t0) / len(ods) * 1e3, np.mean([r['fitTime'] for r in results]) * 1e3, len(ods), (t2 - t1) * 1e3)
+		print "    fit:", ", ".join(["{}={:.3f}".format(n, v) for (n, v) in zip(fit_models[model][4], results[0]['params'])])
@@ -0,0 +1,172 @@
+import numpy as np
+
+from andor_helpers import *
+
+# Container for all of the images taken in one acquisition series
+#
+# The images are stored in one preallocated array with indices
+# (acquisition loop frame, kinetics frame, row, column)
+# in the orientation the camera reads them out.
+#
+# Rotation is only kept as metadata. It is applied as a numpy view when an
+# image is displayed or saved, so we never make a transposed copy of every frame
+# at readout.
+class KRbFrameSet:
+	def __init__(self, acqLength, kinFrames, height, width, rotate=False, dtype=np.int32):
+		self.acqLength = acqLength
+		self.kinFrames = kinFrames
+		self.rotate = rotate
+
+		# Raw frames in camera orientation
+		self.frames = np.zeros((acqLength, kinFrames, height, width), dtype=dtype)
+
+		# Number of acquisition loop frames filled so far
+		self.nAcquired = 0
+
+		# Offset (x, y) of the frames in the full readout region and (height, width) of the full region
+		# in binned camera pixels. These only differ from the defaults if the readout was cropped
+		self.origin = (0, 0)
+		self.fullShape = (height, width)
+
+		# Master dark (kinFrames, height, width) for the KRBCAM_MASTER_DARK frame selection
+		# Zeros if the master dark was already subtracted from the frames
+		self.darkFrames = None
+
+		# Rows of the frames that were read out in a multi-region readout, None if all of them were
+		# The rows between the regions stay zero
+		self.regionRows = None
+
+		# OD images already calculated for display, keyed by the frame selection
+		self.odCache = {}
+
+		# Anything else we want to keep track of for this series
+		# e.g. file number, config, timings
+		self.metadata = {}
+
+	# Copy one acquisition (all kinetics frames) into the next free slot
+	# images should have shape (kinFrames, height, width)
+	# For a multi-region readout images only has the rows that were read
+	def addShot(self, images):
+		if self.regionRows is None:
+			self.frames[self.nAcquired] = images
+		else:
+			self.frames[self.nAcquired][:, self.regionRows, :] = images
+		self.nAcquired += 1
+
+	# Set the rows between the regions of acquisition i back to zero
+	# e.g. after a master dark was subtracted from the whole frame
+	def clearGaps(self, i):
+		if self.regionRows is None:
+			return
+		gaps = np.ones(np.shape(self.frames)[2], dtype=bool)
+		gaps[self.regionRows] = False
+		self.frames[i][:, gaps, :] = 0
+
+	def isComplete(self):
+		return self.nAcquired >= self.acqLength
+
+	# Apply the image orientation to a 2D array in camera orientation
+	# Returns a view, no data is copied
+	def orient(self, image):
+		if self.rotate:
+			# Rotate 90 degrees clockwise
+			return np.rot90(image, -1)
+		else:
+			return image
+
+	# Raw image in camera orientation
+	# i can be KRBCAM_MASTER_DARK for the master dark of kinetics frame j
+	def rawImage(self, i, j):
+		if i == KRBCAM_MASTER_DARK:
+			if self.darkFrames is None:
+				raise IndexError("No master dark for this frame set")
+			return self.darkFrames[j]
+		return self.frames[i, j]
+
+	# Image in display/save orientation
+	def image(self, i, j):
+		return self.orient(self.rawImage(i, j))
+
+	# Convert a [x, y, dx, dy] region in display orientation to camera orientation
+	def cameraROI(self, roi):
+		(x, y, dx, dy) = roi
+		if self.rotate:
+			# Display column x is camera row (height - 1 - x),
+			# display row y is camera column y
+			height = np.shape(self.frames)[2]
+			return [y, height - x - dx, dy, dx]
+		else:
+			return [x, y, dx, dy]
+
+	# Offset of the display coordinates of these frames in those of the full region
+	def displayOrigin(self):
+		(x, y) = self.origin
+		if self.rotate:
+			return (self.fullShape[0] - np.shape(self.frames)[2] - y, x)
+		else:
+			return (x, y)
+
+	# Convert a [x, y, dx, dy] region in full region display coordinates to
+	# display coordinates of these frames
+	def localROI(self, roi):
+		(ox, oy) = self.displayOrigin()
+		return [roi[0] - ox, roi[1] - oy, roi[2], roi[3]]
+
+	# Where these frames are in the full region, for files that only have the images
+	# region is [x, y, width, height] of the images in display/save orientation,
+	# in display coordinates of the full region, whose (height, width) is fullShape
+	# regionRows are the rows (camera orientation) of these frames that were read out,
+	# the only ones in the csv of a multi-region readout
+	def regionInfo(self):
+		(ox, oy) = self.displayOrigin()
+		(height, width) = self.imageShape()
+		fullShape = tuple(self.fullShape)
+		if self.rotate:
+			fullShape = fullShape[::-1]
+		rows = None
+		if self.regionRows is not None:
+			rows = [int(r) for r in self.regionRows]
+		return {'region': [int(ox), int(oy), int(width), int(height)], 'fullShape': [int(n) for n in fullShape],
+			'regionRows': rows}
+
+	# Frame set of the region [x, y, dx, dy] (camera orientation) of these frames
+	# The frames are a view, and the origin is moved so the region keeps its place in the full region
+	def crop(self, box):
+		(x, y, dx, dy) = box
+		frameSet = KRbFrameSet(self.acqLength, self.kinFrames, 0, 0, self.rotate, self.frames.dtype)
+		frameSet.frames = self.frames[:, :, y:y + dy, x:x + dx]
+		frameSet.nAcquired = self.nAcquired
+		frameSet.origin = (self.origin[0] + x, self.origin[1] + y)
+		frameSet.fullShape = self.fullShape
+		if self.darkFrames is not None:
+			frameSet.darkFrames = self.darkFrames[:, y:y + dy, x:x + dx]
+		if self.regionRows is not None:
+			frameSet.regionRows = [r - y for r in self.regionRows if y <= r < y + dy]
+		frameSet.metadata = dict(self.metadata)
+		return frameSet
+
+	# (height, width) of a single image in display/save orientation
+	def imageShape(self):
+		(height, width) = np.shape(self.frames)[2:]
+		if self.rotate:
+			return (width, height)
+		else:
+			return (height, width)
+
+	# Write the frames as a csv to an open file
+	#
+	# Layout is the same as it has always been:
+	# all the acquisition loop frames of kinetics frame 0, then kinetics frame 1, ...
+	# e.g. K shadow, light, dark, Rb shadow, light, dark
+	#
+	# Each image is written straight from its (possibly rotated) view
+	# For a multi-region readout only the rows that were read are written,
+	# stacked in the order of the regions
+	def writeCSV(self, f):
+		for j in range(self.kinFrames):
+			for i in range(self.acqLength):
+				if self.regionRows is None:
+					image = self.image(i, j)
+				else:
+					image = self.orient(self.rawImage(i, j)[self.regionRows])
+				np.savetxt(f, image, fmt='%d', delimiter=',')
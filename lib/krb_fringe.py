@@ -0,0 +1,139 @@
+import threading
+from collections import deque
+
+import numpy as np
+
+from andor_helpers import *
+
+# Fringe removal for absorption imaging
+#
+# The light frame is taken tens of ms after the shadow frame, so the fringes
+# don't cancel in the OD. Instead of the measured light frame, we use the
+# combination of recent light frames that best matches the shadow frame
+# outside of the atoms.
+#
+# A rolling library of recent (dark subtracted) light frames is kept, and an
+# orthonormal basis for it is updated incrementally with each new frame
+# (Brand's incremental SVD), with older frames slowly forgotten. The basis is
+# only recomputed from the library every libraryLength frames to get rid of
+# numerical drift.
+class KRbFringeRemover:
+	def __init__(self, basisSize=KRBCAM_FRINGE_BASIS_SIZE, libraryLength=KRBCAM_FRINGE_LIBRARY_LENGTH):
+		self.basisSize = basisSize
+		self.libraryLength = libraryLength
+
+		# Forget a frame's weight on the time scale of the library length
+		self.forget = np.exp(-1.0/libraryLength)
+
+		# The library is kept in float32 to save memory
+		self.library = deque(maxlen=libraryLength)
+
+		self.lock = threading.Lock()
+		self.reset()
+
+	# Throw away the basis and library, e.g. when the image size changes
+	def reset(self):
+		self.shape = None
+		self.U = None # (npixels, k) orthonormal basis
+		self.S = None # (k) singular values
+		self.library.clear()
+		self.updatesSinceRebuild = 0
+
+	def basisLength(self):
+		if self.S is None:
+			return 0
+		return len(self.S)
+
+	# Add a dark subtracted light frame to the library and update the basis
+	def addFrame(self, light):
+		if np.shape(light) != self.shape:
+			self.reset()
+			self.shape = np.shape(light)
+
+		c = np.asarray(light, dtype=float).ravel()
+		self.library.append(c.astype(np.float32))
+		self.updatesSinceRebuild += 1
+
+		if self.U is None or self.updatesSinceRebuild >= self.libraryLength:
+			self.rebuild()
+		else:
+			self.update(c)
+
+	# Incremental SVD update with one new column
+	def update(self, c):
+		U = self.U
+		S = self.S * self.forget
+		k = len(S)
+
+		# Component of c outside of the current basis
+		p = np.dot(U.T, c)
+		r = c - np.dot(U, p)
+		rho = np.linalg.norm(r)
+
+		# SVD of the small (k+1, k+1) matrix [[diag(S), p], [0, rho]]
+		K = np.zeros((k + 1, k + 1))
+		K[:k, :k] = np.diag(S)
+		K[:k, k] = p
+		K[k, k] = rho
+		(Uk, Sk, Vk) = np.linalg.svd(K)
+
+		n = min(k + 1, self.basisSize)
+		if rho > 1e-12 * np.linalg.norm(c):
+			self.U = np.dot(U, Uk[:k, :n]) + np.outer(r / rho, Uk[k, :n])
+		else:
+			self.U = np.dot(U, Uk[:k, :n])
+		self.S = Sk[:n]
+
+	# Recompute the basis from the frames in the library
+	# Uses the eigenvectors of the small (L, L) Gram matrix
+	def rebuild(self):
+		A = np.column_stack(self.library).astype(float)
+		G = np.dot(A.T, A)
+		(w, V) = np.linalg.eigh(G)
+
+		# Largest first, and only keep the significant ones
+		order = np.argsort(w)[::-1][:self.basisSize]
+		w = w[order]
+		keep = w > 1e-12 * w[0]
+		w = w[keep]
+		V = V[:, order[keep]]
+
+		self.S = np.sqrt(w)
+		self.U = np.dot(A, V) / self.S
+		self.updatesSinceRebuild = 0
+
+	# The combination of basis frames that best matches the shadow frame outside of the mask
+	# shadow is dark subtracted, mask is a boolean image that is True on the atoms
+	#
+	# With an orthonormal basis the masked normal equations are
+	# (1 - Um^T Um) c = U^T s - Um^T sm, where Um is the basis on the mask only,
+	# so only the masked pixels have to be copied
+	def reference(self, shadow, mask=None):
+		s = np.asarray(shadow, dtype=float).ravel()
+		b = np.dot(self.U.T, s)
+		A = np.eye(len(self.S))
+		if mask is not None:
+			m = np.asarray(mask).ravel()
+			Um = self.U[m]
+			A -= np.dot(Um.T, Um)
+			b -= np.dot(Um.T, s[m])
+
+		c = np.linalg.lstsq(A, b, rcond=None)[0]
+		return np.dot(self.U, c).reshape(np.shape(shadow))
+
+	# Process one shot
+	# Adds the light frame to the library, then returns the reconstructed light frame
+	# (dark added back) to use in place of the measured light frame for the OD
+	# roi is [x, y, dx, dy] of the atoms, in the same orientation as the frames
+	def process(self, shadow, light, dark, roi=None):
+		with self.lock:
+			dark = np.asarray(dark, dtype=float)
+			self.addFrame(light - dark)
+
+			mask = None
+			if roi is not None:
+				mask = np.zeros(np.shape(dark), dtype=bool)
+				(x, y, dx, dy) = [int(v) for v in roi]
+				mask[max(y, 0):max(y + dy, 0), max(x, 0):max(x + dx, 0)] = True
+
+			return self.reference(shadow - dark, mask) + dark
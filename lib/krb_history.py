@@ -0,0 +1,126 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from andor_helpers import *
+from krb_archive import KRbArchive
+
+# Memory used by a frame set, including the cached ODs and fringe references
+def frameSetBytes(frameSet):
+	n = frameSet.frames.nbytes
+	if frameSet.darkFrames is not None:
+		n += frameSet.darkFrames.nbytes
+	n += sum([od.nbytes for od in frameSet.odCache.values()])
+	n += sum([ref.nbytes for ref in frameSet.metadata.get('references', {}).values()])
+	return n
+
+# Sequence numbers of the shots of this session
+# File numbers aren't unique (they repeat while saving is off, and start over every
+# day), so shots are told apart by metadata['shotId'], taken from here
+shotIds = itertools.count()
+
+def nextShotId():
+	return next(shotIds)
+
+# Recent frame sets by shot id
+#
+# Frame sets are kept in memory up to maxBytes, evicting the least recently used.
+# An evicted shot that was saved in the frame archive can still be recalled from
+# there (without its cached ODs). Only the last maxShots shots are remembered.
+# The file number of each shot is kept to label it.
+class KRbShotHistory:
+	def __init__(self, maxBytes=KRBCAM_HISTORY_MAX_BYTES, maxShots=KRBCAM_HISTORY_MAX_SHOTS, spill=KRBCAM_HISTORY_SPILL):
+		self.maxBytes = maxBytes
+		self.maxShots = maxShots
+		self.spill = spill
+
+		self.cache = OrderedDict() # shotId: frame set, least recently used first
+		self.archived = {} # shotId: archive path, for evicted shots
+		self.order = [] # Shot ids in the order the shots came in
+		self.fileNumbers = {} # shotId: file number
+		self.archive = None
+
+	def __len__(self):
+		return len(self.order)
+
+	def shotId(self, position):
+		return self.order[position]
+
+	def fileNumber(self, position):
+		return self.fileNumbers[self.order[position]]
+
+	def label(self, shotId):
+		return self.fileNumbers[shotId]
+
+	# Position of a shot, None if it isn't in the history
+	def position(self, shotId):
+		if shotId not in self.order:
+			return None
+		return self.order.index(shotId)
+
+	def add(self, frameSet):
+		shotId = frameSet.metadata['shotId']
+		if shotId in self.cache:
+			del self.cache[shotId]
+		else:
+			if shotId in self.order:
+				self.order.remove(shotId)
+			self.order.append(shotId)
+		self.archived.pop(shotId, None)
+		self.cache[shotId] = frameSet
+		self.fileNumbers[shotId] = frameSet.metadata['fileNumber']
+
+		while len(self.order) > self.maxShots:
+			old = self.order.pop(0)
+			self.cache.pop(old, None)
+			self.archived.pop(old, None)
+			self.fileNumbers.pop(old, None)
+		self.evict()
+
+	# Drop the least recently used frame sets until the rest fit
+	# The newest one always stays
+	def evict(self):
+		total = sum([frameSetBytes(fs) for fs in self.cache.values()])
+		while total > self.maxBytes and len(self.cache) > 1:
+			(shotId, frameSet) = self.cache.popitem(last=False)
+			total -= frameSetBytes(frameSet)
+			path = frameSet.metadata.get('archivePath')
+			if self.spill and path is not None:
+				self.archived[shotId] = path
+
+	# Frame set of a shot, or None if it is no longer available
+	def get(self, shotId):
+		if shotId in self.cache:
+			frameSet = self.cache.pop(shotId)
+			self.cache[shotId] = frameSet
+			return frameSet
+
+		if shotId not in self.archived:
+			return None
+		frameSet = self.loadArchived(self.fileNumbers[shotId], self.archived[shotId])
+		if frameSet is not None:
+			frameSet.metadata['shotId'] = shotId
+			del self.archived[shotId]
+			self.cache[shotId] = frameSet
+			self.evict()
+		return frameSet
+
+	# The archive has the shot under its file number, which is unique within one archive
+	def loadArchived(self, fileNumber, path):
+		try:
+			if self.archive is None or self.archive.path != path:
+				self.archive = KRbArchive(path)
+			i = self.archive.find(fileNumber)
+			if i is None:
+				self.archive.refresh()
+				i = self.archive.find(fileNumber)
+			if i is None:
+				return None
+			return self.archive.frameSet(i)
+		except (IOError, ValueError):
+			return None
+
+	# Memory used by the frame sets in memory
+	def nbytes(self):
+		return sum([frameSetBytes(fs) for fs in self.cache.values()])
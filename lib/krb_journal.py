@@ -0,0 +1,213 @@
+import os
+import json
+import zlib
+import struct
+
+import numpy as np
+
+from andor_helpers import *
+from krb_frames import KRbFrameSet
+from krb_archive import archiveMetadata
+
+# Journal of raw frames, written as soon as they come off the camera
+#
+# Every acquisition is appended to a preallocated local file right after
+# getData, before anything else touches the frames, and the series is marked done
+# once it has been saved. If the program dies in between, the series is still
+# pending in the journal the next time it starts, and is saved then.
+#
+# The file is used as a ring buffer of records, each starting on a
+# KRBCAM_JOURNAL_ALIGN boundary:
+#	PREFIX (magic, state), FIELDS, header crc, metadata as json, frames as little endian int32
+# The header crc covers FIELDS and the metadata, the frames have their own crc,
+# and marking a record done only rewrites its state. Opening the journal scans
+# the boundaries for valid records. Records of pending series are never
+# overwritten, if the journal is that far behind new acquisitions aren't journaled.
+#
+# The frames are journaled as they came off the camera, before the master dark is
+# subtracted, so a recovered frame set is never marked calibrated.
+
+JOURNAL_MAGIC = 'KRBJ'
+STATE_PENDING = 1
+STATE_DONE = 2
+PREFIX = struct.Struct('<4sI')				# magic, state
+FIELDS = struct.Struct('<qqIIIIIIqI')		# sequence number, series, acquisition, acq. length, kinetics frames, height, width, metadata length, data length, data crc
+HEADER_CRC = struct.Struct('<I')
+HEADER_SIZE = PREFIX.size + FIELDS.size + HEADER_CRC.size
+
+def crc(data, value=0):
+	return zlib.crc32(data, value) & 0xffffffff
+
+def aligned(n):
+	return -(-n // KRBCAM_JOURNAL_ALIGN) * KRBCAM_JOURNAL_ALIGN
+
+class KRbRawJournal:
+	def __init__(self, path=KRBCAM_JOURNAL_PATH, size=KRBCAM_JOURNAL_BYTES):
+		self.path = path
+		self.size = aligned(size)
+
+		if not os.path.isfile(path):
+			d = os.path.dirname(path)
+			if d and not os.path.isdir(d):
+				os.makedirs(d)
+			open(path, 'wb').close()
+		self.f = open(path, 'r+b')
+		if os.path.getsize(path) < self.size:
+			self.f.truncate(self.size)
+		self.size = os.path.getsize(path)
+
+		# Pending records by series, {series: [(offset, header), ...]}
+		self.series = {}
+		# Series written since opening that aren't finished yet
+		self.open = set()
+
+		self.seq = 0
+		self.position = 0
+		self.scan()
+
+	# Find the records in the file
+	def scan(self):
+		newest = None
+		offset = 0
+		while offset + HEADER_SIZE <= self.size:
+			header = self.readHeader(offset)
+			if header is None:
+				offset += KRBCAM_JOURNAL_ALIGN
+				continue
+			if header['state'] == STATE_PENDING:
+				self.series.setdefault(header['series'], []).append((offset, header))
+			if newest is None or header['seq'] > newest[1]['seq']:
+				newest = (offset, header)
+			offset += aligned(header['length'])
+
+		if newest is not None:
+			self.seq = newest[1]['seq'] + 1
+			self.position = newest[0] + aligned(newest[1]['length'])
+			if self.position >= self.size:
+				self.position = 0
+
+	# Header of the record at an offset, None if there isn't a valid one
+	def readHeader(self, offset):
+		self.f.seek(offset)
+		data = self.f.read(HEADER_SIZE)
+		if len(data) < HEADER_SIZE:
+			return None
+		(magic, state) = PREFIX.unpack_from(data)
+		if magic != JOURNAL_MAGIC or state not in [STATE_PENDING, STATE_DONE]:
+			return None
+		fields = data[PREFIX.size:PREFIX.size + FIELDS.size]
+		(seq, series, acq, acqLength, kinFrames, height, width, metaLength, dataLength, dataCRC) = FIELDS.unpack(fields)
+		if metaLength > KRBCAM_JOURNAL_ALIGN or offset + HEADER_SIZE + metaLength + dataLength > self.size:
+			return None
+		meta = self.f.read(metaLength)
+		if HEADER_CRC.unpack_from(data, PREFIX.size + FIELDS.size)[0] != crc(meta, crc(fields)):
+			return None
+		return {
+			'state': state, 'seq': seq, 'series': series, 'acq': acq,
+			'shape': (kinFrames, height, width), 'acqLength': acqLength,
+			'metadata': json.loads(meta), 'dataOffset': offset + HEADER_SIZE + metaLength,
+			'dataLength': dataLength, 'dataCRC': dataCRC,
+			'length': HEADER_SIZE + metaLength + dataLength
+		}
+
+	# Would a record at offset overwrite one of a pending series?
+	def overlapsPending(self, offset, length):
+		for records in self.series.values():
+			for (start, header) in records:
+				if start < offset + length and offset < start + aligned(header['length']):
+					return True
+		return False
+
+	# Journal acquisition i of a frame set
+	# images is what getData returned, (kinetics frame, row, column)
+	# Everything needed to rebuild the frame set goes with every acquisition
+	# Returns False if there was no room
+	def append(self, frameSet, i, images):
+		images = np.ascontiguousarray(images, dtype='<i4')
+		(kinFrames, height, width) = np.shape(images)
+		data = images.tostring()
+		meta = json.dumps({
+			'frameShape': np.shape(frameSet.frames)[2:],
+			'origin': frameSet.origin,
+			'fullShape': frameSet.fullShape,
+			'rotate': frameSet.rotate,
+			'regionRows': frameSet.regionRows,
+			'metadata': archiveMetadata(frameSet.metadata)
+		})
+		length = HEADER_SIZE + len(meta) + len(data)
+		if aligned(length) > self.size:
+			return False
+
+		offset = self.position
+		if offset + length > self.size:
+			offset = 0
+		if self.overlapsPending(offset, length):
+			return False
+
+		series = frameSet.metadata.setdefault('journalSeries', self.seq)
+		fields = FIELDS.pack(self.seq, series, i, frameSet.acqLength, kinFrames, height, width, len(meta), len(data), crc(data))
+		header = PREFIX.pack(JOURNAL_MAGIC, STATE_PENDING) + fields + HEADER_CRC.pack(crc(meta, crc(fields)))
+
+		self.f.seek(offset)
+		self.f.write(header + meta)
+		self.f.write(data)
+		self.f.flush()
+		if KRBCAM_JOURNAL_FSYNC:
+			os.fsync(self.f.fileno())
+
+		self.series.setdefault(series, []).append((offset, {'seq': self.seq, 'length': length}))
+		self.open.add(series)
+		self.seq += 1
+		self.position = offset + aligned(length)
+		if self.position >= self.size:
+			self.position = 0
+		return True
+
+	# Mark a series done, its records can be overwritten
+	def finish(self, series):
+		for (offset, header) in self.series.pop(series, []):
+			self.f.seek(offset)
+			self.f.write(PREFIX.pack(JOURNAL_MAGIC, STATE_DONE))
+		self.f.flush()
+		if KRBCAM_JOURNAL_FSYNC:
+			os.fsync(self.f.fileno())
+		self.open.discard(series)
+
+	# Mark the series written since opening done, e.g. after an abort
+	def discard(self):
+		for series in list(self.open):
+			self.finish(series)
+
+	# Series left pending from before the journal was opened, oldest first
+	def pending(self):
+		return sorted([s for s in self.series.keys() if s not in self.open])
+
+	# Rebuild the frame set of a pending series
+	# Acquisitions that are missing or whose frames don't match their crc stay zero
+	# Returns (frame set, number of acquisitions recovered)
+	def frameSet(self, series):
+		records = sorted(self.series[series], key=lambda r: r[1]['acq'])
+		meta = records[0][1]['metadata']
+		(height, width) = meta['frameShape']
+		frameSet = KRbFrameSet(records[0][1]['acqLength'], records[0][1]['shape'][0], height, width, meta.get('rotate', False))
+		frameSet.origin = tuple(meta.get('origin', (0, 0)))
+		frameSet.fullShape = tuple(meta.get('fullShape', (height, width)))
+		frameSet.regionRows = meta.get('regionRows')
+		frameSet.metadata = dict(meta.get('metadata', {}))
+		frameSet.metadata['journalSeries'] = series
+		frameSet.metadata['calibrated'] = False
+
+		n = 0
+		for (offset, header) in records:
+			self.f.seek(header['dataOffset'])
+			data = self.f.read(header['dataLength'])
+			if crc(data) != header['dataCRC']:
+				continue
+			frameSet.nAcquired = header['acq']
+			frameSet.addShot(np.fromstring(data, dtype='<i4').reshape(header['shape']))
+			n += 1
+		frameSet.nAcquired = max([h['acq'] for (o, h) in records]) + 1
+		return (frameSet, n)
+
+	def close(self):
+		self.f.close()
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import numpy as np
+
+from andor_helpers import *
+
+# EMCCD photon counting
+#
+# At high EM gain a single photoelectron is amplified far above the read noise,
+# so in sparse frames each pixel can be read as 0 or 1 photons by a threshold.
+# This gets rid of the EM excess noise factor, at the cost of saturating at
+# about one photon per pixel per frame.
+#
+# The threshold is set per pixel from calibration frames: the bias is the median
+# of the calibration frames and the read noise is the robust spread around it.
+# Most pixels of a sparse frame are empty, so the first frames of a run can be
+# used even with the light on.
+#
+# Counts are accumulated in a uint16 image, promoted to uint32 before it could overflow.
+class KRbPhotonCounter:
+	def __init__(self, threshold=KRBCAM_PC_THRESHOLD):
+		self.threshold = threshold
+		self.lock = threading.Lock()
+		self.key = None
+		self.bias = None
+		self.readNoise = None
+		self.cut = None
+		self.reset()
+
+	# Start a new count, the calibration is kept
+	def reset(self):
+		with self.lock:
+			self.counts = None
+			self.nFrames = 0
+
+	# The calibration is only valid for the same EM gain and frame shape
+	# Returns True if the existing calibration can be used
+	def select(self, key):
+		if key != self.key:
+			self.key = key
+			self.bias = None
+			self.readNoise = None
+			self.cut = None
+		return self.isCalibrated()
+
+	def isCalibrated(self):
+		return self.cut is not None
+
+	# Set the threshold from (n, row, column) calibration frames
+	def calibrate(self, frames):
+		frames = np.asarray(frames, dtype=float)
+		if len(frames) >= 3:
+			bias = np.median(frames, axis=0)
+		else:
+			bias = np.median(frames) * np.ones(np.shape(frames)[1:])
+
+		residual = frames - bias
+		readNoise = 1.4826 * np.median(np.abs(residual))
+
+		self.bias = bias
+		self.readNoise = max(readNoise, 1.0)
+		self.cut = bias + self.threshold * self.readNoise
+
+	# Count the photons in (n, row, column) frames
+	def addFrames(self, frames):
+		with self.lock:
+			if self.counts is None or np.shape(self.counts) != np.shape(frames)[1:]:
+				self.counts = np.zeros(np.shape(frames)[1:], dtype=np.uint16)
+				self.nFrames = 0
+
+			n = len(frames)
+			if self.counts.dtype == np.uint16 and self.nFrames + n > np.iinfo(np.uint16).max:
+				self.counts = self.counts.astype(np.uint32)
+
+			self.counts += np.sum(frames > self.cut, axis=0, dtype=self.counts.dtype)
+			self.nFrames += n
+
+	# Copy of the counts image, or None if nothing was counted yet
+	def image(self):
+		with self.lock:
+			if self.counts is None:
+				return None
+			return self.counts.copy()
+
+	# Mean number of photons per pixel per frame
+	# Corrects for more than one photon landing in a pixel (Poisson statistics)
+	def rate(self):
+		with self.lock:
+			if self.counts is None or self.nFrames == 0:
+				return None
+			p = np.minimum(self.counts / float(self.nFrames), 1 - 1.0/(self.nFrames + 1))
+			return -np.log(1 - p)
+
+	def describe(self):
+		if not self.isCalibrated():
+			return "Photon counting is not calibrated."
+		return "Photon counting threshold is {:.1f} counts above bias (read noise {:.1f} counts).".format(
+			self.threshold * self.readNoise, self.readNoise)
+
+# Time the counting on simulated sparse frames
+if __name__ == "__main__":
+	np.random.seed(0)
+	shape = (100, 512, 512)
+	frames = np.random.normal(500, 10, shape).astype(np.int32)
+	photons = np.random.rand(*shape) < 0.01
+	frames[photons] += np.random.exponential(300, np.sum(photons)).astype(np.int32)
+
+	counter = KRbPhotonCounter()
+	counter.calibrate(frames[:10])
+	t0 = time.time()
+	counter.addFrames(frames)
+	t1 = time.time()
+
+	print counter.describe()
+	print "{} frames in {:.1f} ms ({:.2f} ms per frame)".format(len(frames), (t1 - t0) * 1e3, (t1 - t0) * 1e3 / len(frames))
+	print "Counted {} of {} photons".format(int(np.sum(counter.image())), int(np.sum(photons)))
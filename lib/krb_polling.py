@@ -0,0 +1,72 @@
+import time
+from collections import deque
+
+from andor_helpers import *
+
+# Time the camera needs for one acquisition (s) after it is triggered,
+# from the real timings reported when the acquisition was set up
+def expectedDuration(timings, config, mode):
+	if not timings:
+		return 0.0
+	exposure = timings['exposure']
+	readout = timings['readout']
+	kinFrames = int(config['kinFrames'])
+
+	if mode == KRBCAM_ACQ_MODE_FK:
+		return kinFrames * exposure + readout
+	elif mode == KRBCAM_ACQ_MODE_ACCUMULATE:
+		return accumulations(config) * max(timings['accumulate'], exposure + readout)
+	elif mode == KRBCAM_ACQ_MODE_KINETICS:
+		return kinFrames * max(timings['kinetic'], accumulations(config) * (exposure + readout))
+	return exposure + readout
+
+# Schedule of GetStatus checks while waiting for an acquisition
+#
+# The first check is at the expected completion time. With an external trigger
+# the camera also waits for the experiment, so the delay from StartAcquisition to
+# idle is learned from recent shots, separately for each shot of the series
+# (shadow, light, dark usually come at fixed times in the sequence).
+# The earliest recent delay is used, so the first check is rarely late.
+# After that the interval backs off from KRBCAM_POLL_MIN up to KRBCAM_POLL_MAX.
+class KRbPollScheduler:
+	def __init__(self):
+		self.expected = 0.0
+		self.delays = {}
+		self.shot = 0
+		self.started = None
+		self.interval = KRBCAM_POLL_MIN
+
+	# Expected duration (s) of each acquisition in the series
+	# Learned delays are forgotten when it changes
+	def setup(self, expected):
+		if abs(expected - self.expected) > 0.1 * max(self.expected, KRBCAM_POLL_MIN):
+			self.delays = {}
+		self.expected = expected
+
+	# Called after StartAcquisition for shot i of the series
+	# Returns the time (s) until the first status check
+	def start(self, i):
+		self.shot = i
+		self.started = time.time()
+		self.interval = KRBCAM_POLL_MIN
+
+		first = self.expected
+		if self.delays.get(i):
+			first = max(first, min(self.delays[i]) - KRBCAM_POLL_MIN)
+		return max(first, KRBCAM_POLL_MIN)
+
+	# The camera is still acquiring
+	# Returns the time (s) until the next status check
+	def next(self):
+		interval = self.interval
+		self.interval = min(self.interval * KRBCAM_POLL_BACKOFF, KRBCAM_POLL_MAX)
+		return interval
+
+	# The camera is idle, remember how long it took
+	def finished(self):
+		if self.started is None:
+			return
+		if self.shot not in self.delays:
+			self.delays[self.shot] = deque(maxlen=KRBCAM_POLL_HISTORY)
+		self.delays[self.shot].append(time.time() - self.started)
+		self.started = None
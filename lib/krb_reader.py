@@ -0,0 +1,174 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Reading the csv files written by KRbFrameSet.writeCSV
+#
+# A shot csv is only integers, comma separated, one image row per line, with all
+# the acquisition loop frames of kinetics frame 0, then kinetics frame 1, ...
+# Rather than parsing line by line, the whole file is parsed in one numpy call.
+#
+# This module doesn't use andor_helpers, so the fitting program and notebooks
+# can use it from anywhere, e.g.
+#	sys.path.append("C:\\...\\KRbCamPython\\lib")
+#	from krb_reader import loadShot
+#	frames = loadShot(path, acqLength=3, kinFrames=2)	# (acquisition, kinetics frame, row, column)
+
+CSV_ACQ_LENGTH = 3			# Acquisitions per shot assumed when the layout isn't known
+CACHE_SHOTS = 50			# Shots kept by the shot cache
+
+# Parse the contents of a shot csv into a (rows, columns) array
+# Values are parsed as int32 (dark subtracted shots can be negative) and then
+# converted to dtype, e.g. np.uint16 to halve the memory, clipping at 0
+def parseCSV(data, dtype=np.int32):
+	end = data.find('\n')
+	if end < 0:
+		end = len(data)
+	columns = data.count(',', 0, end) + 1
+
+	values = np.fromstring(data.replace('\r', '').replace('\n', ','), dtype=np.int32, sep=',')
+	if len(values) % columns:
+		raise ValueError("{} values don't fill rows of {}".format(len(values), columns))
+	if np.dtype(dtype) != values.dtype:
+		info = np.iinfo(dtype)
+		values = np.clip(values, max(info.min, -2**31), min(info.max, 2**31 - 1)).astype(dtype)
+	return values.reshape((-1, columns))
+
+def readCSV(path, dtype=np.int32):
+	with open(path, 'rb') as f:
+		return parseCSV(f.read(), dtype)
+
+# (acqLength, kinFrames, height, width) of the images in a (rows, columns) csv array
+#
+# The layout comes from the config of the shot if there is one, otherwise from
+# acqLength and kinFrames if given. Failing both, the images are taken to be square
+# and split into acquisitions of CSV_ACQ_LENGTH if they divide evenly.
+# Returns (layout, guessed)
+def csvLayout(shape, config=None, acqLength=None, kinFrames=None):
+	(rows, columns) = shape
+	if config is not None:
+		acqLength = int(config['acqLength'])
+		kinFrames = int(config['kinFrames'])
+
+	if acqLength is not None and kinFrames is not None:
+		if rows % (acqLength * kinFrames):
+			raise ValueError("{} rows don't split into {} x {} images".format(rows, acqLength, kinFrames))
+		return ((acqLength, kinFrames, rows // (acqLength * kinFrames), columns), False)
+
+	if rows % columns:
+		raise ValueError("Can't tell the layout of {} x {} values".format(rows, columns))
+	n = rows // columns
+	if n % CSV_ACQ_LENGTH == 0:
+		return ((CSV_ACQ_LENGTH, n // CSV_ACQ_LENGTH, columns, columns), True)
+	return ((n, 1, columns, columns), True)
+
+# Images of a (rows, columns) csv array as an (acquisition, kinetics frame, row, column) array
+# Returns a view, nothing is copied
+def csvFrames(values, layout):
+	(acqLength, kinFrames, height, width) = layout
+	return values.reshape((kinFrames, acqLength, height, width)).swapaxes(0, 1)
+
+# Recently loaded shots, keyed by path, so reloading a shot that hasn't changed is free
+# A shot is reloaded when its modification time or size changes. The cached
+# arrays are read only, since every caller gets the same one.
+class KRbShotCache:
+	def __init__(self, maxShots=CACHE_SHOTS):
+		self.maxShots = maxShots
+		self.lock = threading.Lock()
+		self.shots = OrderedDict() # (path, dtype, layout): (mtime, size, array), least recently used first
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, load):
+		stat = os.stat(key[0])
+		with self.lock:
+			entry = self.shots.pop(key, None)
+			if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+				self.shots[key] = entry
+				self.hits += 1
+				return entry[2]
+			self.misses += 1
+
+		array = load()
+		array.flags.writeable = False
+		with self.lock:
+			self.shots[key] = (stat.st_mtime, stat.st_size, array)
+			while len(self.shots) > self.maxShots:
+				self.shots.popitem(last=False)
+		return array
+
+	def clear(self):
+		with self.lock:
+			self.shots.clear()
+
+shotCache = KRbShotCache()
+
+# Load a shot csv
+#
+# With a config (the shot's, or a dict with acqLength and kinFrames) or acqLength
+# and kinFrames, returns an (acquisition, kinetics frame, row, column) array, the
+# layout of KRbFrameSet.frames but in display orientation. Otherwise returns the
+# (rows, columns) array as it is in the file.
+# With cache=True the array comes from shotCache and is read only.
+def loadShot(path, config=None, acqLength=None, kinFrames=None, dtype=np.int32, cache=False):
+	if config is not None:
+		(acqLength, kinFrames) = (int(config['acqLength']), int(config['kinFrames']))
+	layout = None
+	if acqLength is not None or kinFrames is not None:
+		layout = (acqLength or 1, kinFrames or 1)
+
+	def load():
+		values = readCSV(path, dtype)
+		if layout is None:
+			return values
+		(shape, guessed) = csvLayout(np.shape(values), None, *layout)
+		return np.ascontiguousarray(csvFrames(values, shape))
+
+	if cache:
+		return shotCache.get((path, np.dtype(dtype).str, layout), load)
+	return load()
+
+# Compare loading a full size shot with numpy's text loaders
+# e.g. python krb_reader.py
+if __name__ == "__main__":
+	import tempfile
+	import shutil
+
+	(acqLength, kinFrames, height, width) = (3, 2, 256, 512)
+	np.random.seed(0)
+	frames = np.random.poisson(300, (acqLength, kinFrames, height, width))
+	folder = tempfile.mkdtemp()
+	try:
+		path = os.path.join(folder, 'iXon_0.csv')
+		with open(path, 'w') as f:
+			for j in range(kinFrames):
+				for i in range(acqLength):
+					np.savetxt(f, frames[i, j], fmt='%d', delimiter=',')
+		print "{:.2f} MB shot, {} x {} x {} x {}".format(os.path.getsize(path) / 2.0**20, acqLength, kinFrames, height, width)
+
+		def timeit(f, n=3):
+			t = []
+			for k in range(n):
+				t0 = time.time()
+				f()
+				t.append(time.time() - t0)
+			return min(t)
+
+		tLoadtxt = timeit(lambda: np.loadtxt(path, delimiter=',', dtype=np.int32))
+		tGenfromtxt = timeit(lambda: np.genfromtxt(path, delimiter=',', dtype=np.int32))
+		tLoad = timeit(lambda: loadShot(path, acqLength=acqLength, kinFrames=kinFrames))
+		tLoad16 = timeit(lambda: loadShot(path, acqLength=acqLength, kinFrames=kinFrames, dtype=np.uint16))
+		loadShot(path, acqLength=acqLength, kinFrames=kinFrames, cache=True)
+		tCached = timeit(lambda: loadShot(path, acqLength=acqLength, kinFrames=kinFrames, cache=True))
+
+		assert np.array_equal(loadShot(path, acqLength=acqLength, kinFrames=kinFrames), frames)
+		print "np.loadtxt:\t{:.1f} ms".format(tLoadtxt * 1e3)
+		print "np.genfromtxt:\t{:.1f} ms".format(tGenfromtxt * 1e3)
+		print "loadShot:\t{:.1f} ms ({:.0f}x loadtxt, {:.0f}x genfromtxt)".format(tLoad * 1e3, tLoadtxt / tLoad, tGenfromtxt / tLoad)
+		print "loadShot uint16:\t{:.1f} ms".format(tLoad16 * 1e3)
+		print "loadShot cached:\t{:.3f} ms".format(tCached * 1e3)
+	finally:
+		shutil.rmtree(folder)
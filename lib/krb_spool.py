@@ -0,0 +1,288 @@
+import os
+import zlib
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+
+from andor_helpers import *
+
+TAIL_CHECK = 65536			# Bytes before the end of a copy whose crc is kept, to tell if the file was rewritten
+COPY_CHUNK = 1048576		# Bytes read at a time when appending
+
+# Local mirror of a folder on the remote data share, None for any other folder
+# e.g. \\server\krbdata\data\2019\01\20190101\Andor\ -> <spool>\2019\01\20190101\Andor\
+def spoolDir(savePath):
+	if not savePath.startswith(KRBCAM_REMOTE_SAVE_PATH):
+		return None
+	return KRBCAM_SPOOL_PATH + savePath[len(KRBCAM_REMOTE_SAVE_PATH):]
+
+# Remote path of a file in the spool, None for any other file
+def remotePath(path):
+	if not path.startswith(KRBCAM_SPOOL_PATH):
+		return None
+	return KRBCAM_REMOTE_SAVE_PATH + path[len(KRBCAM_SPOOL_PATH):]
+
+# crc32 of the TAIL_CHECK bytes of a file before offset end
+def tailCRC(path, end):
+	start = max(end - TAIL_CHECK, 0)
+	with open(path, 'rb') as f:
+		f.seek(start)
+		return zlib.crc32(f.read(end - start)) & 0xffffffff
+
+# Copies files from the local spool to the remote share
+#
+# Files are saved in the spool first, so a slow or missing network never holds
+# up the acquisition loop, and each file is queued here to be copied to its
+# remote path. Files that only grow (the frame archive, the analysis log) are
+# copied by appending the new bytes. Jobs are copied in the order they were added,
+# a batch stops at the first failure, and the next batch is retried after an
+# increasing wait.
+#
+# Every added and copied job goes in a journal in the spool, so the jobs left
+# when the program stopped are picked up at the next start. A copied job is
+# journaled with the size of the remote copy and the crc of the TAIL_CHECK bytes
+# before its end. New bytes are only appended if the remote copy still has that
+# size and the local file still has those bytes, e.g. an archive whose partial
+# last record was cut off by KRbArchiveWriter.recover() is copied again whole.
+#
+# Copied files are removed from the spool once they haven't changed for
+# KRBCAM_SPOOL_KEEP. Save folders are dated, so by then nothing appends to them.
+#
+# work does the copying and removing and is meant to run in a thread, everything
+# else is called from the GUI thread.
+class KRbReplicator:
+	def __init__(self, journalPath=None):
+		if journalPath is None:
+			journalPath = KRBCAM_SPOOL_PATH + KRBCAM_SPOOL_JOURNAL
+		self.journalPath = journalPath
+		self.lock = threading.Lock()
+
+		# (src, dst): [append, times added], in the order they were added
+		self.pending = OrderedDict()
+		# (src, dst): (size, tail crc) of the last copy
+		self.copied = {}
+
+		self.retryAt = 0
+		self.retryWait = KRBCAM_REPLICATE_RETRY_MIN
+		self.lastError = None
+		self.pruneAt = 0
+
+		# (bytes, seconds) of recent batches
+		self.batches = deque(maxlen=KRBCAM_REPLICATE_RATE_WINDOW)
+		self.copiedFiles = 0
+		self.copiedBytes = 0
+
+		self.resume()
+
+	# Read the jobs left in the journal and rewrite it with only those
+	def resume(self):
+		if os.path.isfile(self.journalPath):
+			with open(self.journalPath, 'r') as f:
+				for line in f:
+					fields = line.rstrip('\n').split('\t')
+					if len(fields) not in [4, 6]:
+						# Partly written line
+						continue
+					(action, src, dst, append) = fields[:4]
+					if action == 'add':
+						self.pending[(src, dst)] = [append == '1', 0]
+					elif action == 'done':
+						self.pending.pop((src, dst), None)
+						self.copied.pop((src, dst), None)
+						if len(fields) == 6:
+							self.copied[(src, dst)] = (int(fields[4]), int(fields[5]))
+		else:
+			d = os.path.dirname(self.journalPath)
+			if d and not os.path.isdir(d):
+				os.makedirs(d)
+
+		# Keep what is known about the copies of files still in the spool
+		for key in [key for key in self.copied.keys() if not os.path.isfile(key[0])]:
+			del self.copied[key]
+		with open(self.journalPath + '_temp', 'w') as f:
+			for ((src, dst), state) in self.copied.items():
+				f.write(self.journalLine('done', src, dst, False, state))
+			for ((src, dst), (append, n)) in self.pending.items():
+				f.write(self.journalLine('add', src, dst, append))
+		if os.path.isfile(self.journalPath):
+			os.remove(self.journalPath)
+		os.rename(self.journalPath + '_temp', self.journalPath)
+
+	# state is (size, tail crc) of a copy
+	def journalLine(self, action, src, dst, append, state=None):
+		fields = [action, src, dst, str(int(bool(append)))]
+		if state is not None:
+			fields += [str(state[0]), str(state[1])]
+		return '\t'.join(fields) + '\n'
+
+	def writeJournal(self, lines):
+		with open(self.journalPath, 'a') as f:
+			f.write(''.join(lines))
+			f.flush()
+			os.fsync(f.fileno())
+
+	# Queue a file to be copied to dst
+	# If append is True, only the bytes dst doesn't have yet are copied, when that is safe
+	# A file that is already queued is counted again, so one that grew while
+	# it was being copied isn't taken off the queue
+	def add(self, src, dst, append=False):
+		with self.lock:
+			if self.pending.has_key((src, dst)):
+				self.pending[(src, dst)][1] += 1
+				return
+			self.pending[(src, dst)] = [append, 0]
+			self.writeJournal([self.journalLine('add', src, dst, append)])
+
+	def backlog(self):
+		with self.lock:
+			return len(self.pending)
+
+	def ready(self):
+		return self.backlog() > 0 and time.time() >= self.retryAt
+
+	# Is there anything for work to do?
+	def due(self):
+		return self.ready() or time.time() >= self.pruneAt
+
+	# Copy a batch if one is ready, and remove old copied files if it's time to
+	# Returns the number of files copied
+	def work(self):
+		n = 0
+		if self.ready():
+			n = self.runBatch()
+		if time.time() >= self.pruneAt:
+			self.prune()
+		return n
+
+	# Copy up to KRBCAM_REPLICATE_BATCH files
+	# Returns the number of files copied
+	def runBatch(self):
+		with self.lock:
+			jobs = [(key, append, n, self.copied.get(key)) for (key, (append, n)) in self.pending.items()[:KRBCAM_REPLICATE_BATCH]]
+
+		t0 = time.time()
+		done = []
+		nBytes = 0
+		error = None
+		for ((src, dst), append, n, known) in jobs:
+			# Nothing to copy if the spooled file was removed, it would block the queue forever
+			if not os.path.isfile(src):
+				done.append(((src, dst), append, n, None))
+				continue
+			try:
+				(copied, state) = self.copy(src, dst, append, known)
+			except (IOError, OSError) as e:
+				error = "{}: {}".format(dst, e)
+				break
+			nBytes += copied
+			done.append(((src, dst), append, n, state))
+		seconds = time.time() - t0
+
+		with self.lock:
+			for (key, append, n, state) in done:
+				if state is None:
+					self.copied.pop(key, None)
+				else:
+					self.copied[key] = state
+			# Files that were added again while being copied stay queued
+			done = [(key, append, state) for (key, append, n, state) in done if self.pending[key][1] == n]
+			for (key, append, state) in done:
+				del self.pending[key]
+			if done:
+				self.writeJournal([self.journalLine('done', src, dst, append, state) for ((src, dst), append, state) in done])
+
+			self.batches.append((nBytes, seconds))
+			self.copiedFiles += len(done)
+			self.copiedBytes += nBytes
+
+			if error is None:
+				self.lastError = None
+				self.retryWait = KRBCAM_REPLICATE_RETRY_MIN
+				self.retryAt = 0
+			else:
+				self.lastError = error
+				self.retryAt = time.time() + self.retryWait
+				self.retryWait = min(2 * self.retryWait, KRBCAM_REPLICATE_RETRY_MAX)
+		return len(done)
+
+	# Remove copied files that haven't changed for KRBCAM_SPOOL_KEEP from the spool
+	# Files that are queued, or that changed size since they were copied, are kept
+	# Returns the number of files removed
+	def prune(self):
+		with self.lock:
+			self.pruneAt = time.time() + KRBCAM_SPOOL_PRUNE_TIMER
+			candidates = [(key, state) for (key, state) in self.copied.items() if not self.pending.has_key(key)]
+
+		removed = []
+		for ((src, dst), (size, tail)) in candidates:
+			try:
+				if os.path.isfile(src):
+					if os.path.getsize(src) != size or time.time() - os.path.getmtime(src) < KRBCAM_SPOOL_KEEP:
+						continue
+					os.remove(src)
+				removed.append((src, dst))
+			except OSError:
+				pass
+
+		with self.lock:
+			for key in removed:
+				if not self.pending.has_key(key):
+					self.copied.pop(key, None)
+		return len(removed)
+
+	# Copy one file
+	# known is the (size, tail crc) of the last copy, None if there wasn't one
+	# Whole files are copied to a temporary name first, so nobody reading the share
+	# sees a partial file
+	# Returns (bytes copied, (size, tail crc) of the copy)
+	def copy(self, src, dst, append, known=None):
+		d = os.path.dirname(dst)
+		if d and not os.path.isdir(d):
+			os.makedirs(d)
+
+		if append and self.canAppend(src, dst, known):
+			start = known[0]
+			n = 0
+			with open(src, 'rb') as fsrc:
+				fsrc.seek(start)
+				with open(dst, 'ab') as fdst:
+					while True:
+						data = fsrc.read(COPY_CHUNK)
+						if not data:
+							break
+						fdst.write(data)
+						n += len(data)
+			return (n, (start + n, tailCRC(dst, start + n)))
+
+		temp = dst + "_temp"
+		shutil.copyfile(src, temp)
+		size = os.path.getsize(temp)
+		state = (size, tailCRC(temp, size))
+		if os.path.isfile(dst):
+			os.remove(dst)
+		os.rename(temp, dst)
+		return (size, state)
+
+	# Can the new bytes of src be appended to dst?
+	# Only if dst is as it was left by the last copy and src still starts with what was copied
+	def canAppend(self, src, dst, known):
+		if known is None or not os.path.isfile(dst):
+			return False
+		(size, tail) = known
+		return os.path.getsize(dst) == size and os.path.getsize(src) >= size and tailCRC(src, size) == tail
+
+	# Copy rate over the recent batches (bytes/s)
+	def rate(self):
+		with self.lock:
+			nBytes = sum([b for (b, s) in self.batches])
+			seconds = sum([s for (b, s) in self.batches])
+		if seconds <= 0:
+			return 0.0
+		return nBytes / seconds
+
+	def describe(self):
+		msg = "Replication: {} waiting, {:.1f} MB/s".format(self.backlog(), self.rate() / 2**20)
+		if self.lastError is not None:
+			msg += ", retry in {:.0f} s".format(max(self.retryAt - time.time(), 0))
+		return msg
@@ -0,0 +1,89 @@
+import threading
+
+import numpy as np
+
+# Running per-pixel mean and variance over many shots
+#
+# Uses Welford's algorithm with float64 accumulators, so memory does not grow
+# with the number of shots and nothing needs to be saved to average images.
+# Keeps statistics of every raw frame of the frame set, and of the OD of each setting.
+#
+# update() is called from a worker thread, everything else from the GUI
+class KRbPixelStats:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	# Start over
+	def reset(self):
+		with self.lock:
+			self.shape = None
+			self.n = 0
+			self.mean = None
+			self.m2 = None
+
+			# OD statistics for each setting
+			# setting: [n, mean, m2]
+			self.od = {}
+
+	# Welford update of (n, mean, m2) with a new sample x
+	def welford(self, n, mean, m2, x):
+		n += 1
+		delta = x - mean
+		mean += delta / n
+		m2 += delta * (x - mean)
+		return n
+
+	# Add a frame set
+	# ods is a dict {setting: OD image}
+	def update(self, frameSet, ods=None):
+		with self.lock:
+			frames = frameSet.frames
+
+			# Different frame layout, so the old statistics don't apply anymore
+			if np.shape(frames) != self.shape:
+				self.shape = np.shape(frames)
+				self.n = 0
+				self.mean = np.zeros(self.shape)
+				self.m2 = np.zeros(self.shape)
+				self.od = {}
+
+			self.n = self.welford(self.n, self.mean, self.m2, frames.astype(float))
+
+			for (setting, od) in (ods or {}).items():
+				if setting not in self.od or np.shape(self.od[setting][1]) != np.shape(od):
+					self.od[setting] = [0, np.zeros(np.shape(od)), np.zeros(np.shape(od))]
+				s = self.od[setting]
+				s[0] = self.welford(s[0], s[1], s[2], od)
+
+	# Number of shots accumulated
+	def count(self):
+		return self.n
+
+	# Mean and standard deviation of raw frame (i, j) in camera orientation
+	# Returns None if there are no statistics yet
+	def frameMean(self, i, j):
+		with self.lock:
+			if self.n == 0:
+				return None
+			return self.mean[i, j].copy()
+
+	def frameStd(self, i, j):
+		with self.lock:
+			if self.n < 2:
+				return None
+			return np.sqrt(self.m2[i, j] / (self.n - 1))
+
+	# Mean and standard deviation of the OD of a setting
+	def odMean(self, setting):
+		with self.lock:
+			if setting not in self.od or self.od[setting][0] == 0:
+				return None
+			return self.od[setting][1].copy()
+
+	def odStd(self, setting):
+		with self.lock:
+			if setting not in self.od or self.od[setting][0] < 2:
+				return None
+			(n, mean, m2) = self.od[setting]
+			return np.sqrt(m2 / (n - 1))
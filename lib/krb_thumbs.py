@@ -0,0 +1,174 @@
+import os
+import time
+import zlib
+import struct
+import threading
+from collections import deque
+
+import numpy as np
+
+from andor_helpers import *
+import krb_analysis
+
+# Small previews of saved shots
+#
+# For each shot, an OD preview (the settings side by side) and a sheet of all the
+# frames (acquisitions down, kinetics frames across) are written as png files in
+# KRBCAM_THUMB_FOLDER of the save folder. Both are in display orientation and
+# colored with the colormap of the image window.
+
+# Contents of a png file of an (height, width, 3) uint8 image
+# Only needs zlib, so it can run outside the GUI thread
+def pngBytes(rgb):
+	(height, width) = np.shape(rgb)[:2]
+	rows = np.zeros((height, 3 * width + 1), dtype=np.uint8) # Filter byte 0 before each row
+	rows[:, 1:] = np.reshape(rgb, (height, 3 * width))
+
+	def chunk(tag, data):
+		return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+	return '\x89PNG\r\n\x1a\n' + chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+		chunk('IDAT', zlib.compress(rows.tostring(), 6)) + chunk('IEND', '')
+
+def writePNG(path, rgb):
+	d = os.path.dirname(path)
+	if d and not os.path.isdir(d):
+		os.makedirs(d)
+	with open(path + "_temp", 'wb') as f:
+		f.write(pngBytes(rgb))
+	if os.path.isfile(path):
+		os.remove(path)
+	os.rename(path + "_temp", path)
+
+# Block average an image so its longer side is at most size
+def downsample(image, size):
+	(height, width) = np.shape(image)
+	block = max(-(-max(height, width) // size), 1)
+	height -= height % block
+	width -= width % block
+	if height == 0 or width == 0:
+		return np.zeros((1, 1))
+	image = np.asarray(image[:height, :width], dtype=float)
+	return image.reshape(height // block, block, width // block, block).mean(axis=3).mean(axis=1)
+
+# Colors of an image through a (256, 3) uint8 lookup table, scaled from its low to high percentile
+def colorize(image, lut, low=1, high=99.5):
+	(vmin, vmax) = np.percentile(image, [low, high])
+	if vmax <= vmin:
+		vmax = vmin + 1
+	index = np.clip((image - vmin) * (255.0 / (vmax - vmin)), 0, 255).astype(np.uint8)
+	return lut[index]
+
+def orient(image, rotate):
+	if rotate:
+		return np.rot90(image, -1)
+	return image
+
+# Side by side images with a gap, all padded to the tallest
+def tile(images, gap=2):
+	height = max([np.shape(im)[0] for im in images])
+	width = sum([np.shape(im)[1] for im in images]) + gap * (len(images) - 1)
+	out = np.full((height, width, 3), 255, dtype=np.uint8)
+	x = 0
+	for im in images:
+		out[:np.shape(im)[0], x:x + np.shape(im)[1]] = im
+		x += np.shape(im)[1] + gap
+	return out
+
+# OD preview of the (shadow, light, dark) frames of each setting
+# ODs are scaled from 0, so an empty shot looks empty
+def odPreview(odFrames, rotate, lut, accumulations=1, size=KRBCAM_THUMB_SIZE):
+	images = []
+	for (shadow, light, dark) in odFrames:
+		od = downsample(orient(krb_analysis.calcOD(shadow, light, dark, accumulations), rotate), size)
+		images.append(lut[np.clip(od * (255.0 / max(np.percentile(od, 99.5), 0.1)), 0, 255).astype(np.uint8)])
+	return tile(images)
+
+# All the frames of a frame set, (acquisition, kinetics frame, row, column) in camera orientation
+def frameSheet(frames, rotate, lut, size=KRBCAM_THUMB_FRAME_SIZE):
+	(acqLength, kinFrames) = np.shape(frames)[:2]
+	rows = [tile([colorize(downsample(orient(frames[i, j], rotate), size), lut) for j in range(kinFrames)])
+		for i in range(acqLength)]
+	width = max([np.shape(r)[1] for r in rows])
+	rows = [np.pad(r, ((0, 2), (0, width - np.shape(r)[1]), (0, 0)), 'constant', constant_values=255) for r in rows]
+	return np.concatenate(rows, axis=0)
+
+# Lookup table of a matplotlib colormap, drawn on white like the plots
+def colormapLUT(cmap):
+	rgba = np.asarray(cmap(np.linspace(0, 1, 256)))
+	rgb = rgba[:, :3] * rgba[:, 3:] + (1 - rgba[:, 3:])
+	return np.clip(rgb * 255, 0, 255).astype(np.uint8)
+
+# Makes previews in a background thread
+#
+# The thread runs at idle priority (on Windows), and waits while the GUI holds it,
+# which it does for a moment after every readout so it never competes with
+# getting and saving the data. done(shotId, paths, error) is called from the
+# thread for every shot, with the paths that were written and, if something went
+# wrong, a message. Nothing that goes wrong with one shot stops the thread.
+class KRbThumbnailer:
+	def __init__(self, done):
+		self.done = done
+		self.jobs = deque()
+		self.condition = threading.Condition()
+		self.holdUntil = 0
+		self.running = True
+		self.thread = threading.Thread(target=self.run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	# Queue a shot
+	# odFrames is a list of (shadow, light, dark), frames is the frame set's array, paths is (OD preview, frame sheet)
+	def add(self, shotId, paths, odFrames, frames, rotate, lut, accumulations=1):
+		with self.condition:
+			self.jobs.append((shotId, paths, odFrames, frames, rotate, lut, accumulations))
+			self.condition.notify()
+
+	def hold(self, seconds=KRBCAM_THUMB_HOLD):
+		with self.condition:
+			self.holdUntil = max(self.holdUntil, time.time() + seconds)
+
+	def backlog(self):
+		with self.condition:
+			return len(self.jobs)
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.thread.join(1)
+
+	def setLowPriority(self):
+		if os.name == 'nt':
+			try:
+				import ctypes
+				kernel32 = ctypes.windll.kernel32
+				kernel32.SetThreadPriority(kernel32.GetCurrentThread(), -15) # THREAD_PRIORITY_IDLE
+			except (ImportError, AttributeError, OSError):
+				pass
+
+	def run(self):
+		self.setLowPriority()
+		while True:
+			with self.condition:
+				while self.running and (not self.jobs or time.time() < self.holdUntil):
+					self.condition.wait(max(self.holdUntil - time.time(), 0.05) if self.jobs else None)
+				if not self.running:
+					return
+				job = self.jobs.popleft()
+
+			(shotId, paths, odFrames, frames, rotate, lut, accumulations) = job
+			written = []
+			error = None
+			try:
+				if odFrames:
+					writePNG(paths[0], odPreview(odFrames, rotate, lut, accumulations))
+					written.append(paths[0])
+				writePNG(paths[1], frameSheet(frames, rotate, lut))
+				written.append(paths[1])
+			except Exception as e:
+				error = "{}: {}: {}".format(os.path.basename(paths[1]), type(e).__name__, e)
+			try:
+				self.done(shotId, written, error)
+			except Exception as e:
+				print "Preview callback error: {}".format(e)
@@ -0,0 +1,117 @@
+import numpy as np
+
+from andor_helpers import *
+
+# Readout timing model and planner
+#
+# The SDK only reports the real timings after an acquisition is set up, which
+# means changing the camera settings. Instead, the readout is modeled from the
+# shift speeds cached in camInfo:
+#  - every row of the chip is shifted once (frame transfer, and dumping the rows outside the ROI)
+#  - every read row is digitized across the full (binned) width at the HS speed
+# The model is scaled by the ratio of the real to the predicted readout time of
+# the last acquisition in each mode, which takes care of the overheads it leaves out.
+
+# Input referred read noise (e-) of an amplifier at a HS speed (MHz)
+# With EM gain the noise is divided by the gain
+def readNoise(emEnable, emGain, hss):
+	if emEnable:
+		table = KRBCAM_READ_NOISE_EM
+	else:
+		table = KRBCAM_READ_NOISE_CONVENTIONAL
+	(speeds, noise) = zip(*sorted(table))
+	n = np.interp(hss, speeds, noise)
+	if emEnable:
+		n /= max(emGain, 1)
+	return n
+
+def binSize(binning):
+	if binning:
+		return KRBCAM_BIN_SIZE
+	return 1
+
+# HS speed (MHz) of a config
+def hsSpeed(config, camInfo):
+	typ = 0 if config['emEnable'] else 1
+	return camInfo['hss'][config['adChannel']][typ][config['hss']]
+
+class KRbTimingPlanner:
+	def __init__(self):
+		# Real / modeled readout time for each acquisition mode
+		self.scale = {}
+
+	# Predicted timings (s) and read noise (e-) of a config
+	# Returns a dict with 'readout', 'cycle', 'keepClean' and 'noise'
+	def predict(self, config, camInfo, mode):
+		(width, height) = camInfo['detDim']
+		vss = camInfo['vss'][config['vss']] * 1e-6
+		hss = hsSpeed(config, camInfo)
+		b = binSize(config['binning'])
+		exposure = config['expTime'] * 1e-3
+		kinFrames = int(config['kinFrames'])
+		nAcc = accumulations(config)
+
+		if mode == KRBCAM_ACQ_MODE_FK:
+			rows = kinFrames * config['dy'] / b
+		elif readoutRegions(config):
+			rows = len(regionRows(config))
+		else:
+			rows = config['dy'] / b
+		rowTime = (width / b) / (hss * 1e6)
+		readout = (height * vss + rows * rowTime) * self.scale.get(mode, 1.0)
+		keepClean = height * vss
+
+		if mode == KRBCAM_ACQ_MODE_FK:
+			# The frames are shifted down by dy rows between exposures, and read out at the end
+			cycle = kinFrames * (exposure + config['dy'] * vss) + readout
+		elif mode == KRBCAM_ACQ_MODE_KINETICS:
+			cycle = kinFrames * nAcc * (exposure + readout)
+		else:
+			cycle = nAcc * (exposure + readout)
+
+		return {
+			'readout': readout,
+			'cycle': cycle,
+			'keepClean': keepClean,
+			'noise': readNoise(config['emEnable'], config['emGain'], hss)
+		}
+
+	# Correct the model with the real readout time (s) of a config
+	def calibrate(self, config, camInfo, mode, readout):
+		self.scale[mode] = 1.0
+		predicted = self.predict(config, camInfo, mode)['readout']
+		if readout > 0 and predicted > 0:
+			self.scale[mode] = readout / predicted
+
+	# The config with the shortest cycle time that meets the read noise limit
+	# Searches the AD channels, HS and VS speeds, and binning if allowed.
+	# The amplifier, EM gain, exposure and ROI are kept.
+	# Returns (config, timings) or (None, None) if nothing meets the limit
+	def plan(self, config, camInfo, mode, maxNoise, allowBinning=False):
+		typ = 0 if config['emEnable'] else 1
+		if allowBinning:
+			binnings = [False, True]
+		else:
+			binnings = [config['binning']]
+
+		best = (None, None)
+		for adc in range(len(camInfo['hss'])):
+			for hss in range(len(camInfo['hss'][adc][typ])):
+				for vss in range(len(camInfo['vss'])):
+					for binning in binnings:
+						candidate = dict(config)
+						candidate.update({'adChannel': adc, 'hss': hss, 'vss': vss, 'binning': binning})
+
+						# Pre-amp gains are indexed among the ones available at this HS speed
+						nPreAmp = sum(camInfo['hssPreAmp'][adc][typ][hss])
+						candidate['preAmpGain'] = min(config['preAmpGain'], max(nPreAmp - 1, 0))
+						if binning:
+							candidate['dy'] -= candidate['dy'] % KRBCAM_BIN_SIZE
+							candidate['dx'] -= candidate['dx'] % KRBCAM_BIN_SIZE
+
+						t = self.predict(candidate, camInfo, mode)
+						if t['noise'] > maxNoise:
+							continue
+						if best[1] is None or t['cycle'] < best[1]['cycle']:
+							best = (candidate, t)
+		return best
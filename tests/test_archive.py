@@ -0,0 +1,106 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append("./lib/")
+
+from krb_archive import KRbArchiveWriter, KRbArchive, archivePath, indexPath, nextFileNumber, INDEX_DTYPE
+
+# Frame archive round trips and recovery from a crash while writing
+# Run from the top folder, like andor_gui.py:
+#	python -m unittest discover -s tests
+
+def shot(seed, low=0, high=1000, shape=(2, 2, 8, 6)):
+	return np.random.RandomState(seed).randint(low, high, shape).astype(np.int32)
+
+class TestArchive(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = archivePath(os.path.join(self.folder, ''), 'iXon')
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def write(self, shots):
+		writer = KRbArchiveWriter(self.path)
+		for (fileNumber, frames) in shots:
+			writer.append(frames, fileNumber, {'fileNumber': fileNumber, 'rotate': True}, 1000.0 + fileNumber)
+		writer.close()
+
+	def testRoundTrip(self):
+		shots = [(0, shot(0)), (1, shot(1, -50, 50)), (2, shot(2, 0, 70000))]
+		self.write(shots)
+
+		archive = KRbArchive(self.path)
+		self.assertEqual(len(archive), 3)
+		self.assertEqual(archive.fileNumbers().tolist(), [0, 1, 2])
+		for (i, (fileNumber, frames)) in enumerate(shots):
+			self.assertTrue(np.array_equal(archive.frames(i), frames))
+			self.assertEqual(archive.metadata(i)['fileNumber'], fileNumber)
+		self.assertEqual(archive.frames(0).dtype, np.dtype('<u2'))
+		self.assertEqual(archive.frames(1).dtype, np.dtype('<i4'))
+		self.assertEqual(archive.find(2), 2)
+		self.assertEqual(archive.find(5), None)
+		self.assertEqual(list(archive.between(1000.5, 1002.0)), [1, 2])
+
+		frameSet = archive.frameSet(1)
+		self.assertTrue(np.array_equal(frameSet.frames, shots[1][1]))
+		self.assertTrue(frameSet.rotate)
+		self.assertEqual(nextFileNumber(self.path), 3)
+
+	def testAppendAfterReopen(self):
+		self.write([(0, shot(0))])
+		self.write([(1, shot(1))])
+		archive = KRbArchive(self.path)
+		self.assertEqual(archive.fileNumbers().tolist(), [0, 1])
+		self.assertTrue(np.array_equal(archive.frames(1), shot(1)))
+
+	# The program died while writing the frames of the last shot, before its index entry
+	def testPartialRecord(self):
+		self.write([(0, shot(0)), (1, shot(1))])
+		end = os.path.getsize(self.path)
+		with open(self.path, 'ab') as f:
+			f.write('KRBS' + '\0' * 100)
+		self.write([(2, shot(2))])
+
+		archive = KRbArchive(self.path)
+		self.assertEqual(archive.fileNumbers().tolist(), [0, 1, 2])
+		self.assertEqual(int(archive.index['offset'][2]), end)
+		self.assertTrue(np.array_equal(archive.frames(2), shot(2)))
+
+	# The program died while writing the index entry of the last shot
+	def testPartialIndexEntry(self):
+		self.write([(0, shot(0)), (1, shot(1))])
+		with open(indexPath(self.path), 'r+b') as f:
+			f.truncate(2 * INDEX_DTYPE.itemsize - 5)
+		self.assertEqual(len(KRbArchive(self.path)), 1)
+
+		writer = KRbArchiveWriter(self.path)
+		self.assertEqual(len(writer), 1)
+		self.assertEqual(os.path.getsize(indexPath(self.path)), INDEX_DTYPE.itemsize)
+		writer.append(shot(2), 2, {})
+		writer.close()
+
+		archive = KRbArchive(self.path)
+		self.assertEqual(archive.fileNumbers().tolist(), [0, 2])
+		self.assertTrue(np.array_equal(archive.frames(1), shot(2)))
+
+	# An index entry pointing past the end of the data is dropped, with everything after it
+	def testIndexAheadOfData(self):
+		self.write([(0, shot(0)), (1, shot(1))])
+		entries = np.fromfile(indexPath(self.path), dtype=INDEX_DTYPE)
+		with open(self.path, 'r+b') as f:
+			f.truncate(int(entries['offset'][1]) + 10)
+		self.assertEqual(len(KRbArchive(self.path)), 1)
+
+		writer = KRbArchiveWriter(self.path)
+		self.assertEqual(len(writer), 1)
+		writer.close()
+		self.assertEqual(os.path.getsize(self.path), int(entries['offset'][1]))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append("./lib/")
+
+import krb_calibration
+from krb_calibration import KRbCalibration, calibrationKey
+from krb_autoroi import KRbAutoROI
+
+# Master darks are found for the right readouts, including readouts cropped by the auto ROI
+# Run from the top folder, like andor_gui.py:
+#	python -m unittest discover -s tests
+
+CONFIG = {'emEnable': True, 'emGain': 100, 'adChannel': 0, 'hss': 0, 'vss': 1, 'preAmpGain': 2,
+	'binning': False, 'expTime': 1.5, 'xOffset': 10, 'yOffset': 20, 'dx': 24, 'dy': 16}
+
+class TestCalibration(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = krb_calibration.PATH_TO_CALIBRATION
+		krb_calibration.PATH_TO_CALIBRATION = self.folder
+
+	def tearDown(self):
+		krb_calibration.PATH_TO_CALIBRATION = self.path
+		shutil.rmtree(self.folder)
+
+	def testKeySettings(self):
+		key = calibrationKey(CONFIG, -60)
+		for (name, value) in [('expTime', 2.0), ('vss', 2), ('xOffset', 0), ('yOffset', 0), ('emGain', 50)]:
+			config = dict(CONFIG)
+			config[name] = value
+			self.assertNotEqual(calibrationKey(config, -60), key, name)
+		self.assertNotEqual(calibrationKey(CONFIG, -70), key)
+
+	# A readout cropped by the auto ROI uses the master dark of the full region
+	def testCroppedReadout(self):
+		(kinFrames, height, width) = (2, CONFIG['dy'], CONFIG['dx'])
+		darks = np.random.RandomState(0).poisson(200, (5, kinFrames, height, width))
+		calibration = KRbCalibration()
+		calibration.select(calibrationKey(CONFIG, -60), (kinFrames, height, width))
+		calibration.startRecording(len(darks))
+		for dark in darks:
+			calibration.addDark(dark)
+		self.assertTrue(calibration.ready())
+
+		crop = [4, 3, 8, 6]
+		cropped = KRbAutoROI().cropConfig(CONFIG, crop)
+		self.assertNotEqual(cropped['xOffset'], CONFIG['xOffset'])
+		self.assertEqual(calibrationKey(cropped, -60), calibrationKey(CONFIG, -60))
+
+		calibration = KRbCalibration()
+		self.assertTrue(calibration.select(calibrationKey(cropped, -60), (kinFrames, height, width)))
+		images = np.full((kinFrames, crop[3], crop[2]), 1000, dtype=np.int32)
+		calibration.apply(images, (crop[0], crop[1]))
+		master = calibration.master[:, crop[1]:crop[1] + crop[3], crop[0]:crop[0] + crop[2]]
+		good = ~calibration.mask[:, crop[1]:crop[1] + crop[3], crop[0]:crop[0] + crop[2]]
+		self.assertTrue(np.array_equal(images[good], (1000 - master)[good]))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append("./lib/")
+
+from krb_compress import encodeShot, writeShot, KRbCompressedShot, codecs, FILTERS, FILE_HEADER
+
+# Compressed shot files decode to exactly the frames that were written
+# Run from the top folder, like andor_gui.py:
+#	python -m unittest discover -s tests
+
+def shot(seed, low, high, shape=(3, 2, 16, 12)):
+	return np.random.RandomState(seed).randint(low, high, shape).astype(np.int32)
+
+class TestCompress(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def roundTrip(self, frames, codec, filt, name='shot.krbz'):
+		path = os.path.join(self.folder, name)
+		writeShot(path, frames, {'fileNumber': 7, 'rotate': True}, codec, 1, filt)
+		return KRbCompressedShot(path)
+
+	def testRoundTrip(self):
+		k = 0
+		for codec in sorted(codecs.keys()):
+			for filt in FILTERS:
+				for (low, high) in [(0, 1000), (-300, 300), (0, 2**20)]:
+					frames = shot(k, low, high)
+					compressed = self.roundTrip(frames, codec, filt, "shot{}.krbz".format(k))
+					k += 1
+					self.assertTrue(np.array_equal(compressed.frames(), frames), (codec, filt, low, high))
+					self.assertTrue(np.array_equal(compressed.image(2, 1), frames[2, 1]))
+					self.assertEqual(compressed.shape, np.shape(frames))
+					self.assertEqual(compressed.metadata['fileNumber'], 7)
+
+	def testStorageType(self):
+		self.assertEqual(self.roundTrip(shot(0, 0, 1000), 'zlib', 'shuffle', 'a.krbz').dtype, np.dtype('<u2'))
+		self.assertEqual(self.roundTrip(shot(0, -5, 1000), 'zlib', 'shuffle', 'b.krbz').dtype, np.dtype('<i4'))
+
+	# Smooth frames with the largest differences, which wrap around in the delta filter
+	def testDeltaWrap(self):
+		frames = np.zeros((1, 1, 4, 6), dtype=np.int32)
+		frames[0, 0, :, ::2] = 65535
+		compressed = self.roundTrip(frames, 'zlib', 'delta')
+		self.assertTrue(np.array_equal(compressed.frames(), frames))
+
+	def testNoOverwrite(self):
+		path = os.path.join(self.folder, 'shot.krbz')
+		writeShot(path, shot(0, 0, 10), {})
+		self.assertRaises(IOError, writeShot, path, shot(1, 0, 10), {})
+		self.assertTrue(np.array_equal(KRbCompressedShot(path).frames(), shot(0, 0, 10)))
+
+	def testNotCompressedShot(self):
+		path = os.path.join(self.folder, 'shot.krbz')
+		with open(path, 'wb') as f:
+			f.write('\0' * FILE_HEADER.size)
+		self.assertRaises(IOError, KRbCompressedShot, path)
+
+	def testUnknownCodec(self):
+		self.assertRaises(ValueError, encodeShot, shot(0, 0, 10), {}, 'nope')
+		self.assertRaises(ValueError, encodeShot, shot(0, 0, 10), {}, 'zlib', 1, 'nope')
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,142 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.append("./lib/")
+
+from andor_helpers import KRBCAM_JOURNAL_ALIGN
+from krb_frames import KRbFrameSet
+from krb_journal import KRbRawJournal, PREFIX, FIELDS
+
+# Raw frame journal round trips, the ring wrapping around, and damaged records
+# Run from the top folder, like andor_gui.py:
+#	python -m unittest discover -s tests
+
+SLOTS = 4
+
+def images(seed, kinFrames=2, height=8, width=6):
+	return np.random.RandomState(seed).randint(0, 1000, (kinFrames, height, width)).astype(np.int32)
+
+class TestJournal(unittest.TestCase):
+	def setUp(self):
+		self.folder = tempfile.mkdtemp()
+		self.path = os.path.join(self.folder, 'raw.journal')
+		self.journals = []
+
+	def tearDown(self):
+		for journal in self.journals:
+			journal.close()
+		shutil.rmtree(self.folder)
+
+	def open(self):
+		journal = KRbRawJournal(self.path, SLOTS * KRBCAM_JOURNAL_ALIGN)
+		self.journals.append(journal)
+		return journal
+
+	# Journal every acquisition of a new series, like checkForData
+	# Returns (frame set, series)
+	def series(self, journal, seed, acqLength=2):
+		frameSet = KRbFrameSet(acqLength, 2, 8, 6, True)
+		frameSet.metadata = {'calibrated': True, 'accumulations': 1}
+		for i in range(acqLength):
+			self.assertTrue(journal.append(frameSet, i, images(seed + i)))
+			frameSet.addShot(images(seed + i))
+		return (frameSet, frameSet.metadata['journalSeries'])
+
+	def testRoundTrip(self):
+		journal = self.open()
+		(frameSet, series) = self.series(journal, 0)
+		self.assertEqual(journal.pending(), [])
+		journal.close()
+
+		journal = self.open()
+		self.assertEqual(journal.pending(), [series])
+		(recovered, n) = journal.frameSet(series)
+		self.assertEqual(n, 2)
+		self.assertEqual(recovered.nAcquired, 2)
+		self.assertTrue(np.array_equal(recovered.frames, frameSet.frames))
+		self.assertTrue(recovered.rotate)
+		self.assertFalse(recovered.metadata['calibrated'])
+
+		journal.finish(series)
+		journal.close()
+		self.assertEqual(self.open().pending(), [])
+
+	def testDiscard(self):
+		journal = self.open()
+		self.series(journal, 0)
+		journal.discard()
+		journal.close()
+		self.assertEqual(self.open().pending(), [])
+
+	# Finished records are written over once the ring wraps around, pending ones never are
+	def testWrap(self):
+		journal = self.open()
+		(frameSet, pending) = self.series(journal, 0, acqLength=1)
+		for k in range(SLOTS - 1):
+			(fs, series) = self.series(journal, 10 * k + 10, acqLength=1)
+			journal.finish(series)
+
+		# The next slot is the first one, which is still pending
+		blocked = KRbFrameSet(1, 2, 8, 6)
+		self.assertFalse(journal.append(blocked, 0, images(100)))
+		journal.finish(pending)
+		(frameSet, series) = self.series(journal, 200, acqLength=1)
+		journal.close()
+
+		journal = self.open()
+		self.assertEqual(journal.pending(), [series])
+		self.assertEqual(journal.seq, SLOTS + 1)
+		self.assertEqual(journal.position, KRBCAM_JOURNAL_ALIGN)
+		(recovered, n) = journal.frameSet(series)
+		self.assertTrue(np.array_equal(recovered.frames, frameSet.frames))
+
+		# Writing carries on after the newest record
+		(fs, newer) = self.series(journal, 300, acqLength=1)
+		journal.close()
+		journal = self.open()
+		self.assertEqual(journal.pending(), [series, newer])
+		self.assertEqual(journal.series[newer][0][0], KRBCAM_JOURNAL_ALIGN)
+
+	# An acquisition whose frames don't match their crc stays zero
+	def testDamagedFrames(self):
+		journal = self.open()
+		(frameSet, series) = self.series(journal, 0)
+		offset = journal.series[series][1][0]
+		journal.close()
+
+		journal = self.open()
+		dataOffset = [h['dataOffset'] for (o, h) in journal.series[series] if o == offset][0]
+		journal.f.seek(dataOffset + 5)
+		journal.f.write('\xff')
+		journal.f.flush()
+
+		(recovered, n) = journal.frameSet(series)
+		self.assertEqual(n, 1)
+		self.assertTrue(np.array_equal(recovered.frames[0], frameSet.frames[0]))
+		self.assertFalse(np.any(recovered.frames[1]))
+
+	# A record whose header was only partly written is not found
+	def testTornHeader(self):
+		journal = self.open()
+		(frameSet, series) = self.series(journal, 0)
+		offset = journal.series[series][1][0]
+		journal.close()
+
+		with open(self.path, 'r+b') as f:
+			f.seek(offset + PREFIX.size + FIELDS.size - 4)
+			f.write('\0' * 4)
+
+		journal = self.open()
+		self.assertEqual(journal.pending(), [series])
+		self.assertEqual([h['acq'] for (o, h) in journal.series[series]], [0])
+		(recovered, n) = journal.frameSet(series)
+		self.assertEqual(n, 1)
+		self.assertEqual(recovered.nAcquired, 1)
+
+if __name__ == "__main__":
+	unittest.main()